@@ -0,0 +1,318 @@
+#
+#
+#  Copyright (c) 2014, 2015, 2016, 2017 Psyop Media Company, LLC
+#  See license.txt
+#
+#
+
+"""
+Headless matte extraction from EXR sequences, without Nuke.
+
+    python -m cryptomatte input.%04d.exr --mattes "heroA, tree*" --output matte.%04d.exr
+
+Frames are baked on a pool of processes. Frames whose output already exists
+are skipped, so an interrupted job can be run again to finish it.
+"""
+
+import os
+import re
+import sys
+import time
+
+SEQUENCE_RE = re.compile(r"%0?(\d*)d|#+")
+
+# Each process reuses one BufferPool for all the frames it bakes, and loads
+# the sequence's FrameIndex once.
+_frame_buffers = None
+_frame_indexes = {}
+
+
+#############################################
+# Sequences
+#############################################
+
+
+def _frame_path(pattern, frame):
+    """ Formats a frame path from a pattern with %04d or #### style padding. """
+    def pad(match):
+        if match.group(0).startswith("#"):
+            width = len(match.group(0))
+        else:
+            width = int(match.group(1) or 0)
+        return "%0*d" % (width, frame)
+    return SEQUENCE_RE.sub(pad, pattern)
+
+
+def find_frames(pattern):
+    """ Returns the sorted frame numbers of the existing files of a sequence. """
+    directory, file_pattern = os.path.split(pattern)
+    parts = SEQUENCE_RE.split(file_pattern)
+    if len(parts) < 2:
+        return []
+    regex = re.compile(re.escape(parts[0]) + r"(-?\d+)" + re.escape(parts[-1]) + "$")
+    frames = []
+    for file_name in os.listdir(directory or "."):
+        match = regex.match(file_name)
+        if match:
+            frames.append(int(match.group(1)))
+    return sorted(frames)
+
+
+def index_path(pattern, layer="", location=""):
+    """ Returns the path of the ID index of a sequence's layer, next to it,
+    or in location if it is a directory, or location itself if it is a file
+    path.
+    """
+    directory, file_name = os.path.split(pattern)
+    if location and not (os.path.isdir(location) or location.endswith(("/", os.sep))):
+        return location
+    stem = SEQUENCE_RE.sub("", os.path.splitext(file_name)[0]).strip("._-") or "sequence"
+    return os.path.join(location or directory,
+                        "%s.%s.cryptoindex.npz" % (stem, layer or "default"))
+
+
+def parse_frame_range(frame_range):
+    """ Parses "1001-1100", "1001-1100x2", "1,5,7-9" into a list of frames. """
+    frames = []
+    for part in frame_range.split(","):
+        match = re.match(r"^\s*(-?\d+)(?:-(-?\d+)(?:x(\d+))?)?\s*$", part)
+        if not match:
+            raise ValueError("Invalid frame range: %s" % frame_range)
+        first, last, step = match.groups()
+        last = last if last is not None else first
+        frames += list(range(int(first), int(last) + 1, int(step or 1)))
+    return frames
+
+
+#############################################
+# Baking
+#############################################
+
+
+class BakeJob(object):
+    """ The settings to bake one frame, passed to worker processes. """
+
+    def __init__(self, frame, input_path, output_path, layer, matte_list, options):
+        self.frame = frame
+        self.input_path = input_path
+        self.output_path = output_path
+        self.layer = layer
+        self.matte_list = matte_list
+        self.options = options
+
+
+def get_frame_buffers():
+    """ Returns this process's BufferPool, sized by the first frame baked. """
+    global _frame_buffers
+    import cryptomatte_exr as ce
+
+    if _frame_buffers is None:
+        _frame_buffers = ce.BufferPool()
+    return _frame_buffers
+
+
+def get_frame_index(path):
+    """ Returns this process's FrameIndex loaded from path, or None. """
+    import cryptomatte_index as ci
+
+    if not path:
+        return None
+    key = (path, os.path.getmtime(path))
+    if key not in _frame_indexes:
+        _frame_indexes.clear()
+        _frame_indexes[key] = ci.load_frame_index(path)
+    return _frame_indexes[key]
+
+
+def update_frame_index(jobs, pattern, layer="", processes=None, location=""):
+    """ Builds the index of the IDs in the jobs' input frames, or updates the
+    existing one for frames that changed, and saves it at
+    index_path(pattern, layer, location). Returns its path. Raises IOError or
+    OSError if it can not be written.
+    """
+    import cryptomatte_index as ci
+
+    path = index_path(pattern, layer, location)
+    existing = None
+    if os.path.exists(path):
+        try:
+            existing = ci.load_frame_index(path)
+        except (IOError, OSError, ValueError, KeyError):
+            existing = None  # rebuilt below
+    paths = dict((job.frame, job.input_path) for job in jobs if os.path.exists(job.input_path))
+    index = ci.build_frame_index(paths, layer, existing, processes)
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    index.save(path)
+    return path
+
+
+def bake_frame(job):
+    """ Writes one frame's matte. Returns (frame, status, message), where
+    status is "written", "skipped" or "failed".
+    """
+    import cryptomatte_exr as ce
+    import cryptomatte_utilities as cu
+    import cryptomatte_extraction as cx
+
+    if os.path.exists(job.output_path) and not job.options.get("overwrite"):
+        return job.frame, "skipped", ""
+    start = time.time()
+    temp_path = "%s.%s.tmp" % (job.output_path, os.getpid())
+    try:
+        cinfo = ce.ExrCryptomatteInfo(job.input_path)
+        if job.layer and not cinfo.set_selection(job.layer):
+            raise ValueError("No cryptomatte layer %s, found: %s" % (
+                job.layer, ", ".join(sorted(cinfo.get_cryptomatte_names()))))
+        if not cinfo.is_valid():
+            raise ValueError("No cryptomatte found.")
+        matte_list = cu.MatteList(job.matte_list)
+        matte_list.expand_wildcards(cinfo)
+        ids = matte_list.IDs
+        index = get_frame_index(job.options.get("index"))
+        if index is not None and index.is_current(job.frame, job.input_path):
+            if not index.contains(job.frame, ids):
+                ids = []  # black, written without decoding the frame
+
+        output_dir = os.path.dirname(job.output_path)
+        if output_dir and not os.path.isdir(output_dir):
+            try:
+                os.makedirs(output_dir)
+            except OSError:
+                pass  # made by another worker
+        cx.write_matte(cinfo, ids, temp_path,
+                       band_height=job.options.get("band_height", 64),
+                       compression=job.options.get("compression", "ZIP"),
+                       channel_name=job.options.get("channel", "A"),
+                       threads=job.options.get("threads", 1),
+                       buffers=get_frame_buffers())
+        # Outputs only appear once complete, so existing outputs can be skipped.
+        if os.path.exists(job.output_path):
+            os.remove(job.output_path)
+        os.rename(temp_path, job.output_path)
+    except Exception as e:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return job.frame, "failed", "%s: %s" % (type(e).__name__, e)
+    return job.frame, "written", "%.2f s%s" % (time.time() - start, "" if ids else ", empty")
+
+
+def bake_sequence(jobs, processes=None, report=None):
+    """ Bakes jobs on a pool of processes, calling report(result, done, total)
+    in frame order as results come in. Returns the list of results.
+    """
+    import multiprocessing
+
+    processes = processes or multiprocessing.cpu_count()
+    results = []
+    if processes == 1 or len(jobs) < 2:
+        result_iter = (bake_frame(job) for job in jobs)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(min(processes, len(jobs)))
+        result_iter = pool.imap(bake_frame, jobs)
+    try:
+        for result in result_iter:
+            results.append(result)
+            if report:
+                report(result, len(results), len(jobs))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    return results
+
+
+#############################################
+# Command line
+#############################################
+
+
+def _parse_args(argv):
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog="python -m cryptomatte",
+        description="Extracts Cryptomatte mattes from EXR sequences, without Nuke.")
+    parser.add_argument("input", help="EXR sequence, with %%04d or #### frame padding.")
+    parser.add_argument("-o", "--output", required=True,
+                        help="Output EXR sequence, with %%04d or #### frame padding.")
+    parser.add_argument("-m", "--mattes", required=True,
+                        help='Matte list, as in the gizmo\'s matte list: "name1, name2, <0.5>, '
+                             'name*". Wildcards are expanded from each frame\'s manifest.')
+    parser.add_argument("-l", "--layer", default="",
+                        help="Cryptomatte layer, such as CryptoObject. Default: the first.")
+    parser.add_argument("-f", "--frames", default="",
+                        help='Frames, such as "1001-1100" or "1,5,7-9". Default: existing files.')
+    parser.add_argument("-j", "--jobs", type=int, default=0,
+                        help="Processes to use. Default: one per core.")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="Write frames whose output already exists.")
+    parser.add_argument("--channel", default="A", help="Output channel name. Default: A.")
+    parser.add_argument("--compression", default="ZIP", choices=["NONE", "RLE", "ZIPS", "ZIP"],
+                        help="Output compression. Default: ZIP.")
+    parser.add_argument("--band-height", type=int, default=64,
+                        help="Scanlines per band when processing frames. Default: 64.")
+    parser.add_argument("--index", action="store_true",
+                        help="Build or update an index of the IDs in each input frame, saved "
+                             "next to the input, and use it to write frames without the mattes "
+                             "without decoding them.")
+    parser.add_argument("--index-path", default="",
+                        help="Where to save the --index file instead of next to the input, "
+                             "such as when the input directory is read only: a directory, or "
+                             "a file path.")
+    return parser.parse_args(argv)
+
+
+def make_jobs(args):
+    if args.frames:
+        frames = parse_frame_range(args.frames)
+    else:
+        frames = find_frames(args.input)
+    options = {
+        "overwrite": args.overwrite,
+        "channel": args.channel,
+        "compression": args.compression,
+        "band_height": args.band_height,
+        "threads": 1,
+    }
+    return [BakeJob(frame, _frame_path(args.input, frame), _frame_path(args.output, frame),
+                    args.layer, args.mattes, options) for frame in frames]
+
+
+def main(argv=None):
+    args = _parse_args(sys.argv[1:] if argv is None else argv)
+    if not SEQUENCE_RE.search(args.input) or not SEQUENCE_RE.search(args.output):
+        print("Cryptomatte: input and output must have frame padding (%04d or ####).")
+        return 2
+    jobs = make_jobs(args)
+    if not jobs:
+        print("Cryptomatte: No frames found for %s" % args.input)
+        return 1
+
+    def report(result, done, total):
+        frame, status, message = result
+        print("[%d/%d] frame %d %s%s" % (done, total, frame, status,
+                                         " (%s)" % message if message else ""))
+        sys.stdout.flush()
+
+    start = time.time()
+    if args.index:
+        try:
+            path = update_frame_index(jobs, args.input, args.layer, args.jobs, args.index_path)
+        except (IOError, OSError) as e:
+            print("Cryptomatte: Could not write the index (%s), baking without it. Use "
+                  "--index-path to save it elsewhere." % e)
+        else:
+            for job in jobs:
+                job.options["index"] = path
+            print("Cryptomatte: Indexed %s in %.1f s." % (path, time.time() - start))
+    results = bake_sequence(jobs, args.jobs, report)
+    failed = [result for result in results if result[1] == "failed"]
+    print("Cryptomatte: %d frames in %.1f s, %d failed." % (len(results), time.time() - start,
+                                                           len(failed)))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,200 @@
+#
+#
+#  Copyright (c) 2014, 2015, 2016, 2017 Psyop Media Company, LLC
+#  See license.txt
+#
+#
+
+""" An on-disk cache of extracted mattes, for flipping between matte lists
+without extracting them again.
+"""
+
+import os
+import json
+import zlib
+import hashlib
+
+import numpy as np
+
+import cryptomatte_extraction as cx
+
+CACHE_VERSION = 1
+
+
+#############################################
+# Cache keys
+#############################################
+
+
+def source_identity(path):
+    """ Returns a string identifying a file's current contents: its real
+    path, size and modification time.
+    """
+    stat = os.stat(path)
+    return "%s:%d:%d" % (os.path.realpath(path), stat.st_size,
+                         getattr(stat, "st_mtime_ns", int(stat.st_mtime * 1e9)))
+
+
+def ids_digest(ids):
+    """ Returns a digest of an ID set (float IDs such as MatteList.IDs, or
+    keys), the same for any order or repetition of the IDs.
+    """
+    return hashlib.sha1(cx._as_keys(ids).astype("<u4").tobytes()).hexdigest()
+
+
+def cache_key(cinfo, ids, dtype=np.float32, crop=False):
+    """ Returns the cache key of the matte of ids in an ExrCryptomatteInfo's
+    selected layer, from the file's identity, the layer's metadata ID, the
+    stored dtype and crop setting and the digest of the IDs.
+    """
+    parts = [str(CACHE_VERSION), source_identity(cinfo.header.path), str(cinfo.selection),
+             np.dtype(dtype).str, "crop" if crop else "full", ids_digest(ids)]
+    return hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()
+
+
+#############################################
+# Matte cache
+#############################################
+
+
+def _crop_window(matte):
+    """ Returns the (xmin, ymin, xmax, ymax) array bounds of the nonzero
+    pixels of matte, or None. """
+    rows = np.flatnonzero(matte.any(axis=1))
+    if not len(rows):
+        return None
+    columns = np.flatnonzero(matte[rows[0]:rows[-1] + 1].any(axis=0))
+    return int(columns[0]), int(rows[0]), int(columns[-1]), int(rows[-1])
+
+
+class MatteCache(object):
+    """ Extracted mattes stored in a directory, as .npy files with a .json
+    description, evicting the least recently used mattes beyond max_bytes.
+
+    Args:
+        dtype is float32 or float16.
+        crop stores only the bounding box of the nonzero pixels.
+        compress stores zlib compressed data. Compressed mattes are
+        decompressed on a hit, others are returned memory mapped.
+
+    hits and misses count the lookups.
+    """
+
+    def __init__(self, directory, max_bytes=2 * 1024 ** 3, dtype=np.float32, crop=False,
+                 compress=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.dtype = np.dtype(dtype)
+        self.crop = crop
+        self.compress = compress
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _paths(self, key):
+        base = os.path.join(self.directory, key)
+        return base + ".npy", base + ".json"
+
+    def get(self, cinfo, ids):
+        """ Returns (window, matte) of a cached matte, or None. window is
+        (xmin, ymin, xmax, ymax) in the pixel coordinates of the data window,
+        as in ExrScanlineReader.read(), or None for an empty cropped matte.
+        """
+        data_path, info_path = self._paths(cache_key(cinfo, ids, self.dtype, self.crop))
+        try:
+            with open(info_path) as f:
+                info = json.load(f)
+            if info["compressed"]:
+                data = zlib.decompress(np.load(data_path).tobytes())
+                matte = np.frombuffer(data, dtype=info["dtype"]).reshape(info["shape"])
+            else:
+                matte = np.load(data_path, mmap_mode="r")
+            os.utime(info_path, None)  # most recently used
+        except (IOError, OSError, ValueError, KeyError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return tuple(info["window"]) if info["window"] else None, matte
+
+    def put(self, cinfo, ids, matte):
+        """ Stores the full frame matte of ids, and returns (window, matte)
+        as get() would.
+        """
+        data_path, info_path = self._paths(cache_key(cinfo, ids, self.dtype, self.crop))
+        xmin, ymin, xmax, ymax = cinfo.header.parts[0].data_window
+        window = (xmin, ymin, xmax, ymax)
+        matte = matte.astype(self.dtype, copy=False)
+        if self.crop:
+            bounds = _crop_window(matte)
+            if bounds is None:
+                window, matte = None, matte[:0, :0]
+            else:
+                matte = matte[bounds[1]:bounds[3] + 1, bounds[0]:bounds[2] + 1]
+                window = (xmin + bounds[0], ymin + bounds[1], xmin + bounds[2], ymin + bounds[3])
+        matte = np.ascontiguousarray(matte)
+        info = {"window": window, "shape": matte.shape, "dtype": matte.dtype.str,
+                "compressed": self.compress}
+
+        suffix = ".%s.tmp" % os.getpid()
+        with open(data_path + suffix, "wb") as f:
+            if self.compress:
+                np.save(f, np.frombuffer(zlib.compress(matte.tobytes()), dtype=np.uint8))
+            else:
+                np.save(f, matte)
+        with open(info_path + suffix, "w") as f:
+            json.dump(info, f)
+        for path in [data_path, info_path]:
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(path + suffix, path)
+        self.evict()
+        return window, matte
+
+    def matte(self, cinfo, ids, ranks=None):
+        """ Returns (window, matte) of ids from the cache, or extracts and
+        caches it. ranks are optional (rank_ids, rank_coverage) or SparseRanks
+        of the frame, which are read from the file otherwise.
+        """
+        cached = self.get(cinfo, ids)
+        if cached is not None:
+            return cached
+        if isinstance(ranks, cx.SparseRanks):
+            matte = ranks.extract(ids)
+        else:
+            rank_ids, rank_coverage = ranks or cinfo.read_ranks()
+            matte = cx.extract_matte(rank_ids, rank_coverage, ids)
+        return self.put(cinfo, ids, matte)
+
+    def entries(self):
+        """ Returns [(last use, bytes, key)] of the cached mattes, oldest first. """
+        entries = []
+        for file_name in os.listdir(self.directory):
+            key, extension = os.path.splitext(file_name)
+            if extension != ".json":
+                continue
+            data_path, info_path = self._paths(key)
+            try:
+                size = os.path.getsize(data_path) + os.path.getsize(info_path)
+                entries.append((os.path.getmtime(info_path), size, key))
+            except OSError:
+                pass  # evicted by another process
+        return sorted(entries)
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        """ Removes the least recently used mattes until the cache fits in
+        max_bytes. """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            for path in self._paths(key):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
@@ -0,0 +1,340 @@
+#
+#
+#  Copyright (c) 2014, 2015, 2016, 2017 Psyop Media Company, LLC
+#  See license.txt
+#
+#
+
+""" Adds mattes to cryptomatte ranks without Nuke, like the Encryptomatte
+gizmo does.
+"""
+
+import numpy as np
+
+import cryptomatte_utilities as cu
+
+MERGE_OPERATIONS = ["over", "under"]
+
+
+#############################################
+# Manifests
+#############################################
+
+
+def add_manifest_id(manifest, name, ID):
+    """ Returns a copy of a manifest dict of names to hex IDs, as stored in
+    the EXR metadata, with name added. Raises ValueError if another name has
+    the same ID.
+    """
+    return add_manifest_ids(manifest, [(name, ID)])
+
+
+def add_manifest_ids(manifest, names_ids):
+    """ Returns a copy of manifest with all (name, ID) pairs added, checking
+    for collisions in one pass, as add_manifest_id().
+    """
+    return _add_manifest_hexes(manifest, [(name, cu.id_to_hex(ID)) for name, ID in names_ids])
+
+
+def _add_manifest_hexes(manifest, names_hexes):
+    manifest = dict(manifest or {})
+    names_by_hex = dict((id_hex.lower(), name) for name, id_hex in manifest.items())
+    for name, id_hex in names_hexes:
+        other_name = names_by_hex.setdefault(id_hex.lower(), name)
+        if other_name != name:
+            raise ValueError("Cryptomatte: %s has the same ID as %s (%s)." % (
+                name, other_name, id_hex))
+        manifest[name] = id_hex
+    return manifest
+
+
+def merge_manifests(manifest_a, manifest_b):
+    """ Returns the union of two manifests of names to hex IDs. Raises
+    ValueError if two names have the same ID, or a name has a different ID
+    in each.
+    """
+    for name, id_hex in sorted(manifest_b.items()):
+        other_hex = manifest_a.get(name, id_hex)
+        if other_hex.lower() != id_hex.lower():
+            raise ValueError("Cryptomatte: %s has different IDs, %s and %s." % (
+                name, other_hex, id_hex))
+    return _add_manifest_hexes(manifest_a, sorted(manifest_b.items()))
+
+
+#############################################
+# Matte insertion
+#############################################
+
+
+def _sorted_ranks(ids, coverage, ranks):
+    """ Returns the ranks entries with the most coverage of each pixel, from
+    (height, width, candidates) arrays, sorted stably by coverage.
+    """
+    if ranks < coverage.shape[-1] // 2:
+        # Partitioning first only pays off with many candidates. The full
+        # sort also keeps ties at the cut in candidate order.
+        top = np.argpartition(-coverage, ranks - 1, axis=-1)[..., :ranks]
+        top.sort(axis=-1)
+        ids = np.take_along_axis(ids, top, axis=-1)
+        coverage = np.take_along_axis(coverage, top, axis=-1)
+    order = np.argsort(-coverage, axis=-1, kind="stable")[..., :ranks]
+    coverage = np.take_along_axis(coverage, order, axis=-1)
+    ids = np.take_along_axis(ids, order, axis=-1)
+    ids[coverage == 0.0] = 0.0
+    return ids, coverage
+
+
+def _insert_band(rank_ids, rank_coverage, alphas, keys, operation, ranks):
+    """ Inserts mattes alphas with keys into one band of ranks. Returns
+    (ids, coverage) of shape (height, width, ranks), sorted.
+    """
+    count, num_mattes = len(rank_ids), len(keys)
+    shape = rank_coverage.shape[1:]
+    matte_coverage = [None] * num_mattes
+    if operation == "over":
+        # Each matte is scaled by (1 - alpha) of the mattes over it.
+        later = np.ones(shape, dtype=np.float32)
+        for index in reversed(range(num_mattes)):
+            matte_coverage[index] = alphas[index] * later
+            later *= np.float32(1.0) - alphas[index]
+        scaled = rank_coverage * later
+    else:
+        scaled = rank_coverage.copy()
+        covered = rank_coverage.sum(axis=0, dtype=np.float32)
+        for index in range(num_mattes):
+            remaining = np.maximum(np.float32(1.0) - covered, np.float32(0.0))
+            matte_coverage[index] = alphas[index] * remaining
+            covered += matte_coverage[index]
+
+    # Coverage an object already had is merged into its latest entry.
+    rank_keys = rank_ids.view(np.uint32)
+    for index, key in enumerate(keys):
+        for earlier in range(index):
+            if keys[earlier] == key:
+                matte_coverage[index] += matte_coverage[earlier]
+                matte_coverage[earlier][...] = 0.0
+        for rank in range(count):
+            same = rank_keys[rank] == key
+            if not same.any():
+                continue
+            np.add(matte_coverage[index], scaled[rank], out=matte_coverage[index], where=same)
+            scaled[rank][same] = 0.0
+
+    # Ranks last, so the sort runs over contiguous rows. A chain of inserts
+    # leaves later mattes first among equal coverage for over, last for under.
+    ids = np.empty(shape + (count + num_mattes,), dtype=np.float32)
+    coverage = np.empty_like(ids)
+    if operation == "over":
+        slots = [num_mattes - 1 - index for index in range(num_mattes)]
+        existing = slice(num_mattes, None)
+    else:
+        slots = [count + index for index in range(num_mattes)]
+        existing = slice(None, count)
+    ids[..., existing] = np.moveaxis(rank_ids, 0, -1)
+    coverage[..., existing] = np.moveaxis(scaled, 0, -1)
+    for index, key in enumerate(keys):
+        ids[..., slots[index]] = np.uint32(key).view(np.float32)
+        coverage[..., slots[index]] = matte_coverage[index]
+    return _sorted_ranks(ids, coverage, ranks)
+
+
+def insert_mattes(rank_ids, rank_coverage, mattes, manifest=None, ranks=None, operation="over",
+                  band_height=32):
+    """ Adds many mattes to ranks at once, as a chain of insert_matte() calls
+    in the same order would, sorting the ranks once.
+
+    Args:
+        mattes is a list of (name, alpha) pairs.
+        The other arguments are as for insert_matte().
+
+    Returns (rank_ids, rank_coverage, manifest). Coverage matches the chain
+    up to float rounding and the order of ties, except that the chain drops
+    ranks beyond the count at each step, which for under leaves more of each
+    pixel uncovered for the later mattes.
+    """
+    if operation not in MERGE_OPERATIONS:
+        raise ValueError("Cryptomatte: Unknown merge operation %s." % operation)
+    names_ids = [(name, cu.mm3hash_float(name)) for name, _ in mattes]
+    manifest = add_manifest_ids(manifest, names_ids)
+    keys = [np.float32(ID).view(np.uint32) for _, ID in names_ids]
+    alphas = [np.asarray(alpha, dtype=np.float32) for _, alpha in mattes]
+    count, height, width = rank_ids.shape
+    ranks = ranks or count
+    used = min(ranks, count + len(keys))
+
+    out_ids = np.zeros((ranks, height, width), dtype=np.float32)
+    out_coverage = np.zeros((ranks, height, width), dtype=np.float32)
+    for y in range(0, height, band_height):
+        rows = slice(y, y + band_height)
+        ids, coverage = _insert_band(rank_ids[:, rows], rank_coverage[:, rows],
+                                     [alpha[rows] for alpha in alphas], keys, operation, used)
+        out_ids[:used, rows] = np.moveaxis(ids, -1, 0)
+        out_coverage[:used, rows] = np.moveaxis(coverage, -1, 0)
+    return out_ids, out_coverage, manifest
+
+
+def insert_matte(rank_ids, rank_coverage, alpha, name, manifest=None, ranks=None,
+                 operation="over", band_height=32):
+    """ Adds a matte to ranks, like the Encryptomatte gizmo.
+
+    Args:
+        rank_ids, rank_coverage are float32 arrays of shape (ranks, height,
+        width), such as from ExrCryptomatteInfo.read_ranks().
+        alpha is the matte, a (height, width) float array.
+        name is the matte's name, hashed with mm3hash_float for its ID.
+        manifest is an optional dict of names to hex IDs.
+        ranks is the number of ranks to return, default the same as given.
+        The ranks with the least coverage are dropped.
+        operation "over" scales the existing coverage by (1 - alpha) and adds
+        the matte, "under" adds alpha * (1 - existing coverage).
+
+    Returns (rank_ids, rank_coverage, manifest), re-sorted by coverage. The
+    new entry goes before ranks with equal coverage for over, after them for
+    under. Coverage the object already had is merged into it.
+    """
+    return insert_mattes(rank_ids, rank_coverage, [(name, alpha)], manifest, ranks, operation,
+                         band_height)
+
+
+#############################################
+# Layer merging
+#############################################
+
+
+def _merge_band(ids_a, coverage_a, ids_b, coverage_b, ranks):
+    """ Merges one band of two rank sets. Returns (ids, coverage) of shape
+    (height, width, ranks), sorted.
+    """
+    coverage_a, coverage_b = coverage_a.copy(), coverage_b.copy()
+    keys_a, keys_b = ids_a.view(np.uint32), ids_b.view(np.uint32)
+    # Objects in both sets keep one entry, with the summed coverage.
+    for rank_b in range(len(ids_b)):
+        for rank_a in range(len(ids_a)):
+            same = keys_b[rank_b] == keys_a[rank_a]
+            if not same.any():
+                continue
+            np.add(coverage_a[rank_a], coverage_b[rank_b], out=coverage_a[rank_a], where=same)
+            coverage_b[rank_b][same] = 0.0
+    ids = np.concatenate([np.moveaxis(ids_a, 0, -1), np.moveaxis(ids_b, 0, -1)], axis=-1)
+    coverage = np.concatenate([np.moveaxis(coverage_a, 0, -1), np.moveaxis(coverage_b, 0, -1)],
+                              axis=-1)
+    return _sorted_ranks(ids, coverage, ranks)
+
+
+def merge_ranks(ids_a, coverage_a, ids_b, coverage_b, ranks=None, band_height=32):
+    """ Merges two rank sets of the same frame, such as separate render
+    passes, keeping the ranks with the most coverage of each pixel. An ID
+    in both sets gets the sum of its coverage. Ties go to the first set.
+
+    ranks is the number of ranks to return, default the most of either set.
+    Returns (rank_ids, rank_coverage).
+    """
+    if ids_a.shape[1:] != ids_b.shape[1:]:
+        raise ValueError("Cryptomatte: Can not merge ranks of shapes %s and %s." % (
+            ids_a.shape[1:], ids_b.shape[1:]))
+    height, width = ids_a.shape[1:]
+    ranks = ranks or max(len(ids_a), len(ids_b))
+    used = min(ranks, len(ids_a) + len(ids_b))
+    out_ids = np.zeros((ranks, height, width), dtype=np.float32)
+    out_coverage = np.zeros((ranks, height, width), dtype=np.float32)
+    for y in range(0, height, band_height):
+        rows = slice(y, y + band_height)
+        ids, coverage = _merge_band(ids_a[:, rows], coverage_a[:, rows], ids_b[:, rows],
+                                    coverage_b[:, rows], used)
+        out_ids[:used, rows] = np.moveaxis(ids, -1, 0)
+        out_coverage[:used, rows] = np.moveaxis(coverage, -1, 0)
+    return out_ids, out_coverage
+
+
+def _open_layer(path, layer):
+    import cryptomatte_exr as ce
+
+    cinfo = ce.ExrCryptomatteInfo(path)
+    if layer and not cinfo.set_selection(layer):
+        raise ValueError("Cryptomatte: No cryptomatte layer %s in %s, found: %s" % (
+            layer, path, ", ".join(sorted(cinfo.get_cryptomatte_names()))))
+    if not cinfo.is_valid():
+        raise ValueError("Cryptomatte: No cryptomatte found in %s." % path)
+    return cinfo
+
+
+def _manifest_hexes(cinfo):
+    return dict((name, cu.id_to_hex(ID)) for name, ID in cinfo.parse_manifest().items())
+
+
+def _passthrough_channels(cinfo, name):
+    """ Returns the ExrChannels of a file to copy to a merge of its selected
+    cryptomatte into layer name: all but the channels of either layer. """
+    import re
+
+    merged = set(channel for pair in cinfo.get_rank_channels() for channel in pair)
+    output_layer = re.compile(r"%s\d+\." % re.escape(name))
+    return [channel for nuke_name, (_, channel) in sorted(cinfo.exr_channels.items())
+            if nuke_name not in merged and not output_layer.match(channel.name)]
+
+
+def merge_cryptomatte_files(path_a, path_b, output_path, name=None, layer_a=None, layer_b=None,
+                            ranks=None, band_height=64, compression="ZIP", threads=None,
+                            copy_channels=True):
+    """ Merges a cryptomatte layer of two files with the same data window,
+    as merge_ranks(), and writes it as layer name (default, that of the
+    first file) with the merged manifest. Reads, merges and writes a band of
+    scanlines at a time, so memory use does not depend on the frame size.
+
+    The output keeps the display window and metadata of the first file.
+    With copy_channels, its other channels, such as rgba and other
+    cryptomattes, are copied unchanged too. Otherwise, only the merged layer
+    is written. Nothing else of the second file is kept.
+    """
+    import cryptomatte_exr as ce
+
+    cinfo_a, cinfo_b = _open_layer(path_a, layer_a), _open_layer(path_b, layer_b)
+    part = cinfo_a.header.parts[0]
+    window = part.data_window
+    if cinfo_b.header.parts[0].data_window != window:
+        raise ValueError("Cryptomatte: %s and %s have different data windows." % (
+            path_a, path_b))
+    manifest = merge_manifests(_manifest_hexes(cinfo_a), _manifest_hexes(cinfo_b))
+    name = name or cinfo_a.get_selection_name()
+    count_a, count_b = len(cinfo_a.get_rank_channels()), len(cinfo_b.get_rank_channels())
+    ranks = ranks or max(count_a, count_b)
+    used = min(ranks, count_a + count_b)
+
+    # The merged layer replaces the first file's layer, and its metadata.
+    replaced = [cu.CRYPTO_METADATA_DEFAULT_PREFIX + prefix + "/"
+                for prefix in [cinfo_a.selection, cu.layer_hash(name)]]
+    attributes = dict((key, value) for key, value in part.metadata_attributes().items()
+                      if not any(key.startswith(prefix) for prefix in replaced))
+    attributes.update(ce.cryptomatte_attributes(name, manifest))
+    passthrough = _passthrough_channels(cinfo_a, name) if copy_channels else []
+
+    # Whole chunks of any decodable compression, so bands line up.
+    chunk = max(ce.EXR_LINES_PER_CHUNK[c] for c in ce.EXR_DECODABLE_COMPRESSIONS)
+    band_height = -(-max(band_height, 1) // chunk) * chunk
+    xmin, ymin, xmax, ymax = window
+    width, height = xmax - xmin + 1, ymax - ymin + 1
+    out_ids = np.zeros((ranks, band_height, width), dtype=np.float32)
+    out_coverage = np.zeros_like(out_ids)
+    planes = [np.empty((band_height, width), dtype=ce.EXR_PIXEL_TYPE_DTYPES[channel.pixel_type])
+              for channel in passthrough]
+    channel_types = dict.fromkeys(ce.cryptomatte_channels(name, out_ids, out_coverage),
+                                  np.float32)
+    channel_types.update((channel.name, plane.dtype) for channel, plane in zip(passthrough, planes))
+    writer = ce.ExrScanlineWriter(output_path, channel_types, width, height, compression,
+                                  attributes, (xmin, ymin), **part.display_attributes())
+    with writer, ce.ExrScanlineReader(path_a, cinfo_a.header, threads) as reader:
+        bands_b = cinfo_b.iter_rank_bands(band_height, threads)
+        for first_line, ids_a, coverage_a in cinfo_a.iter_rank_bands(band_height, threads):
+            _, ids_b, coverage_b = next(bands_b)
+            lines = ids_a.shape[1]
+            ids, coverage = _merge_band(ids_a, coverage_a, ids_b, coverage_b, used)
+            out_ids[:used, :lines] = np.moveaxis(ids, -1, 0)
+            out_coverage[:used, :lines] = np.moveaxis(coverage, -1, 0)
+            channels = ce.cryptomatte_channels(name, out_ids[:, :lines], out_coverage[:, :lines])
+            if passthrough:
+                band = [plane[:lines] for plane in planes]
+                reader.read([channel.nuke_name for channel in passthrough], band,
+                            (xmin, first_line, xmax, first_line + lines - 1))
+                channels.update((channel.name, plane) for channel, plane in zip(passthrough, band))
+            writer.write(channels)
+    return manifest
@@ -0,0 +1,998 @@
+#
+#
+#  Copyright (c) 2014, 2015, 2016, 2017 Psyop Media Company, LLC
+#  See license.txt
+#
+#
+
+import mmap
+import zlib
+import struct
+import threading
+
+import cryptomatte_utilities as cu
+
+try:
+    import numpy as np
+except ImportError:
+    # Headers can still be read without numpy, pixels cannot.
+    np = None
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # Python 2.7 without the futures backport decodes on one thread.
+    ThreadPoolExecutor = None
+
+EXR_MAGIC = 20000630
+EXR_FLAG_TILED = 0x200
+EXR_FLAG_LONG_NAMES = 0x400
+EXR_FLAG_DEEP = 0x800
+EXR_FLAG_MULTIPART = 0x1000
+
+EXR_COMPRESSION_NAMES = [
+    "NONE", "RLE", "ZIPS", "ZIP", "PIZ", "PXR24", "B44", "B44A", "DWAA", "DWAB"
+]
+EXR_LINES_PER_CHUNK = {
+    "NONE": 1, "RLE": 1, "ZIPS": 1, "ZIP": 16, "PIZ": 32, "PXR24": 16,
+    "B44": 32, "B44A": 32, "DWAA": 32, "DWAB": 256
+}
+EXR_PIXEL_TYPE_NAMES = ["UINT", "HALF", "FLOAT"]
+EXR_PIXEL_TYPE_SIZES = [4, 2, 4]
+EXR_PIXEL_TYPE_DTYPES = ["<u4", "<f2", "<f4"]
+EXR_DECODABLE_COMPRESSIONS = ["NONE", "RLE", "ZIPS", "ZIP"]
+
+# Attributes describing the layout of a part, which writers set themselves.
+EXR_LAYOUT_ATTRIBUTES = [
+    "channels", "compression", "dataWindow", "displayWindow", "lineOrder", "pixelAspectRatio",
+    "screenWindowCenter", "screenWindowWidth", "tiles", "type", "name", "version", "chunkCount",
+    "maxSamplesPerPixel",
+]
+
+# Threads used to decompress chunks, None for one per core (up to 16).
+DECODE_THREADS = None
+
+# EXR channel names Nuke shows as red, green, blue and alpha
+NUKE_CHANNEL_NAMES = {
+    "r": "red", "red": "red", "g": "green", "green": "green",
+    "b": "blue", "blue": "blue", "a": "alpha", "alpha": "alpha",
+}
+
+
+#############################################
+# Header parsing
+#############################################
+
+
+def _decode_string(value):
+    """ Returns attribute strings as str, like Nuke's metadata. """
+    if str is bytes:
+        return value  # Python 2.7
+    return value.decode("utf-8", "replace")
+
+
+def _unpacker(fmt):
+    unpack = struct.Struct("<" + fmt).unpack
+    return lambda value: unpack(value)
+
+
+def _unpack_single(fmt):
+    unpack = struct.Struct("<" + fmt).unpack
+    return lambda value: unpack(value)[0]
+
+
+def _parse_chlist(value):
+    channels = []
+    pos = 0
+    while value[pos:pos + 1] != b"\0":
+        end = value.index(b"\0", pos)
+        name = _decode_string(value[pos:end])
+        pixel_type, _, x_sampling, y_sampling = struct.unpack("<iiii", value[end + 1:end + 17])
+        channels.append(ExrChannel(name, pixel_type, x_sampling, y_sampling))
+        pos = end + 17
+    return channels
+
+
+def _parse_string_vector(value):
+    strings = []
+    pos = 0
+    while pos < len(value):
+        size, = struct.unpack("<i", value[pos:pos + 4])
+        strings.append(_decode_string(value[pos + 4:pos + 4 + size]))
+        pos += 4 + size
+    return strings
+
+
+EXR_ATTRIBUTE_PARSERS = {
+    "string": _decode_string,
+    "int": _unpack_single("i"),
+    "float": _unpack_single("f"),
+    "double": _unpack_single("d"),
+    "box2i": _unpacker("iiii"),
+    "box2f": _unpacker("ffff"),
+    "v2i": _unpacker("ii"),
+    "v2f": _unpacker("ff"),
+    "v3i": _unpacker("iii"),
+    "v3f": _unpacker("fff"),
+    "m33f": _unpacker("9f"),
+    "m44f": _unpacker("16f"),
+    "rational": _unpacker("iI"),
+    "compression": _unpack_single("B"),
+    "lineOrder": _unpack_single("B"),
+    "envmap": _unpack_single("B"),
+    "deepImageState": _unpack_single("B"),
+    "tiledesc": _unpacker("IIB"),
+    "chlist": _parse_chlist,
+    "stringvector": _parse_string_vector,
+}
+
+
+class ExrChannel(object):
+    def __init__(self, name, pixel_type, x_sampling=1, y_sampling=1):
+        self.name = name
+        self.pixel_type = pixel_type
+        self.x_sampling = x_sampling
+        self.y_sampling = y_sampling
+
+    @property
+    def nuke_name(self):
+        """ The channel name as Nuke shows it, eg. "CryptoObject00.R" becomes
+        "CryptoObject00.red". Layer names are made legal the same way Nuke does.
+        """
+        layer, _, channel = self.name.rpartition(".")
+        channel = NUKE_CHANNEL_NAMES.get(channel.lower(), channel)
+        if not layer:
+            return channel
+        return "%s.%s" % (cu._legal_nuke_layer_name(layer), channel)
+
+    @property
+    def size(self):
+        return EXR_PIXEL_TYPE_SIZES[self.pixel_type]
+
+    def __repr__(self):
+        return "ExrChannel(%r, %s)" % (self.name, EXR_PIXEL_TYPE_NAMES[self.pixel_type])
+
+
+class ExrPart(object):
+    """ A part of an EXR file (single-part files have one), with its attributes. """
+
+    def __init__(self, attributes, tiled=False, raw_attributes=None):
+        self.attributes = attributes
+        self.raw_attributes = raw_attributes or {}
+        self.channels = attributes.get("channels", [])
+        self.compression = EXR_COMPRESSION_NAMES[attributes.get("compression", 0)]
+        self.data_window = attributes.get("dataWindow", (0, 0, -1, -1))
+        self.line_order = attributes.get("lineOrder", 0)
+        self.tiled = tiled or attributes.get("type", "") in ["tiledimage", "deeptile"]
+        self.deep = attributes.get("type", "").startswith("deep")
+        self.name = attributes.get("name", "")
+        self.offset_table_position = None
+
+    @property
+    def width(self):
+        return self.data_window[2] - self.data_window[0] + 1
+
+    @property
+    def height(self):
+        return self.data_window[3] - self.data_window[1] + 1
+
+    @property
+    def lines_per_chunk(self):
+        return EXR_LINES_PER_CHUNK[self.compression]
+
+    def display_attributes(self):
+        """ Returns the displayWindow, pixelAspectRatio and screenWindow*
+        attributes as keyword arguments of ExrScanlineWriter, so outputs keep
+        the format of their source. """
+        return {
+            "display_window": self.attributes.get("displayWindow", self.data_window),
+            "pixel_aspect_ratio": self.attributes.get("pixelAspectRatio", 1.0),
+            "screen_window_center": self.attributes.get("screenWindowCenter", (0.0, 0.0)),
+            "screen_window_width": self.attributes.get("screenWindowWidth", 1.0),
+        }
+
+    def metadata_attributes(self):
+        """ Returns the attributes other than EXR_LAYOUT_ATTRIBUTES, as
+        (type, bytes) pairs ExrScanlineWriter writes unchanged. """
+        return dict((name, value) for name, value in self.raw_attributes.items()
+                    if name not in EXR_LAYOUT_ATTRIBUTES)
+
+    @property
+    def chunk_count(self):
+        if "chunkCount" in self.attributes:
+            return self.attributes["chunkCount"]
+        if self.tiled:
+            return None  # only needed for multi-part files, where it is required.
+        return (self.height + self.lines_per_chunk - 1) // self.lines_per_chunk
+
+
+class ExrHeader(object):
+    """ The headers of an OpenEXR file, read without decoding any pixels. """
+
+    def __init__(self, path, version, parts):
+        self.path = path
+        self.version = version
+        self.parts = parts
+
+    @property
+    def multipart(self):
+        return bool(self.version & EXR_FLAG_MULTIPART)
+
+    def metadata(self):
+        """ Returns the attributes as Nuke presents them, with "exr/" prefixes,
+        so CryptomatteInfo can process them the same way. For multi-part files
+        the first part with a given attribute wins.
+        """
+        metadata = {}
+        for part in reversed(self.parts):
+            for name, value in part.attributes.items():
+                if name != "channels":
+                    metadata["exr/" + name] = value
+        metadata["input/filename"] = self.path
+        return metadata
+
+    def channels(self):
+        """ Returns a dict of Nuke style channel names to (part index, ExrChannel). """
+        channels = {}
+        for part_index, part in enumerate(self.parts):
+            for channel in part.channels:
+                channels.setdefault(channel.nuke_name, (part_index, channel))
+        return channels
+
+
+def _read_attributes(data, pos):
+    """ Reads the attributes of one header from pos. Returns the attributes,
+    the raw (type, bytes) of each, and the position after the header's
+    terminating null byte.
+    """
+    attributes = {}
+    raw_attributes = {}
+    while data[pos:pos + 1] != b"\0":
+        name_end = data.find(b"\0", pos)
+        type_end = data.find(b"\0", name_end + 1)
+        if name_end < 0 or type_end < 0 or type_end + 5 > len(data):
+            raise IOError("Cryptomatte: Truncated EXR header.")
+        name = _decode_string(data[pos:name_end])
+        attr_type = _decode_string(data[name_end + 1:type_end])
+        size, = struct.unpack("<i", data[type_end + 1:type_end + 5])
+        value_start = type_end + 5
+        if size < 0 or value_start + size > len(data):
+            raise IOError("Cryptomatte: Truncated EXR header.")
+        value = data[value_start:value_start + size]
+        parser = EXR_ATTRIBUTE_PARSERS.get(attr_type)
+        attributes[name] = parser(value) if parser else value
+        raw_attributes[name] = (attr_type, value)
+        pos = value_start + size
+    return attributes, raw_attributes, pos + 1
+
+
+def _parse_header(path, data):
+    if len(data) < 8:
+        raise IOError("Cryptomatte: Not an OpenEXR file: %s" % path)
+    magic, version = struct.unpack("<ii", data[:8])
+    if magic != EXR_MAGIC:
+        raise IOError("Cryptomatte: Not an OpenEXR file: %s" % path)
+
+    pos = 8
+    parts = []
+    if version & EXR_FLAG_MULTIPART:
+        while data[pos:pos + 1] != b"\0":
+            attributes, raw_attributes, pos = _read_attributes(data, pos)
+            parts.append(ExrPart(attributes, raw_attributes=raw_attributes))
+        pos += 1
+    else:
+        attributes, raw_attributes, pos = _read_attributes(data, pos)
+        parts.append(ExrPart(attributes, bool(version & EXR_FLAG_TILED), raw_attributes))
+
+    # Offset tables follow the headers, one per part.
+    for part in parts:
+        part.offset_table_position = pos
+        if part is not parts[-1]:
+            pos += 8 * part.chunk_count
+    return ExrHeader(path, version, parts)
+
+
+def read_exr_header(path):
+    """ Reads the header(s) of an OpenEXR file, without reading any pixel data.
+    Raises IOError if the file is not an OpenEXR file.
+    """
+    with open(path, "rb") as exr_file:
+        try:
+            data = mmap.mmap(exr_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error):
+            data = exr_file.read()  # empty files or no mmap support
+        try:
+            return _parse_header(path, data)
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+
+#############################################
+# Scanline decoding
+#############################################
+
+
+def get_decode_threads(threads=None):
+    """ Resolves the number of decode threads, see DECODE_THREADS. """
+    import multiprocessing
+    threads = threads or DECODE_THREADS
+    if not threads:
+        threads = min(multiprocessing.cpu_count(), 16)
+    return threads if ThreadPoolExecutor else 1
+
+
+def _rle_decompress(data):
+    out = bytearray()
+    pos = 0
+    size = len(data)
+    while pos < size:
+        count = struct.unpack("b", data[pos:pos + 1])[0]
+        pos += 1
+        if count < 0:
+            out += data[pos:pos - count]
+            pos -= count
+        else:
+            out += data[pos:pos + 1] * (count + 1)
+            pos += 1
+    return bytes(out)
+
+
+def _reconstruct_bytes(data, out=None, scratch=None):
+    """ Undoes the predictor and byte interleaving applied before ZIP and RLE
+    compression. Returns a numpy uint8 array, the start of out if given.
+    scratch is an optional uint8 array to use for the intermediate bytes.
+    """
+    size = len(data)
+    if scratch is None:
+        predicted = np.frombuffer(data, dtype=np.uint8).copy()
+    else:
+        predicted = scratch[:size]
+        predicted[:] = np.frombuffer(data, dtype=np.uint8)
+    predicted[1:] -= 128
+    np.cumsum(predicted, dtype=np.uint8, out=predicted)
+    half = (size + 1) // 2
+    out = np.empty_like(predicted) if out is None else out[:size]
+    out[0::2] = predicted[:half]
+    out[1::2] = predicted[half:]
+    return out
+
+
+class BufferPool(object):
+    """ numpy buffers reused from frame to frame: the frame and band sized
+    arrays of decoded planes, rank and matte bands, and the decompression
+    scratch. Buffers are only reallocated when their shape changes, such as
+    with a different data window or number of ranks.
+
+    Smaller temporaries are still allocated for each chunk or band: zlib's
+    output, the extraction masks, and the writer's interleaved and
+    compressed scanlines. So after the first frame, allocation depends on
+    the chunk and band size, not the frame size.
+
+    allocations and reuses count the buffers handed out by the pool.
+    """
+
+    def __init__(self):
+        self._buffers = {}
+        self._scratch = {}
+        self._lock = threading.Lock()
+        self.allocations = 0
+        self.reuses = 0
+
+    def get(self, name, shape, dtype=None):
+        """ Returns the buffer called name with the shape and dtype (default
+        float32). Contents are left over from the last use.
+        """
+        dtype = np.dtype(dtype or np.float32)
+        shape = tuple(shape)
+        with self._lock:
+            buffer = self._buffers.get(name)
+            if buffer is not None and buffer.shape == shape and buffer.dtype == dtype:
+                self.reuses += 1
+                return buffer
+            self.allocations += 1
+            buffer = self._buffers[name] = np.empty(shape, dtype=dtype)
+            return buffer
+
+    def acquire(self, size):
+        """ Takes a uint8 scratch array of size bytes, for one thread's use
+        until it is given back with release().
+        """
+        with self._lock:
+            free = self._scratch.setdefault(size, [])
+            if free:
+                self.reuses += 1
+                return free.pop()
+            self.allocations += 1
+        return np.empty(size, dtype=np.uint8)
+
+    def release(self, buffer):
+        with self._lock:
+            self._scratch.setdefault(len(buffer), []).append(buffer)
+
+    def stats(self):
+        return {"allocations": self.allocations, "reuses": self.reuses}
+
+
+class ExrScanlineReader(object):
+    """ Decodes selected channels of a scanline OpenEXR file with numpy, for
+    NONE, RLE, ZIPS and ZIP compression.
+
+    Only the requested channels are converted and stored. Compressed chunks
+    still have to be inflated whole, since all channels of a scanline are
+    compressed together.
+
+    Chunks are independent, and are decompressed on a pool of threads (zlib
+    and numpy release the GIL), each writing into its own rows of the planes.
+    threads defaults to DECODE_THREADS, 1 decodes on the calling thread.
+
+    chunks_read and bytes_read count the pixel data read so far. buffers is
+    an optional BufferPool for the decompression scratch arrays.
+    """
+
+    def __init__(self, path, header=None, threads=None, buffers=None):
+        if np is None:
+            raise ImportError("Cryptomatte: numpy is required to decode EXR pixels.")
+        self.header = header or read_exr_header(path)
+        self.path = self.header.path
+        self.channels = self.header.channels()
+        self.threads = get_decode_threads(threads)
+        self.buffers = buffers
+        self.chunks_read = 0
+        self.bytes_read = 0
+        self._executor = None
+        self._file = open(self.path, "rb")
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        if self._executor:
+            self._executor.shutdown()
+            self._executor = None
+        self._data.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def data_window(self):
+        return self.header.parts[0].data_window
+
+    @property
+    def shape(self):
+        """ (height, width) of the data window. """
+        part = self.header.parts[0]
+        return (part.height, part.width)
+
+    def allocate(self, count, dtype=None, window=None):
+        """ Returns an uninitialized array of count planes, to read channels
+        into, covering the data window or the given window.
+        """
+        shape = self.shape
+        if window:
+            shape = (window[3] - window[1] + 1, window[2] - window[0] + 1)
+        return np.empty((count,) + shape, dtype=dtype or np.float32)
+
+    def read(self, channel_names, planes=None, window=None):
+        """ Reads channels (Nuke style names, see ExrHeader.channels()) into
+        planes, one (height, width) array per channel, such as an array from
+        allocate(). Returns the planes.
+
+        window (xmin, ymin, xmax, ymax), inclusive and in the same pixel
+        coordinates as the data window, limits the read to the chunks that
+        overlap it. Planes then cover the window, with zeros outside the data
+        window.
+        """
+        window = window or self.data_window
+        if planes is None:
+            planes = self.allocate(len(channel_names), window=window)
+        if len(planes) != len(channel_names):
+            raise ValueError("Cryptomatte: %s channels and %s planes." % (
+                len(channel_names), len(planes)))
+        shape = (window[3] - window[1] + 1, window[2] - window[0] + 1)
+        if shape[0] < 1 or shape[1] < 1:
+            raise ValueError("Cryptomatte: Empty window %s." % (window,))
+
+        data_window = self.data_window
+        region = (max(window[0], data_window[0]), max(window[1], data_window[1]),
+                  min(window[2], data_window[2]), min(window[3], data_window[3]))
+        padded = region != tuple(window)
+        empty = region[0] > region[2] or region[1] > region[3]
+
+        requests = {}
+        for channel_name, plane in zip(channel_names, planes):
+            if channel_name not in self.channels:
+                raise ValueError("Cryptomatte: No channel %s in %s." % (channel_name, self.path))
+            if plane.shape != shape:
+                raise ValueError("Cryptomatte: Plane shape %s does not match %s." % (
+                    plane.shape, shape))
+            if padded:
+                plane[...] = 0.0
+            if empty:
+                continue
+            # The part of the plane inside the data window
+            destination = plane[region[1] - window[1]:region[3] - window[1] + 1,
+                                region[0] - window[0]:region[2] - window[0] + 1]
+            part_index, channel = self.channels[channel_name]
+            requests.setdefault(part_index, []).append((channel, destination))
+
+        for part_index, part_requests in requests.items():
+            self._read_part(part_index, part_requests, region)
+        return planes
+
+    def _check_part(self, part):
+        if part.tiled or part.deep:
+            raise ValueError("Cryptomatte: Only scanline EXR files can be decoded: %s" % self.path)
+        if part.compression not in EXR_DECODABLE_COMPRESSIONS:
+            raise ValueError("Cryptomatte: %s compression can not be decoded: %s" % (
+                part.compression, self.path))
+        if part.data_window != self.data_window:
+            raise ValueError("Cryptomatte: Parts with different data windows: %s" % self.path)
+
+    def _channel_layout(self, part, part_requests, region):
+        """ Returns the bytes per scanline, and a list of (byte range in a
+        scanline, dtype, plane) for the requested channels within the region.
+        """
+        offsets = {}
+        line_bytes = 0
+        for channel in part.channels:
+            if channel.x_sampling != 1 or channel.y_sampling != 1:
+                raise ValueError("Cryptomatte: Subsampled channels are not supported.")
+            offsets[channel.name] = line_bytes
+            line_bytes += channel.size * part.width
+        first_column = region[0] - part.data_window[0]
+        columns = region[2] - region[0] + 1
+        layout = []
+        for channel, plane in part_requests:
+            start = offsets[channel.name] + first_column * channel.size
+            layout.append((slice(start, start + columns * channel.size),
+                           EXR_PIXEL_TYPE_DTYPES[channel.pixel_type], plane))
+        return line_bytes, layout
+
+    def _offset_table(self, part):
+        position = part.offset_table_position
+        return np.frombuffer(self._data, dtype="<u8", count=part.chunk_count, offset=position)
+
+    def _read_part(self, part_index, part_requests, region):
+        part = self.header.parts[part_index]
+        self._check_part(part)
+        line_bytes, layout = self._channel_layout(part, part_requests, region)
+
+        # Scanline offset tables are in increasing y order, whatever the line order.
+        lines = (region[1] - part.data_window[1], region[3] - part.data_window[1])
+        first_chunk = lines[0] // part.lines_per_chunk
+        last_chunk = lines[1] // part.lines_per_chunk
+        offsets = [int(offset) for offset in
+                   self._offset_table(part)[first_chunk:last_chunk + 1]]
+        if self.threads == 1 or len(offsets) == 1:
+            self.bytes_read += self._read_chunks(part, offsets, line_bytes, layout, lines)
+            self.chunks_read += len(offsets)
+            return
+
+        # A few tasks per thread, so single-scanline chunks are not one task each.
+        if not self._executor:
+            self._executor = ThreadPoolExecutor(self.threads)
+        step = max(1, len(offsets) // (self.threads * 4))
+        futures = [
+            self._executor.submit(
+                self._read_chunks, part, offsets[i:i + step], line_bytes, layout, lines)
+            for i in range(0, len(offsets), step)
+        ]
+        for future in futures:
+            self.bytes_read += future.result()  # raises errors from the chunks
+        self.chunks_read += len(offsets)
+
+    def _read_chunks(self, part, offsets, line_bytes, layout, lines):
+        """ Returns the number of bytes read. """
+        bytes_read = 0
+        for offset in offsets:
+            bytes_read += self._read_chunk(part, offset, line_bytes, layout, lines)
+        return bytes_read
+
+    def _read_chunk(self, part, offset, line_bytes, layout, lines):
+        """ Decodes the chunk at offset, copying its scanlines within lines
+        (first, last, relative to the data window) into the planes. Returns
+        the number of bytes read.
+        """
+        if self.header.multipart:
+            offset += 4  # part number
+        y, size = struct.unpack("<ii", self._data[offset:offset + 8])
+        first_line = y - part.data_window[1]
+        num_lines = min(part.lines_per_chunk, part.height - first_line)
+        raw_size = num_lines * line_bytes
+        start = offset + 8
+
+        scratch = []
+        if part.compression == "NONE" or size == raw_size:
+            # Chunks that would not get smaller are stored uncompressed.
+            chunk = np.frombuffer(self._data, dtype=np.uint8, count=raw_size, offset=start)
+        else:
+            if part.compression == "RLE":
+                data = _rle_decompress(self._data[start:start + size])
+            else:
+                data = zlib.decompress(self._data[start:start + size])
+            if len(data) != raw_size:
+                raise IOError("Cryptomatte: Corrupt EXR chunk at scanline %s: %s" % (y, self.path))
+            if self.buffers:
+                # Sized for whole chunks, so the last, shorter chunk reuses them too.
+                chunk_size = part.lines_per_chunk * line_bytes
+                scratch = [self.buffers.acquire(chunk_size), self.buffers.acquire(chunk_size)]
+                chunk = _reconstruct_bytes(data, *scratch)
+            else:
+                chunk = _reconstruct_bytes(data)
+
+        chunk = chunk.reshape(num_lines, line_bytes)
+        copy_start = max(first_line, lines[0])
+        copy_end = min(first_line + num_lines, lines[1] + 1)
+        chunk = chunk[copy_start - first_line:copy_end - first_line]
+        for byte_range, dtype, plane in layout:
+            plane[copy_start - lines[0]:copy_end - lines[0]] = chunk[:, byte_range].view(dtype)
+        for buffer in scratch:
+            self.buffers.release(buffer)
+        return size + 8
+
+
+#############################################
+# Scanline writing
+#############################################
+
+
+def _rle_compress(data):
+    """ OpenEXR run length encoding: runs of three or more equal bytes become
+    (count - 1, byte), everything else (-count, bytes...).
+    """
+    out = bytearray()
+    data = bytearray(data)
+    size = len(data)
+    run_start = 0
+    while run_start < size:
+        run_end = run_start + 1
+        while run_end < size and data[run_end] == data[run_start] and run_end - run_start < 128:
+            run_end += 1
+        if run_end - run_start >= 3:
+            out += struct.pack("bB", run_end - run_start - 1, data[run_start])
+            run_start = run_end
+            continue
+        # Literal run, until the next run of three equal bytes.
+        while run_end < size and run_end - run_start < 127:
+            if (run_end + 2 < size and data[run_end] == data[run_end + 1] and
+                    data[run_end] == data[run_end + 2]):
+                break
+            run_end += 1
+        out += struct.pack("b", run_start - run_end) + data[run_start:run_end]
+        run_start = run_end
+    return bytes(out)
+
+
+def _split_and_predict(data):
+    """ Inverse of _reconstruct_bytes. """
+    data = np.frombuffer(data, dtype=np.uint8)
+    interleaved = np.concatenate([data[0::2], data[1::2]])
+    predicted = interleaved.copy()
+    predicted[1:] = interleaved[1:] - interleaved[:-1] + 128
+    return predicted.tobytes()
+
+
+def _pack_attribute(name, attr_type, value):
+    name = name.encode("utf-8") if not isinstance(name, bytes) else name
+    attr_type = attr_type.encode("utf-8")
+    return name + b"\0" + attr_type + b"\0" + struct.pack("<i", len(value)) + value
+
+
+def _pack_string(value):
+    return value.encode("utf-8") if not isinstance(value, bytes) else value
+
+
+def _exr_array(array, dtype=None):
+    """ float16 and uint32 arrays keep their type, others become float32. """
+    array = np.asarray(array)
+    if dtype is None:
+        dtype = array.dtype if array.dtype in (np.float16, np.uint32) else np.float32
+    return array.astype(np.dtype(dtype).newbyteorder("<"), copy=False)
+
+
+class ExrScanlineWriter(object):
+    """ Writes a single-part scanline OpenEXR file, a band of scanlines at a
+    time, so whole frames never need to be in memory.
+
+    Args:
+        channel_types is a dict of EXR channel names to numpy dtypes: float16,
+        uint32, or float32 for anything else.
+        compression is one of NONE, RLE, ZIPS and ZIP.
+        attributes is an optional dict of string attributes, such as the
+        cryptomatte/<id>/... metadata, or of (type, bytes) pairs of other
+        types, such as from ExrPart.metadata_attributes().
+        data_window is (xmin, ymin) of the data, default (0, 0).
+        display_window is (xmin, ymin, xmax, ymax), by default the data
+        window. It and the pixel aspect ratio and screen window are usually
+        those of a source file, from ExrPart.display_attributes().
+    """
+
+    def __init__(self, path, channel_types, width, height, compression="ZIP",
+                 attributes=None, data_window=None, display_window=None, pixel_aspect_ratio=1.0,
+                 screen_window_center=(0.0, 0.0), screen_window_width=1.0):
+        if compression not in EXR_DECODABLE_COMPRESSIONS:
+            raise ValueError("Cryptomatte: Can not write %s compression." % compression)
+        self.path = path
+        self.names = sorted(channel_types)
+        self.dtypes = [_exr_array(np.zeros(0, channel_types[name])).dtype for name in self.names]
+        self.width = width
+        self.height = height
+        self.compression = compression
+        self.lines_per_chunk = EXR_LINES_PER_CHUNK[compression]
+        self.lines_written = 0
+        self.data_window = data_window or (0, 0)
+        self.display_window = display_window or (
+            self.data_window[0], self.data_window[1],
+            self.data_window[0] + width - 1, self.data_window[1] + height - 1)
+        self.pixel_aspect_ratio = pixel_aspect_ratio
+        self.screen_window_center = screen_window_center
+        self.screen_window_width = screen_window_width
+        self._offsets = []
+        self._file = open(path, "wb")
+        self._file.write(self._header(attributes or {}))
+        self._table_position = self._file.tell()
+        chunk_count = (height + self.lines_per_chunk - 1) // self.lines_per_chunk
+        self._file.write(b"\0" * 8 * chunk_count)
+
+    def _header(self, attributes):
+        xmin, ymin = self.data_window
+        window = struct.pack("<iiii", xmin, ymin, xmin + self.width - 1, ymin + self.height - 1)
+
+        chlist = b""
+        for name, dtype in zip(self.names, self.dtypes):
+            pixel_type = EXR_PIXEL_TYPE_DTYPES.index(dtype.str)
+            chlist += _pack_string(name) + b"\0" + struct.pack("<iiii", pixel_type, 0, 1, 1)
+        chlist += b"\0"
+
+        compression = EXR_COMPRESSION_NAMES.index(self.compression)
+        header_attributes = [
+            ("channels", "chlist", chlist),
+            ("compression", "compression", struct.pack("B", compression)),
+            ("dataWindow", "box2i", window),
+            ("displayWindow", "box2i", struct.pack("<iiii", *self.display_window)),
+            ("lineOrder", "lineOrder", struct.pack("B", 0)),
+            ("pixelAspectRatio", "float", struct.pack("<f", self.pixel_aspect_ratio)),
+            ("screenWindowCenter", "v2f", struct.pack("<ff", *self.screen_window_center)),
+            ("screenWindowWidth", "float", struct.pack("<f", self.screen_window_width)),
+        ]
+        for name, value in sorted(attributes.items()):
+            if isinstance(value, tuple):
+                header_attributes.append((name,) + value)
+            else:
+                header_attributes.append((name, "string", _pack_string(value)))
+        names = [name for name, _, _ in header_attributes] + self.names
+        long_names = any(len(_pack_string(name)) > 31 for name in names)
+
+        header = struct.pack("<ii", EXR_MAGIC, 2 | (EXR_FLAG_LONG_NAMES if long_names else 0))
+        return header + b"".join(_pack_attribute(*attr) for attr in sorted(header_attributes)) + b"\0"
+
+    def write(self, channels):
+        """ Writes the next scanlines, from a dict of channel names to (lines,
+        width) arrays. All but the last band must be a multiple of
+        lines_per_chunk scanlines.
+        """
+        if self.lines_written % self.lines_per_chunk:
+            raise ValueError("Cryptomatte: Only the last band may end mid chunk.")
+        arrays = [_exr_array(channels[name], dtype) for name, dtype in zip(self.names, self.dtypes)]
+        lines = arrays[0].shape[0]
+        if self.lines_written + lines > self.height:
+            raise ValueError("Cryptomatte: More than %s scanlines written." % self.height)
+
+        # Channels are interleaved per scanline.
+        scanlines = np.concatenate(
+            [np.ascontiguousarray(array).view(np.uint8).reshape(lines, -1) for array in arrays],
+            axis=1)
+        for first_line in range(0, lines, self.lines_per_chunk):
+            raw = scanlines[first_line:first_line + self.lines_per_chunk].tobytes()
+            if self.compression == "RLE":
+                data = _rle_compress(_split_and_predict(raw))
+            elif self.compression in ["ZIPS", "ZIP"]:
+                data = zlib.compress(_split_and_predict(raw))
+            else:
+                data = raw
+            if len(data) >= len(raw):
+                data = raw
+            y = self.data_window[1] + self.lines_written + first_line
+            self._offsets.append(self._file.tell())
+            self._file.write(struct.pack("<ii", y, len(data)))
+            self._file.write(data)
+        self.lines_written += lines
+
+    def close(self):
+        """ Writes the offset table and closes the file. """
+        if self._file.closed:
+            return
+        try:
+            if self.lines_written != self.height:
+                raise ValueError("Cryptomatte: %s of %s scanlines written to %s." % (
+                    self.lines_written, self.height, self.path))
+            self._file.seek(self._table_position)
+            self._file.write(struct.pack("<%dQ" % len(self._offsets), *self._offsets))
+        finally:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self._file.close()
+        else:
+            self.close()
+
+
+def write_exr(path, channels, compression="ZIP", attributes=None, data_window=None):
+    """ Writes a single-part scanline OpenEXR file.
+
+    Args:
+        channels is a dict of EXR channel names to (height, width) numpy
+        arrays. float16 and uint32 arrays keep their type, others are written
+        as float32.
+        See ExrScanlineWriter for the other arguments.
+    """
+    channels = dict((name, _exr_array(array)) for name, array in channels.items())
+    height, width = next(iter(channels.values())).shape
+    channel_types = dict((name, array.dtype) for name, array in channels.items())
+    with ExrScanlineWriter(path, channel_types, width, height, compression, attributes,
+                           data_window) as writer:
+        writer.write(channels)
+
+
+def cryptomatte_attributes(name, manifest):
+    """ Returns the metadata of a cryptomatte layer called name, with a
+    manifest of names to hex IDs. """
+    import json
+
+    prefix = cu.CRYPTO_METADATA_DEFAULT_PREFIX + cu.layer_hash(name) + "/"
+    return {
+        prefix + "name": name,
+        prefix + "hash": "MurmurHash3_32",
+        prefix + "conversion": "uint32_to_float32",
+        prefix + "manifest": json.dumps(manifest, sort_keys=True),
+    }
+
+
+def cryptomatte_channels(name, rank_ids, rank_coverage):
+    """ Returns a dict of the EXR channels of a cryptomatte layer called
+    name to rank planes. An odd number of ranks is padded with an empty rank.
+    """
+    channels = {}
+    empty = np.zeros(rank_ids.shape[1:], dtype=np.float32)
+    for layer in range((len(rank_ids) + 1) // 2):
+        layer_name = "%s%02d." % (name, layer)
+        channels[layer_name + "R"] = rank_ids[layer * 2]
+        channels[layer_name + "G"] = rank_coverage[layer * 2]
+        has_odd = layer * 2 + 1 < len(rank_ids)
+        channels[layer_name + "B"] = rank_ids[layer * 2 + 1] if has_odd else empty
+        channels[layer_name + "A"] = rank_coverage[layer * 2 + 1] if has_odd else empty
+    return channels
+
+
+def write_cryptomatte(path, rank_ids, rank_coverage, name, manifest, compression="ZIP",
+                      data_window=None, channels=None, attributes=None):
+    """ Writes ranks as a cryptomatte layer called name, with a manifest of
+    names to hex IDs, such as from cryptomatte_encoding.insert_matte(). An
+    odd number of ranks is padded with an empty rank. channels and
+    attributes are optional other channels and string attributes to write.
+    """
+    attributes = dict(attributes or {})
+    attributes.update(cryptomatte_attributes(name, manifest))
+    channels = dict(channels or {})
+    channels.update(cryptomatte_channels(name, rank_ids, rank_coverage))
+    write_exr(path, channels, compression, attributes, data_window)
+
+
+#############################################
+# Headless cryptomatte info
+#############################################
+
+
+class ExrCryptomatteInfo(cu.CryptomatteInfo):
+    """ Equivalent of CryptomatteInfo for an EXR file, without Nuke. The
+    cryptomattes, channels and selection work the same way, with channel names
+    as Nuke would show them (see ExrChannel.nuke_name).
+    """
+
+    def __init__(self, path, header=None):
+        self.cryptomattes = {}
+        self.nuke_node = None
+        self.selection = None
+        self.filename = None
+        self.header = header or read_exr_header(path)
+        self.exr_channels = self.header.channels()
+        self.selection = self._load_cryptomattes(self.header.metadata())
+
+    def _get_channel_list(self):
+        return list(self.exr_channels.keys())
+
+    def lazy_load_manifest(self):
+        if 'manifest' not in self.cryptomattes[self.selection]:
+            return {}
+        return super(ExrCryptomatteInfo, self).lazy_load_manifest()
+
+    def get_rank_channels(self):
+        """ Returns the (ID channel, coverage channel) pairs of the selected
+        cryptomatte, in rank order: red/green then blue/alpha of each layer.
+        """
+        rank_channels = []
+        for layer in self.get_channels() or []:
+            rank_channels.append((layer + ".red", layer + ".green"))
+            rank_channels.append((layer + ".blue", layer + ".alpha"))
+        return rank_channels
+
+    def read_ranks(self, out=None, threads=None, window=None, buffers=None):
+        """ Decodes the selected cryptomatte's channels, and only those.
+
+        Returns (rank_ids, rank_coverage), float32 arrays of shape (ranks,
+        height, width) over the data window. They are views of one array of
+        shape (2, ranks, height, width), which can be passed in as out and
+        reused between frames, or taken from a BufferPool given as buffers.
+        threads and window (see ExrScanlineReader.read) are passed to the
+        reader, with a window the arrays cover the window.
+        """
+        rank_channels = self.get_rank_channels()
+        with ExrScanlineReader(self.header.path, self.header, threads, buffers) as reader:
+            if out is None:
+                xmin, ymin, xmax, ymax = window or reader.data_window
+                shape = (2, len(rank_channels), ymax - ymin + 1, xmax - xmin + 1)
+                if buffers:
+                    out = buffers.get("ranks", shape)
+                else:
+                    out = np.empty(shape, dtype=np.float32)
+            self._read_rank_planes(reader, out, window)
+        return out[0], out[1]
+
+    def _read_rank_planes(self, reader, out, window):
+        channel_names, planes = [], []
+        for rank, (id_channel, coverage_channel) in enumerate(self.get_rank_channels()):
+            channel_names += [id_channel, coverage_channel]
+            planes += [out[0, rank], out[1, rank]]
+        reader.read(channel_names, planes, window)
+
+    def iter_rank_bands(self, band_height=64, threads=None, buffers=None):
+        """ Yields (first scanline, rank_ids, rank_coverage) for horizontal
+        bands of the data window, top to bottom, like read_ranks() but only
+        ever holding one band. The arrays are reused: each band overwrites
+        the previous one, and with a BufferPool as buffers, the next frame.
+
+        band_height is rounded up to whole chunks of the file.
+        """
+        part = self.header.parts[0]
+        band_height = -(-max(band_height, 1) // part.lines_per_chunk) * part.lines_per_chunk
+        xmin, ymin, xmax, ymax = part.data_window
+        shape = (2, len(self.get_rank_channels()), band_height, xmax - xmin + 1)
+        with ExrScanlineReader(self.header.path, self.header, threads, buffers) as reader:
+            if buffers:
+                rank_bands = buffers.get("rank_bands", shape)
+            else:
+                rank_bands = np.empty(shape, dtype=np.float32)
+            for first_line in range(ymin, ymax + 1, band_height):
+                lines = min(band_height, ymax + 1 - first_line)
+                band = rank_bands[:, :, :lines]
+                self._read_rank_planes(reader, band, (xmin, first_line, xmax, first_line + lines - 1))
+                yield first_line, band[0], band[1]
+
+    def pick(self, x, y):
+        """ Returns the [(ID, coverage)] of the ranks at one pixel, in rank
+        order, leaving out ranks without coverage. Only the chunk holding the
+        pixel is decoded.
+        """
+        rank_ids, rank_coverage = self.read_ranks(threads=1, window=(x, y, x, y))
+        return [(float(ID), float(coverage))
+                for ID, coverage in zip(rank_ids[:, 0, 0], rank_coverage[:, 0, 0])
+                if coverage > 0.0]
+
+
+def scan_cryptomattes(paths):
+    """ Yields (path, ExrCryptomatteInfo) for the paths, skipping any that
+    are not readable OpenEXR files.
+    """
+    for path in paths:
+        try:
+            yield path, ExrCryptomatteInfo(path)
+        except IOError as e:
+            print("Cryptomatte: Unable to read %s (%s)." % (path, e))
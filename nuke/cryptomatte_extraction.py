@@ -0,0 +1,637 @@
+#
+#
+#  Copyright (c) 2014, 2015, 2016, 2017 Psyop Media Company, LLC
+#  See license.txt
+#
+#
+
+import os
+
+import numpy as np
+
+# ID sets up to this size are matched with comparisons. Larger ones are
+# matched with a lookup table of the keys' low bits, then a binary search of
+# the sorted keys for the few candidates the table lets through.
+SMALL_ID_SET = 6
+KEY_TABLE_BITS = 16
+KEY_TABLE_MASK = (1 << KEY_TABLE_BITS) - 1
+
+
+#############################################
+# ID matching
+#############################################
+
+
+def id_keys(ids):
+    """ Returns the sorted, unique uint32 keys of float IDs, such as
+    MatteList.IDs. Matching keys rather than floats is exact, like the ==
+    tests of the gizmo's expression (IDs are never zero or NaN).
+    """
+    return np.unique(np.asarray(list(ids), dtype=np.float32).view(np.uint32))
+
+
+def _as_keys(ids):
+    if isinstance(ids, np.ndarray) and ids.dtype == np.uint32:
+        return ids
+    return id_keys(ids)
+
+
+def match_ids(id_array, keys):
+    """ Returns a bool array, True where the float32 id_array has one of the
+    keys (see id_keys).
+    """
+    values = id_array.view(np.uint32)
+    if len(keys) <= SMALL_ID_SET:
+        mask = values == keys[0] if len(keys) else np.zeros(values.shape, dtype=bool)
+        for key in keys[1:]:
+            mask |= values == key
+        return mask
+    table = _key_table(keys)
+    mask = table[values & KEY_TABLE_MASK]
+    candidates = np.flatnonzero(mask)
+    candidate_values = values.ravel()[candidates]
+    positions = np.searchsorted(keys, candidate_values)
+    positions[positions == len(keys)] = 0
+    mask.ravel()[candidates] = keys[positions] == candidate_values
+    return mask
+
+
+def _key_table(keys):
+    table = np.zeros(1 << KEY_TABLE_BITS, dtype=bool)
+    table[keys & KEY_TABLE_MASK] = True
+    return table
+
+
+def find_keys(id_array, keys, table=None):
+    """ Returns (pixels, positions): the flat indices of the pixels of the
+    float32 id_array with one of the keys, and the index in keys of each.
+    table is an optional precomputed _key_table(keys).
+    """
+    values = id_array.view(np.uint32).ravel()
+    if table is None:
+        table = _key_table(keys)
+    pixels = np.flatnonzero(table[values & KEY_TABLE_MASK])
+    candidate_values = values[pixels]
+    positions = np.searchsorted(keys, candidate_values)
+    positions[positions == len(keys)] = 0
+    found = keys[positions] == candidate_values
+    return pixels[found], positions[found]
+
+
+#############################################
+# Extraction
+#############################################
+
+
+def _active_ranks(rank_id_arrays, rank_cov_arrays, early_exit=False, tolerance=None):
+    """ Yields (pixels, ids, coverage) per rank: the flat indices of the pixels
+    to evaluate and their IDs and coverage, or None and the whole rank for
+    all pixels.
+
+    With early_exit, a pixel with no coverage in a rank is left out of the
+    later ranks too, and the set shrinks with each rank. That is only exact
+    when each pixel's ranks are sorted by decreasing, non-negative coverage,
+    as renderers write them. Unsorted ranks, or negative coverage such as
+    from inserting alpha above 1, have later entries the gizmo's expression
+    still sums. With a tolerance, pixels whose earlier ranks add up to
+    1 - tolerance are left out as well (not exact).
+    """
+    pixels = None
+    total = None
+    for rank, (rank_ids, rank_coverage) in enumerate(zip(rank_id_arrays, rank_cov_arrays)):
+        if rank == 0 or not (early_exit or tolerance is not None):
+            yield None, rank_ids.ravel(), rank_coverage.ravel()
+            continue
+
+        all_coverage = rank_coverage.ravel()
+        if pixels is None:
+            pixels = np.flatnonzero(all_coverage) if early_exit else np.arange(all_coverage.size)
+            if tolerance is not None:
+                total = rank_cov_arrays[0].ravel()[pixels]
+        elif early_exit:
+            active = all_coverage[pixels] != 0.0
+            pixels = pixels[active]
+            total = total[active] if total is not None else None
+        if total is not None:
+            active = total < 1.0 - tolerance
+            pixels, total = pixels[active], total[active]
+        if not len(pixels):
+            return
+
+        coverage = all_coverage[pixels]
+        yield pixels, rank_ids.ravel()[pixels], coverage
+        if total is not None:
+            total = total + coverage
+
+
+def extract_matte(rank_id_arrays, rank_cov_arrays, ids, out=None, early_exit=False,
+                  tolerance=None):
+    """ Evaluates a matte like the gizmo's extraction expression: the sum, in
+    rank order and in float32, of the coverage of ranks with one of the IDs.
+
+    Args:
+        rank_id_arrays, rank_cov_arrays are sequences of float32 arrays, one
+        per rank, such as from ExrCryptomatteInfo.read_ranks().
+        ids are float IDs, such as MatteList.IDs, or keys from id_keys().
+        out is an optional float32 array to write the matte into.
+        early_exit skips the remaining ranks of pixels without coverage in a
+        rank. It is faster, but only exact for ranks sorted by decreasing,
+        non-negative coverage, see _active_ranks().
+        tolerance also skips pixels with coverage of 1 - tolerance or more,
+        which differs from the gizmo where later ranks have tiny coverage.
+    """
+    keys = _as_keys(ids)
+    if out is None:
+        out = np.zeros(rank_id_arrays[0].shape, dtype=np.float32)
+    else:
+        out[...] = 0.0
+    if not len(keys):
+        return out
+    if len(keys) == 1 and tolerance is None:
+        early_exit = False  # one comparison is cheaper than compacting the pixels.
+    flat_out = out.reshape(-1)
+    for pixels, rank_ids, rank_coverage in _active_ranks(
+            rank_id_arrays, rank_cov_arrays, early_exit, tolerance):
+        mask = match_ids(rank_ids, keys)
+        if pixels is None:
+            np.add(flat_out, rank_coverage, out=flat_out, where=mask)
+        else:
+            flat_out[pixels[mask]] += rank_coverage[mask]
+    return out
+
+
+def extract_mattes(rank_id_arrays, rank_cov_arrays, id_sets, out=None, early_exit=False,
+                   tolerance=None):
+    """ Evaluates several mattes from the same ranks, such as the MatteList.IDs
+    of all the gizmos reading one image. Each matte matches extract_matte().
+
+    The ID sets are merged into one sorted table of keys, each with the list
+    of mattes it belongs to. Each rank is searched once, and its matches are
+    grouped by key, so the remaining work is the writes into the mattes.
+
+    Returns out, or a new (len(id_sets), height, width) float32 array.
+    """
+    shape = rank_id_arrays[0].shape
+    if out is None:
+        out = np.zeros((len(id_sets),) + shape, dtype=np.float32)
+    else:
+        out[...] = 0.0
+    set_keys = [_as_keys(ids) for ids in id_sets]
+    if not any(len(keys) for keys in set_keys):
+        return out
+
+    keys = np.unique(np.concatenate(set_keys))
+    key_mattes = [[] for _ in keys]
+    for matte_index, matte_keys in enumerate(set_keys):
+        for position in np.searchsorted(keys, matte_keys).tolist():
+            key_mattes[position].append(matte_index)
+
+    table = _key_table(keys)
+    flat_out = out.reshape(len(id_sets), -1)
+    for active_pixels, rank_ids, rank_coverage in _active_ranks(
+            rank_id_arrays, rank_cov_arrays, early_exit, tolerance):
+        found, positions = find_keys(rank_ids, keys, table)
+        if not len(found):
+            continue
+        if len(keys) <= 0xFFFF:
+            positions = positions.astype(np.uint16)  # radix sorted
+        order = np.argsort(positions, kind="stable")
+        found = found[order]
+        coverage = rank_coverage[found]
+        pixels = found if active_pixels is None else active_pixels[found]
+        bounds = np.searchsorted(positions[order], np.arange(len(keys) + 1)).tolist()
+        for position, matte_indices in enumerate(key_mattes):
+            first, last = bounds[position], bounds[position + 1]
+            if first == last:
+                continue
+            # Pixels are unique within a rank, so += adds each once.
+            for matte_index in matte_indices:
+                flat_out[matte_index, pixels[first:last]] += coverage[first:last]
+    return out
+
+
+#############################################
+# All mattes
+#############################################
+
+
+class MatteSet(object):
+    """ The mattes of many objects in one frame, stored sparsely. Object i's
+    nonzero pixels are pixels[offsets[i]:offsets[i + 1]], flat indices into a
+    frame of the given shape, with values from the same range of values.
+    """
+
+    def __init__(self, shape, keys, names, offsets, pixels, values):
+        self.shape = shape
+        self.keys = keys
+        self.names = names
+        self.offsets = offsets
+        self.pixels = pixels
+        self.values = values
+
+    def __len__(self):
+        return len(self.keys)
+
+    def index(self, name_or_id):
+        """ Returns the index of an object, by manifest name or float ID. """
+        if name_or_id in self.names:
+            return self.names.index(name_or_id)
+        key = np.float32(name_or_id).view(np.uint32)
+        position = int(np.searchsorted(self.keys, key))
+        if position == len(self.keys) or self.keys[position] != key:
+            raise KeyError(name_or_id)
+        return position
+
+    def pixel_count(self, index):
+        return int(self.offsets[index + 1] - self.offsets[index])
+
+    def _entries(self, index):
+        entries = slice(self.offsets[index], self.offsets[index + 1])
+        return self.pixels[entries], self.values[entries]
+
+    def matte(self, index, out=None):
+        """ Returns object index's matte as a full frame float32 array. """
+        if out is None:
+            out = np.zeros(self.shape, dtype=np.float32)
+        else:
+            out[...] = 0.0
+        pixels, values = self._entries(index)
+        out.ravel()[pixels] = values
+        return out
+
+    def bbox(self, index):
+        """ Returns (xmin, ymin, xmax, ymax) of object index's nonzero pixels,
+        inclusive and in array coordinates, or None if there are none.
+        """
+        pixels, _ = self._entries(index)
+        if not len(pixels):
+            return None
+        rows, columns = np.divmod(pixels, self.shape[1])
+        return (int(columns.min()), int(rows.min()), int(columns.max()), int(rows.max()))
+
+    def cropped(self, index):
+        """ Returns (bbox, matte) with the matte cropped to the bbox. """
+        bbox = self.bbox(index)
+        if bbox is None:
+            return None, np.zeros((0, 0), dtype=np.float32)
+        pixels, values = self._entries(index)
+        rows, columns = np.divmod(pixels, self.shape[1])
+        matte = np.zeros((bbox[3] - bbox[1] + 1, bbox[2] - bbox[0] + 1), dtype=np.float32)
+        matte[rows - bbox[1], columns - bbox[0]] = values
+        return bbox, matte
+
+
+def _manifest_keys(manifest):
+    """ Returns sorted unique keys, and the names of each, from a manifest
+    dict of names to float IDs (see CryptomatteInfo.parse_manifest) or a
+    sequence of IDs.
+    """
+    if isinstance(manifest, dict):
+        names, ids = list(manifest.keys()), list(manifest.values())
+    else:
+        ids = list(manifest)
+        names = ["<{0:.12g}>".format(ID) for ID in ids]
+    keys, inverse = np.unique(
+        np.asarray(ids, dtype=np.float32).view(np.uint32), return_inverse=True)
+    slot_names = [None] * len(keys)
+    for name, slot in sorted(zip(names, inverse.ravel().tolist())):
+        if slot_names[slot] is None:
+            slot_names[slot] = name
+    return keys, slot_names
+
+
+def extract_all_mattes(rank_id_arrays, rank_cov_arrays, manifest):
+    """ Extracts the matte of every object of a manifest in one pass over the
+    ranks. Each matte matches extract_matte() for the object's ID.
+
+    Every rank pixel's ID is mapped to its object with one binary search of
+    the sorted manifest IDs. The rare IDs found in more than one rank of a
+    pixel are summed in rank order, then the coverage is grouped by object
+    with a stable sort.
+
+    Returns a MatteSet.
+    """
+    keys, names = _manifest_keys(manifest)
+    shape = rank_id_arrays[0].shape
+    num_pixels = rank_id_arrays[0].size
+    slot_type = np.uint16 if len(keys) < 0xFFFF else np.uint32
+    no_slot = np.iinfo(slot_type).max
+
+    rank_slots, rank_values = [], []
+    for rank_ids, rank_coverage in zip(rank_id_arrays, rank_cov_arrays):
+        values = rank_ids.view(np.uint32).ravel()
+        positions = np.searchsorted(keys, values)
+        positions[positions == len(keys)] = 0
+        found = (keys[positions] == values) & (rank_coverage.ravel() != 0.0)
+        slots = np.where(found, positions, no_slot).astype(slot_type)
+        coverage = rank_coverage.ravel()
+
+        # Sum into the first rank with the same object, in rank order.
+        for earlier_slots, earlier_values in zip(rank_slots, rank_values):
+            repeated = np.flatnonzero((slots == earlier_slots) & (slots != no_slot))
+            if len(repeated):
+                earlier_values[repeated] += coverage[repeated]
+                slots[repeated] = no_slot
+        rank_slots.append(slots)
+        rank_values.append(coverage.copy())
+
+    pixel_type = np.int32 if num_pixels < 2 ** 31 else np.int64
+    all_slots, all_pixels, all_values = [], [], []
+    for slots, values in zip(rank_slots, rank_values):
+        pixels = np.flatnonzero((slots != no_slot) & (values != 0.0))
+        all_slots.append(slots[pixels])
+        all_values.append(values[pixels])
+        all_pixels.append(pixels.astype(pixel_type))
+    slots = np.concatenate(all_slots)
+    pixels = np.concatenate(all_pixels)
+    values = np.concatenate(all_values)
+
+    order = np.argsort(slots, kind="stable")
+    slots, pixels, values = slots[order], pixels[order], values[order]
+    offsets = np.searchsorted(slots, np.arange(len(keys) + 1))
+    return MatteSet(shape, keys, names, offsets, pixels, values)
+
+
+#############################################
+# Sparse ranks
+#############################################
+
+
+class SparseRanks(object):
+    """ The ranks of a frame without their zero coverage entries, in CSR
+    form: pixel p's (ID, coverage) entries, in rank order, are
+    keys[offsets[p]:offsets[p + 1]] and coverage[offsets[p]:offsets[p + 1]],
+    with uint32 keys (see id_keys) and float32 or float16 coverage.
+
+    For queries, the entries are also indexed by ID: the entries of
+    index_keys[i] are order[index_offsets[i]:index_offsets[i + 1]], at the
+    pixels in the same range of index_pixels. A query then only touches the
+    entries of its IDs.
+    """
+
+    ARRAYS = ["offsets", "keys", "coverage", "order", "index_pixels", "index_keys",
+              "index_offsets"]
+
+    def __init__(self, shape, offsets, keys, coverage, order=None, index_pixels=None,
+                 index_keys=None, index_offsets=None):
+        self.shape = tuple(shape)
+        self.offsets = offsets
+        self.keys = keys
+        self.coverage = coverage
+        if order is None:
+            index_type = np.int32 if len(keys) < 2 ** 31 else np.int64
+            order = np.argsort(keys, kind="stable").astype(index_type)
+            pixel_counts = np.diff(offsets.astype(np.int64))
+            pixels = np.repeat(np.arange(len(pixel_counts), dtype=index_type), pixel_counts)
+            index_pixels = pixels[order]
+            index_keys, counts = np.unique(keys, return_counts=True)
+            index_offsets = np.concatenate([[0], np.cumsum(counts)])
+        self.order = order
+        self.index_pixels = index_pixels
+        self.index_keys = index_keys
+        self.index_offsets = index_offsets
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _entries(self, keys):
+        """ Returns (entries, pixels) of keys, in entry order. """
+        positions = np.searchsorted(self.index_keys, keys)
+        positions[positions == len(self.index_keys)] = 0
+        positions = positions[self.index_keys[positions] == keys] if len(self.index_keys) else []
+        ranges = [slice(self.index_offsets[i], self.index_offsets[i + 1]) for i in positions]
+        if len(ranges) == 1:
+            return self.order[ranges[0]], self.index_pixels[ranges[0]]
+        if not ranges:
+            return np.zeros(0, np.int64), np.zeros(0, np.int64)
+        entries = np.concatenate([self.order[x] for x in ranges])
+        pixels = np.concatenate([self.index_pixels[x] for x in ranges])
+        # Merges the sorted runs of each key.
+        merged = np.argsort(entries, kind="stable")
+        return entries[merged], pixels[merged]
+
+    def extract(self, ids, out=None):
+        """ Returns the matte of ids, like extract_matte() on the dense ranks
+        (bit for bit, with float32 coverage).
+        """
+        if out is None:
+            out = np.zeros(self.shape, dtype=np.float32)
+        else:
+            out[...] = 0.0
+        entries, pixels = self._entries(_as_keys(ids))
+        # Entries are in pixel then rank order, so sums are in rank order.
+        np.add.at(out.ravel(), pixels, self.coverage[entries].astype(np.float32))
+        return out
+
+    def save(self, path):
+        """ Saves the arrays as .npy files in the directory path, which
+        load_sparse_ranks() can memory map.
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        np.save(os.path.join(path, "shape.npy"), np.array(self.shape, dtype=np.int64))
+        for name in self.ARRAYS:
+            np.save(os.path.join(path, name + ".npy"), np.asarray(getattr(self, name)))
+
+
+def load_sparse_ranks(path, mmap_mode="r"):
+    """ Loads SparseRanks saved in the directory path, memory mapped by
+    default, so that queries only read the entries they need.
+    """
+    arrays = [np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+              for name in SparseRanks.ARRAYS]
+    shape = np.load(os.path.join(path, "shape.npy"))
+    return SparseRanks(tuple(int(x) for x in shape), *arrays)
+
+
+def _sparse_band(rank_ids, rank_coverage, dtype):
+    """ Returns the per pixel entry counts, keys and coverage of ranks. """
+    ranks = len(rank_ids)
+    # Transposed views, so boolean indexing is in pixel then rank order.
+    ids = np.asarray(rank_ids).reshape(ranks, -1).T
+    coverage = np.asarray(rank_coverage).reshape(ranks, -1).T
+    nonzero = coverage != 0.0
+    return (nonzero.sum(axis=1, dtype=np.int64), ids.view(np.uint32)[nonzero],
+            coverage[nonzero].astype(dtype))
+
+
+def _sparse_ranks(shape, bands):
+    counts, keys, coverage = [np.concatenate(x) for x in zip(*bands)]
+    offset_type = np.uint32 if len(keys) < 2 ** 32 else np.int64
+    offsets = np.zeros(len(counts) + 1, dtype=offset_type)
+    np.cumsum(counts, out=offsets[1:])
+    return SparseRanks(shape, offsets, keys, coverage)
+
+
+def sparse_ranks(rank_id_arrays, rank_cov_arrays, dtype=np.float32, band_height=64):
+    """ Converts dense ranks to SparseRanks, with coverage of dtype (float32
+    or float16), converting bands of scanlines at a time to bound memory.
+    """
+    rank_id_arrays, rank_cov_arrays = np.asarray(rank_id_arrays), np.asarray(rank_cov_arrays)
+    height = rank_id_arrays[0].shape[0]
+    bands = [_sparse_band(rank_id_arrays[:, y:y + band_height],
+                          rank_cov_arrays[:, y:y + band_height], dtype)
+             for y in range(0, height, band_height)]
+    return _sparse_ranks(rank_id_arrays[0].shape, bands)
+
+
+def read_sparse_ranks(cinfo, dtype=np.float32, band_height=64, threads=None, buffers=None):
+    """ Reads an ExrCryptomatteInfo's selected layer as SparseRanks, in
+    bands, without holding the dense ranks of the whole frame.
+    """
+    part = cinfo.header.parts[0]
+    bands = [_sparse_band(rank_ids, rank_coverage, dtype) for _, rank_ids, rank_coverage
+             in cinfo.iter_rank_bands(band_height, threads, buffers)]
+    return _sparse_ranks((part.height, part.width), bands)
+
+
+#############################################
+# Incremental updates
+#############################################
+
+
+def _touched_pixels(ranks, keys):
+    """ Returns the sorted flat indices of the pixels where keys have
+    coverage, in SparseRanks or (rank_ids, rank_coverage).
+    """
+    if isinstance(ranks, SparseRanks):
+        return np.unique(ranks._entries(keys)[1])
+    rank_ids, rank_coverage = ranks
+    touched = np.zeros(rank_ids[0].size, dtype=bool)
+    for ids, coverage in zip(rank_ids, rank_coverage):
+        touched |= match_ids(ids.ravel(), keys) & (coverage.ravel() != 0.0)
+    return np.flatnonzero(touched)
+
+
+def _extract_pixels(ranks, keys, pixels):
+    """ Returns the matte of keys at the flat indices pixels, summed in rank
+    order like extract_matte().
+    """
+    values = np.zeros(len(pixels), dtype=np.float32)
+    if isinstance(ranks, SparseRanks):
+        starts = ranks.offsets[pixels].astype(np.int64)
+        counts = ranks.offsets[pixels + 1].astype(np.int64) - starts
+        owners = np.repeat(np.arange(len(pixels)), counts)
+        entries = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - starts, counts)
+        matched = match_ids(ranks.keys[entries], keys)
+        np.add.at(values, owners[matched], ranks.coverage[entries[matched]].astype(np.float32))
+        return values
+    for ids, coverage in zip(*ranks):
+        pixel_ids = ids.ravel()[pixels]
+        np.add(values, coverage.ravel()[pixels], out=values, where=match_ids(pixel_ids, keys))
+    return values
+
+
+class IncrementalMatte(object):
+    """ Keeps the last matte extracted for each frame, so that extracting it
+    again for a matte list that gained or lost a few IDs only recomputes the
+    pixels where those IDs are. Mattes are the same as extract_matte()
+    without early exit, bit for bit.
+
+    When the changed IDs cover more than max_fraction of the frame, the
+    matte is extracted in full instead. The last max_frames frames are kept.
+    full_updates and incremental_updates count the two kinds of update.
+    """
+
+    def __init__(self, max_fraction=0.25, max_frames=8):
+        import collections
+        self.max_fraction = max_fraction
+        self.max_frames = max_frames
+        self.full_updates = 0
+        self.incremental_updates = 0
+        self._frames = collections.OrderedDict()
+
+    def matte(self, frame, ranks, ids):
+        """ Returns the matte of ids in frame, any hashable key, from its
+        SparseRanks or (rank_ids, rank_coverage). The matte kept for the next
+        update is private, the caller gets a copy.
+        """
+        keys = _as_keys(ids)
+        last = self._frames.pop(frame, None)
+        if last is not None:
+            last_keys, matte = last
+            changed = np.setxor1d(last_keys, keys, assume_unique=True)
+            if not len(changed):
+                self._frames[frame] = last
+                return matte.copy()
+            pixels = _touched_pixels(ranks, changed)
+            if len(pixels) <= self.max_fraction * matte.size:
+                matte.ravel()[pixels] = _extract_pixels(ranks, keys, pixels)
+                self.incremental_updates += 1
+                self._store(frame, keys, matte)
+                return matte.copy()
+        if isinstance(ranks, SparseRanks):
+            matte = ranks.extract(keys, None if last is None else last[1])
+        else:
+            matte = extract_matte(ranks[0], ranks[1], keys, None if last is None else last[1],
+                                  early_exit=False)
+        self.full_updates += 1
+        self._store(frame, keys, matte)
+        return matte.copy()
+
+    def _store(self, frame, keys, matte):
+        self._frames[frame] = (keys, matte)
+        while len(self._frames) > self.max_frames:
+            self._frames.popitem(last=False)
+
+
+#############################################
+# Streaming
+#############################################
+
+
+def iter_matte_bands(cinfo, ids, band_height=64, threads=None, early_exit=False, buffers=None):
+    """ Yields (first scanline, matte) for horizontal bands of an
+    ExrCryptomatteInfo's data window, reading, decoding and extracting one
+    band at a time. Memory use depends on the band height and the number of
+    ranks, not the frame size. The matte array is reused for every band.
+
+    buffers is an optional cryptomatte_exr.BufferPool, to also reuse the
+    band arrays from frame to frame.
+    """
+    keys = _as_keys(ids)
+    matte = None
+    for first_line, rank_ids, rank_coverage in cinfo.iter_rank_bands(band_height, threads,
+                                                                     buffers):
+        if matte is None and buffers:
+            matte = buffers.get("matte_band", rank_ids.shape[1:])
+        elif matte is None:
+            matte = np.empty(rank_ids.shape[1:], dtype=np.float32)
+        band = matte[:rank_ids.shape[1]]
+        yield first_line, extract_matte(rank_ids, rank_coverage, keys, band, early_exit)
+
+
+def extract_matte_window(cinfo, ids, window, threads=None, buffers=None, early_exit=False):
+    """ Extracts a matte from an ExrCryptomatteInfo's file over a window
+    (xmin, ymin, xmax, ymax), such as cryptomatte_index.ObjectTable.window(),
+    only decoding the chunks that overlap it. Returns the matte of the window.
+    """
+    rank_ids, rank_coverage = cinfo.read_ranks(threads=threads, window=window, buffers=buffers)
+    return extract_matte(rank_ids, rank_coverage, ids, early_exit=early_exit)
+
+
+def write_matte(cinfo, ids, path, band_height=64, compression="ZIP", channel_name="A",
+                threads=None, buffers=None):
+    """ Extracts a matte from an ExrCryptomatteInfo's file and writes it as a
+    float EXR with one channel, over the same data and display windows,
+    band by band.
+    buffers is an optional BufferPool reused between frames. Without IDs,
+    the black matte is written without decoding the file.
+    """
+    import cryptomatte_exr as ce
+
+    part = cinfo.header.parts[0]
+    # Bands of whole chunks for both the reader and the writer (powers of 2).
+    lines_per_chunk = max(ce.EXR_LINES_PER_CHUNK[compression], part.lines_per_chunk)
+    band_height = -(-max(band_height, 1) // lines_per_chunk) * lines_per_chunk
+    writer = ce.ExrScanlineWriter(path, {channel_name: np.float32}, part.width, part.height,
+                                  compression, data_window=part.data_window[:2],
+                                  **part.display_attributes())
+    with writer:
+        if not len(ids):
+            black = np.zeros((band_height, part.width), dtype=np.float32)
+            for first_line in range(0, part.height, band_height):
+                writer.write({channel_name: black[:part.height - first_line]})
+            return
+        for _, matte in iter_matte_bands(cinfo, ids, band_height, threads, buffers=buffers):
+            writer.write({channel_name: matte})
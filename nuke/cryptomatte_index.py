@@ -0,0 +1,388 @@
+#
+#
+#  Copyright (c) 2014, 2015, 2016, 2017 Psyop Media Company, LLC
+#  See license.txt
+#
+#
+
+""" Indexes of what is in the frames of a sequence: the IDs present in each
+frame, saved next to the sequence, so that frames without an object need
+not be decoded, and per frame tables of each object's bounding box and
+area, so that only the window around an object need be.
+"""
+
+import os
+
+import numpy as np
+
+import cryptomatte_utilities as cu
+import cryptomatte_extraction as cx
+
+# Bloom filters of about 1% false positives.
+BLOOM_BITS_PER_ID = 10
+BLOOM_HASHES = 7
+BLOOM_MIN_BITS = 64
+INDEX_VERSION = 1
+
+
+#############################################
+# Bloom filters
+#############################################
+
+
+def _bloom_positions(keys, bits):
+    """ Returns the (BLOOM_HASHES, len(keys)) bit positions of uint32 keys in
+    a filter of bits bits, a power of 2. The keys are already hashes, so a
+    second hash for double hashing is enough.
+    """
+    keys = np.asarray(keys, dtype=np.uint64)
+    step = ((keys * np.uint64(0x9E3779B1)) >> np.uint64(16)) | np.uint64(1)
+    hashes = np.arange(BLOOM_HASHES, dtype=np.uint64)[:, np.newaxis]
+    return (keys + hashes * step) & np.uint64(bits - 1)
+
+
+def _bloom_filter(keys, bits):
+    """ Returns a Bloom filter of uint32 keys, as bits // 8 uint8. """
+    # Bit i is (1 << (i & 7)) of byte i >> 3, as _bloom_rows reads it.
+    positions = _bloom_positions(keys, bits).ravel().astype(np.int64)
+    bloom = np.zeros(bits // 8, dtype=np.uint8)
+    np.bitwise_or.at(bloom, positions >> 3, (1 << (positions & 7)).astype(np.uint8))
+    return bloom
+
+
+#############################################
+# Frame index
+#############################################
+
+
+def _key(name_or_id):
+    """ Returns the uint32 key of a name (as in a matte list) or float ID. """
+    if isinstance(name_or_id, (float, np.floating)):
+        return np.float32(name_or_id).view(np.uint32)
+    matte_list = cu.MatteList("")
+    matte_list.add(name_or_id)
+    return np.float32(matte_list.IDs[0]).view(np.uint32)
+
+
+def _file_stat(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime
+
+
+class FrameIndex(object):
+    """ The sorted uint32 keys (see cryptomatte_extraction.id_keys) of the
+    IDs with coverage in each frame of one cryptomatte layer, with a Bloom
+    filter per frame to rule frames out without searching their keys.
+
+    Frames remember their file's size and modification time, so changed
+    files are not trusted (see is_current()).
+    """
+
+    def __init__(self, layer, frames, paths, stats, offsets, keys, blooms=None):
+        self.layer = layer
+        self.frames = list(frames)
+        self.paths = list(paths)
+        self.stats = [tuple(stat) for stat in stats]
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.keys = np.asarray(keys, dtype=np.uint32)
+        self._rows = dict((frame, row) for row, frame in enumerate(self.frames))
+        if blooms is None:
+            counts = np.diff(self.offsets)
+            bits = BLOOM_MIN_BITS
+            while bits < BLOOM_BITS_PER_ID * (counts.max() if len(counts) else 0):
+                bits *= 2
+            blooms = np.zeros((len(self.frames), bits // 8), dtype=np.uint8)
+            for row in range(len(self.frames)):
+                blooms[row] = _bloom_filter(self.frame_keys(self.frames[row]), bits)
+        self.blooms = blooms
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __contains__(self, frame):
+        return frame in self._rows
+
+    def frame_keys(self, frame):
+        row = self._rows[frame]
+        return self.keys[self.offsets[row]:self.offsets[row + 1]]
+
+    def is_current(self, frame, path):
+        """ True if the frame was indexed from this path, unchanged since. """
+        row = self._rows.get(frame)
+        if row is None or os.path.abspath(path) != os.path.abspath(self.paths[row]):
+            return False
+        try:
+            return _file_stat(path) == self.stats[row]
+        except OSError:
+            return False
+
+    def _bloom_rows(self, key):
+        """ Returns the bool array of frames whose filter may have key. """
+        positions = _bloom_positions([key], self.blooms.shape[1] * 8)[:, 0].astype(np.int64)
+        masks = (1 << (positions & 7)).astype(np.uint8)
+        return ((self.blooms[:, positions >> 3] & masks) == masks).all(axis=1)
+
+    def contains(self, frame, ids):
+        """ True if any of the IDs (float IDs or uint32 keys) is in the frame. """
+        keys = cx._as_keys(ids)
+        frame_keys = self.frame_keys(frame)
+        positions = np.searchsorted(frame_keys, keys)
+        positions[positions == len(frame_keys)] = 0
+        return bool(len(frame_keys) and (frame_keys[positions] == keys).any())
+
+    def frames_containing(self, name_or_id):
+        """ Returns the sorted frames with an object, by name or float ID.
+        Only frames that pass the Bloom filter have their keys searched.
+        """
+        key = _key(name_or_id)
+        frames = []
+        for row in np.flatnonzero(self._bloom_rows(key)):
+            frame_keys = self.keys[self.offsets[row]:self.offsets[row + 1]]
+            position = np.searchsorted(frame_keys, key)
+            if position < len(frame_keys) and frame_keys[position] == key:
+                frames.append(self.frames[row])
+        return sorted(frames)
+
+    def save(self, path):
+        """ Writes the index as a .npz file, replacing it once complete. """
+        temp_path = "%s.%s.tmp" % (path, os.getpid())
+        try:
+            with open(temp_path, "wb") as f:
+                np.savez(f, version=np.array(INDEX_VERSION), layer=np.array(self.layer),
+                         frames=np.array(self.frames, dtype=np.int64),
+                         paths=np.array(self.paths),
+                         stats=np.array(self.stats, dtype=np.float64).reshape(-1, 2),
+                         offsets=self.offsets, keys=self.keys, blooms=self.blooms)
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+
+def load_frame_index(path):
+    """ Reads an index written by FrameIndex.save(). """
+    with np.load(path) as data:
+        if int(data["version"]) != INDEX_VERSION:
+            raise IOError("Cryptomatte: Unsupported index version in %s" % path)
+        stats = [(int(size), float(mtime)) for size, mtime in data["stats"]]
+        return FrameIndex(str(data["layer"]), [int(x) for x in data["frames"]],
+                          [str(x) for x in data["paths"]], stats, data["offsets"],
+                          data["keys"], data["blooms"])
+
+
+def frame_keys(cinfo, band_height=64, threads=None):
+    """ Returns the sorted uint32 keys of the IDs with coverage in an
+    ExrCryptomatteInfo's selected layer, reading it in bands.
+    """
+    band_keys = []
+    for _, rank_ids, rank_coverage in cinfo.iter_rank_bands(band_height, threads):
+        band_keys.append(np.unique(rank_ids.view(np.uint32)[rank_coverage != 0.0]))
+    return np.unique(np.concatenate(band_keys)) if band_keys else np.zeros(0, np.uint32)
+
+
+def _index_frame(args):
+    """ Returns (frame, path, layer, stat, keys) for one frame, for a pool of
+    processes. Frames that can not be read have no layer, so that they are
+    left out of the index and reported when baked.
+    """
+    import cryptomatte_exr as ce
+
+    frame, path, layer = args
+    try:
+        stat = _file_stat(path)
+        cinfo = ce.ExrCryptomatteInfo(path)
+        if (layer and not cinfo.set_selection(layer)) or not cinfo.is_valid():
+            return frame, path, None, None, None
+        return frame, path, cinfo.get_selection_name(), stat, frame_keys(cinfo, threads=1)
+    except (IOError, OSError, ValueError):
+        return frame, path, None, None, None
+
+
+def build_frame_index(paths, layer="", existing=None, processes=None):
+    """ Indexes frames, given as a dict of frame numbers to paths, on a pool
+    of processes. Frames of an existing index that are still current are
+    kept rather than read again.
+    """
+    import multiprocessing
+
+    if existing is not None and layer and existing.layer != cu._legal_nuke_layer_name(layer):
+        existing = None
+    kept, todo = {}, []
+    if existing is not None:
+        # Frames indexed before, but not asked for now, are kept if current.
+        for frame, path in zip(existing.frames, existing.paths):
+            if frame not in paths and existing.is_current(frame, path):
+                kept[frame] = (path, existing.stats[existing._rows[frame]],
+                               existing.frame_keys(frame))
+    for frame, path in sorted(paths.items()):
+        if existing is not None and existing.is_current(frame, path):
+            kept[frame] = (path, existing.stats[existing._rows[frame]], existing.frame_keys(frame))
+        else:
+            todo.append((frame, path, layer))
+    if existing is not None:
+        layer = existing.layer
+
+    processes = processes or multiprocessing.cpu_count()
+    if processes == 1 or len(todo) < 2:
+        results = [_index_frame(args) for args in todo]
+    else:
+        pool = multiprocessing.Pool(min(processes, len(todo)))
+        try:
+            results = pool.map(_index_frame, todo)
+        finally:
+            pool.close()
+            pool.join()
+    for frame, path, frame_layer, stat, keys in results:
+        if frame_layer is not None:
+            layer = frame_layer
+            kept[frame] = (path, stat, keys)
+
+    frames = sorted(kept)
+    counts = [len(kept[frame][2]) for frame in frames]
+    return FrameIndex(layer, frames, [kept[frame][0] for frame in frames],
+                      [kept[frame][1] for frame in frames], np.concatenate([[0], np.cumsum(counts)]),
+                      np.concatenate([kept[frame][2] for frame in frames] or [[]]))
+
+
+#############################################
+# Object tables
+#############################################
+
+
+def _reduce_by_key(keys, xmins, ymins, xmaxs, ymaxs, areas, counts):
+    """ Groups per entry statistics by key: bounding boxes are merged,
+    areas and counts summed. Returns the same arrays, one entry per key.
+    """
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+    return (keys[starts],
+            np.minimum.reduceat(xmins[order], starts), np.minimum.reduceat(ymins[order], starts),
+            np.maximum.reduceat(xmaxs[order], starts), np.maximum.reduceat(ymaxs[order], starts),
+            np.add.reduceat(areas[order], starts), np.add.reduceat(counts[order], starts))
+
+
+def _band_statistics(rank_ids, rank_coverage, xmin, first_line):
+    """ Returns _reduce_by_key() of one band of ranks, with pixel coordinates
+    offset by (xmin, first_line).
+    """
+    width = rank_ids.shape[2]
+    entries = []
+    for rank in range(len(rank_ids)):
+        coverage = rank_coverage[rank].ravel()
+        pixels = np.flatnonzero(coverage)
+        keys = rank_ids[rank].view(np.uint32).ravel()[pixels]
+        # Pixels with an ID in more than one rank count once.
+        counted = np.ones(len(pixels), dtype=np.int64)
+        for earlier in range(rank):
+            repeated = ((rank_ids[earlier].view(np.uint32).ravel()[pixels] == keys) &
+                        (rank_coverage[earlier].ravel()[pixels] != 0.0))
+            counted[repeated] = 0
+        entries.append((keys, pixels, coverage[pixels].astype(np.float64), counted))
+    keys, pixels, areas, counts = [np.concatenate(x) for x in zip(*entries)]
+    if not len(keys):
+        return None
+    rows, columns = np.divmod(pixels.astype(np.int32), np.int32(width))
+    columns += np.int32(xmin)
+    rows += np.int32(first_line)
+    return _reduce_by_key(keys, columns, rows, columns, rows, areas, counts)
+
+
+class ObjectTable(object):
+    """ Statistics of every ID with coverage in a frame: keys (sorted uint32,
+    see cryptomatte_extraction.id_keys), bboxes (xmin, ymin, xmax, ymax),
+    inclusive and in the pixel coordinates of the data window, areas (the
+    sum of the coverage) and pixel counts. names are from the manifest, or
+    "<ID>" for IDs that are not in it.
+    """
+
+    def __init__(self, keys, bboxes, areas, pixel_counts, names):
+        self.keys = keys
+        self.bboxes = bboxes
+        self.areas = areas
+        self.pixel_counts = pixel_counts
+        self.names = names
+
+    def __len__(self):
+        return len(self.keys)
+
+    def index(self, name_or_id):
+        """ Returns the row of an object, by manifest name or float ID. """
+        if name_or_id in self.names:
+            return self.names.index(name_or_id)
+        key = np.float32(name_or_id).view(np.uint32)
+        position = int(np.searchsorted(self.keys, key))
+        if position == len(self.keys) or self.keys[position] != key:
+            raise KeyError(name_or_id)
+        return position
+
+    def window(self, ids):
+        """ Returns the union of the bboxes of IDs (float IDs or uint32 keys)
+        as a window for ExrScanlineReader.read(), or None if none are present.
+        """
+        keys = cx._as_keys(ids)
+        if not len(self.keys) or not len(keys):
+            return None
+        positions = np.searchsorted(self.keys, keys)
+        positions[positions == len(self.keys)] = 0
+        rows = positions[self.keys[positions] == keys]
+        if not len(rows):
+            return None
+        bboxes = self.bboxes[rows]
+        return (int(bboxes[:, 0].min()), int(bboxes[:, 1].min()),
+                int(bboxes[:, 2].max()), int(bboxes[:, 3].max()))
+
+    def rows(self, min_pixels=1):
+        """ Returns [(name, bbox, area, pixel count)], largest area first, for
+        reports of what is in the frame.
+        """
+        order = np.argsort(-self.areas, kind="stable")
+        return [(self.names[row], tuple(int(x) for x in self.bboxes[row]),
+                 float(self.areas[row]), int(self.pixel_counts[row]))
+                for row in order if self.pixel_counts[row] >= min_pixels]
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            np.savez(f, version=np.array(INDEX_VERSION), keys=self.keys, bboxes=self.bboxes,
+                     areas=self.areas, pixel_counts=self.pixel_counts,
+                     names=np.array(self.names))
+
+
+def load_object_table(path):
+    """ Reads a table written by ObjectTable.save(). """
+    with np.load(path) as data:
+        if int(data["version"]) != INDEX_VERSION:
+            raise IOError("Cryptomatte: Unsupported object table version in %s" % path)
+        return ObjectTable(data["keys"], data["bboxes"], data["areas"], data["pixel_counts"],
+                           [str(x) for x in data["names"]])
+
+
+def object_table(cinfo, band_height=64, threads=None, buffers=None):
+    """ Computes the ObjectTable of an ExrCryptomatteInfo's selected layer in
+    one pass over its ranks, read in bands.
+    """
+    xmin = cinfo.header.parts[0].data_window[0]
+    tables = []
+    for first_line, rank_ids, rank_coverage in cinfo.iter_rank_bands(band_height, threads,
+                                                                     buffers):
+        table = _band_statistics(rank_ids, rank_coverage, xmin, first_line)
+        if table is not None:
+            tables.append(table)
+    if tables:
+        columns = _reduce_by_key(*[np.concatenate(x) for x in zip(*tables)])
+    else:
+        columns = (np.zeros(0, np.uint32),) + (np.zeros(0, np.int32),) * 4 + (
+            np.zeros(0, np.float64), np.zeros(0, np.int64))
+    keys = columns[0]
+
+    manifest_keys, manifest_names = cx._manifest_keys(cinfo.parse_manifest())
+    names = []
+    for key in keys:
+        position = np.searchsorted(manifest_keys, key)
+        if position < len(manifest_keys) and manifest_keys[position] == key:
+            names.append(manifest_names[position])
+        else:
+            names.append("<{0:.12g}>".format(float(np.uint32(key).view(np.float32))))
+    return ObjectTable(keys, np.stack(columns[1:5], axis=1), columns[5], columns[6], names)
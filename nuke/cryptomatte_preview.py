@@ -0,0 +1,130 @@
+#
+#
+#  Copyright (c) 2014, 2015, 2016, 2017 Psyop Media Company, LLC
+#  See license.txt
+#
+#
+
+""" Renders the Cryptomatte gizmo's preview modes from decoded rank arrays,
+without Nuke, for checking renders and making contact sheets of sequences.
+"""
+
+import numpy as np
+
+PREVIEW_MODES = ["Colors", "Edges", "None"]
+
+# As in cryptomatte_utilities._build_preview_expressions().
+PREVIEW_FACTORS = [1, 16, 64]
+PREVIEW_RANKS = 4
+
+RGB_CHANNELS = ["red", "green", "blue"]
+
+
+#############################################
+# Preview rendering
+#############################################
+
+
+def render_preview(rank_ids, rank_coverage, mode="Colors", ranks=PREVIEW_RANKS, rgb=None,
+                   out=None):
+    """ Returns the (4, height, width) float32 rgba the gizmo's preview
+    expressions evaluate to, bit for bit.
+
+    Colors sums (mantissa(abs(id)) * factor % 0.25) * coverage over the first
+    four ranks, or over the first ranks given, or all ranks if ranks is None.
+    Edges is twice the coverage of the second rank in alpha. Modes leave rgb
+    as it was, like the Expression node does with empty expressions: rgb is
+    an optional (3, height, width) input image, black otherwise. The alpha
+    of the input is black, as the gizmo shuffles it out before the preview.
+    """
+    if mode not in PREVIEW_MODES:
+        raise ValueError("Cryptomatte: Unknown preview mode %s." % mode)
+    shape = rank_ids.shape[1:]
+    if out is None:
+        out = np.zeros((4,) + shape, dtype=np.float32)
+    else:
+        out[...] = 0.0
+    if rgb is not None:
+        out[:3] = rgb
+
+    if mode == "Colors":
+        ranks = len(rank_ids) if ranks is None else min(ranks, len(rank_ids))
+        term = np.empty(shape, dtype=np.float32)
+        whole = np.empty(shape, dtype=np.float32)
+        for rank in range(ranks):
+            mantissa = np.frexp(np.abs(rank_ids[rank]))[0]
+            for channel, factor in enumerate(PREVIEW_FACTORS):
+                np.multiply(mantissa, np.float32(factor), out=term)
+                # term % 0.25, exactly, as term is positive and the result
+                # representable, but many times faster than np.fmod.
+                np.multiply(term, np.float32(4.0), out=whole)
+                np.floor(whole, out=whole)
+                whole *= np.float32(0.25)
+                term -= whole
+                term *= rank_coverage[rank]
+                if rank:
+                    out[channel] += term
+                else:
+                    out[channel] = term
+    elif mode == "Edges" and len(rank_ids) > 1:
+        np.multiply(rank_coverage[1], np.float32(2.0), out=out[3])
+    return out
+
+
+#############################################
+# Contact sheets
+#############################################
+
+
+def _read_rgb(cinfo, buffers=None):
+    """ Returns the rgb of the file as (3, height, width), or None. """
+    import cryptomatte_exr as ce
+
+    if not all(channel in cinfo.exr_channels for channel in RGB_CHANNELS):
+        return None
+    with ce.ExrScanlineReader(cinfo.header.path, cinfo.header, buffers=buffers) as reader:
+        planes = buffers.get("rgb", (3,) + reader.shape) if buffers else None
+        return reader.read(RGB_CHANNELS, planes)
+
+
+def contact_sheet(paths, mode="Colors", ranks=PREVIEW_RANKS, layer=None, columns=4, step=4,
+                  threads=None):
+    """ Renders the preview of every file in a grid, columns wide, taking
+    every step-th pixel of each frame's data window. Files missing the layer
+    are left black. Returns a (4, height, width) float32 array.
+    """
+    import cryptomatte_exr as ce
+
+    buffers = ce.BufferPool()
+    tiles = []
+    for path in paths:
+        cinfo = ce.ExrCryptomatteInfo(path)
+        if (layer and not cinfo.set_selection(layer)) or not cinfo.is_valid():
+            tiles.append(None)
+            continue
+        rank_ids, rank_coverage = cinfo.read_ranks(threads=threads, buffers=buffers)
+        rank_ids, rank_coverage = rank_ids[:, ::step, ::step], rank_coverage[:, ::step, ::step]
+        rgb = _read_rgb(cinfo, buffers) if mode != "Colors" else None
+        if rgb is not None:
+            rgb = rgb[:, ::step, ::step]
+        tiles.append(render_preview(rank_ids, rank_coverage, mode, ranks, rgb))
+
+    shapes = [tile.shape[1:] for tile in tiles if tile is not None] or [(1, 1)]
+    tile_height, tile_width = max(shape[0] for shape in shapes), max(shape[1] for shape in shapes)
+    rows = max(1, -(-len(tiles) // columns))
+    sheet = np.zeros((4, rows * tile_height, min(columns, max(len(tiles), 1)) * tile_width),
+                     dtype=np.float32)
+    for index, tile in enumerate(tiles):
+        if tile is not None:
+            y, x = (index // columns) * tile_height, (index % columns) * tile_width
+            sheet[:, y:y + tile.shape[1], x:x + tile.shape[2]] = tile
+    return sheet
+
+
+def write_contact_sheet(paths, output_path, mode="Colors", ranks=PREVIEW_RANKS, layer=None,
+                        columns=4, step=4, compression="ZIP", threads=None):
+    """ Writes contact_sheet() as an rgba EXR. """
+    import cryptomatte_exr as ce
+
+    sheet = contact_sheet(paths, mode, ranks, layer, columns, step, threads)
+    ce.write_exr(output_path, dict(zip("RGBA", sheet)), compression)
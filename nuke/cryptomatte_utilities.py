@@ -7,10 +7,15 @@
 
 import re
 import csv
-import nuke
 import struct
 import fnmatch
 
+try:
+    import nuke
+except ImportError:
+    # Headless use, such as reading cryptomattes from EXR files directly.
+    nuke = None
+
 __version__ = "1.4.0"
 
 GIZMO_CHANNEL_KNOBS = [
@@ -30,7 +35,11 @@ GIZMO_ADD_CHANNEL_KNOBS = [
 CRYPTO_METADATA_LEGAL_PREFIX = ["exr/cryptomatte/", "cryptomatte/"]
 CRYPTO_METADATA_DEFAULT_PREFIX = CRYPTO_METADATA_LEGAL_PREFIX[1]
 
+DECRYPTOMATTE_BATCH_LAYER = "decryptomatteBatch"
+DECRYPTOMATTE_BATCH_CHANNELS = ["red", "green", "blue", "alpha"]
+
 HAS_WILDCARDS_RE = re.compile(r"(?<!\\)([*?\[\]])")
+EXTRACTION_TERM_RE = re.compile(r"^\(\((?P<condition>.*)\) \? (?P<coverage>[^ ]+) : 0\.0\)$")
 
 
 def setup_cryptomatte_ui():
@@ -85,6 +94,10 @@ class CryptomatteTesting(object):
         import cryptomatte_utilities_tests as cu_tests
         return cu_tests.run_nuke_tests(test_filter, failfast)
 
+    def run_benchmarks(self, benchmark_filter=""):
+        import cryptomatte_utilities_benchmarks as cu_benchmarks
+        return cu_benchmarks.run_benchmarks(benchmark_filter)
+
 tests = CryptomatteTesting()
 
 #############################################
@@ -163,6 +176,20 @@ class CryptomatteInfo(object):
         if not exr_metadata_dict:
             exr_metadata_dict = self.nuke_node.metadata(view=nuke.thisView()) or {}
 
+        default_selection = self._load_cryptomattes(exr_metadata_dict)
+
+        self.selection = default_selection
+        if self.nuke_node.Class() in ["Cryptomatte", "Encryptomatte"]:
+            selection_name = self.nuke_node.knob("cryptoLayer").getValue()
+            if selection_name:
+                valid_selection = self.set_selection(selection_name)
+                if not valid_selection and not self.nuke_node.knob("cryptoLayerLock").getValue():
+                    self.selection = default_selection
+
+    def _load_cryptomattes(self, exr_metadata_dict):
+        """ Collects the cryptomattes and their channels from the metadata.
+        Returns the default selection.
+        """
         default_selection = None
         
         self.cachable_metadata = {}
@@ -199,13 +226,7 @@ class CryptomatteInfo(object):
             channels = self._identify_channels(name)
             self.cryptomattes[metadata_id]["channels"] = channels
 
-        self.selection = default_selection
-        if self.nuke_node.Class() in ["Cryptomatte", "Encryptomatte"]:
-            selection_name = self.nuke_node.knob("cryptoLayer").getValue()
-            if selection_name:
-                valid_selection = self.set_selection(selection_name)
-                if not valid_selection and not self.nuke_node.knob("cryptoLayerLock").getValue():
-                    self.selection = default_selection
+        return default_selection
 
     def is_valid(self):
         """Checks that the selection is valid."""
@@ -269,13 +290,7 @@ class CryptomatteInfo(object):
         gets sorted channels, such as cryptoObject00, cryptoObject01, cryptoObject02
         """
 
-        channel_list = []
-        if self.nuke_node.Class() in ["Cryptomatte", "Encryptomatte"]:
-            # nuke_node is a keyer gizmo or encryptomatte gizmo
-            channel_list = self.nuke_node.node('Input1').channels()
-        else:
-            # nuke_node might a read node
-            channel_list = self.nuke_node.channels()
+        channel_list = self._get_channel_list()
 
         # regex for "cryptoObject" + digits + ending with .red or .r
         channel_regex = re.compile(r'({name}\d+)\.(?:red|r)$'.format(name=name))
@@ -287,6 +302,14 @@ class CryptomatteInfo(object):
 
         return sorted(pure_channels)[:len(GIZMO_CHANNEL_KNOBS)]
 
+    def _get_channel_list(self):
+        if self.nuke_node.Class() in ["Cryptomatte", "Encryptomatte"]:
+            # nuke_node is a keyer gizmo or encryptomatte gizmo
+            return self.nuke_node.node('Input1').channels()
+        else:
+            # nuke_node might a read node
+            return self.nuke_node.channels()
+
     def resolve_manifest_paths(self, exr_path, sidecar_path):
         import os
         if "\\" in sidecar_path:
@@ -402,7 +425,8 @@ class CryptomatteInfo(object):
                 ids[idvalue] = name
 
         if not quiet:
-            print("Tested %s, %s names" % (self.nuke_node.name(), len(manifest)))
+            tested = self.nuke_node.name() if self.nuke_node else self.filename
+            print("Tested %s, %s names" % (tested, len(manifest)))
             print("    ", len(errors), "non-matching IDs between python and c++.")
             print("    ", len(collisions), "hash collisions in manifest.")
 
@@ -630,18 +654,100 @@ def _limbo_state(gizmo):
     return False
 
 
+#############################################
+# Utils - Knob writes
+#############################################
+
+
+def reset_knob_write_stats():
+    global g_cryptomatte_knob_writes
+    g_cryptomatte_knob_writes = {"written": 0, "avoided": 0}
+
+reset_knob_write_stats()
+
+
+def get_knob_write_stats():
+    """ Returns how many knob writes were made and avoided by dirty-checking. """
+    return dict(g_cryptomatte_knob_writes)
+
+
+def _knob_has_value(knob, value):
+    if isinstance(value, (list, tuple)):
+        current = knob.getValue()
+        return isinstance(current, (list, tuple)) and list(current) == list(value)
+    if isinstance(value, (bool, int, float)):
+        return knob.getValue() == value
+    return knob.value() == value
+
+
+def _set_knob_value(knob, value):
+    """ Sets the knob value only if it changed, as every write makes Nuke
+    re-parse and re-evaluate. Returns True if the knob was written.
+    """
+    if _knob_has_value(knob, value):
+        g_cryptomatte_knob_writes["avoided"] += 1
+        return False
+    knob.setValue(value)
+    g_cryptomatte_knob_writes["written"] += 1
+    return True
+
+
+class KnobChanges(object):
+    """ Collects knob writes during a gizmo update, and on commit only writes
+    knobs whose values actually changed. Each write can trigger re-evaluation
+    and further knobChanged callbacks, so no-op updates should not write
+    anything, and knobs are written in the order of their last set(), which
+    is the order the final writes would have happened without batching.
+
+    Use as a context manager, which commits on exit:
+        with KnobChanges(gizmo) as knobs:
+            knobs.set("cryptoLayer", "CryptoObject")
+    """
+
+    def __init__(self, node):
+        import collections
+        self.node = node
+        self._pending = collections.OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+
+    def set(self, knob_name, value):
+        self._pending.pop(knob_name, None)
+        self._pending[knob_name] = value
+
+    def value(self, knob_name):
+        """ Returns the pending value if there is one, otherwise the knob's. """
+        if knob_name in self._pending:
+            return self._pending[knob_name]
+        return self.node.knob(knob_name).value()
+
+    def commit(self):
+        """ Writes the changed knobs. Returns the number of knobs written. """
+        written = 0
+        for knob_name, value in self._pending.items():
+            if _set_knob_value(self.node.knob(knob_name), value):
+                written += 1
+        self._pending.clear()
+        return written
+
+
 #############################################
 # Utils - Update Gizmi
 #############################################
 
-def _set_channels(gizmo, channels, layer_name):
-    gizmo.knob("cryptoLayer").setValue(layer_name)
+def _set_channels(knobs, channels, layer_name):
+    knobs.set("cryptoLayer", layer_name)
     for i, knob_name in enumerate(GIZMO_CHANNEL_KNOBS):
         channel = channels[i] if i < len(channels) else "none"
-        gizmo.knob(knob_name).setValue(channel)
+        knobs.set(knob_name, channel)
 
-def _set_metadata_cache(gizmo, cinfo):
-    gizmo.knob('metadataCache').setValue(cinfo.get_metadata_cache())
+def _set_metadata_cache(knobs, cinfo):
+    knobs.set('metadataCache', cinfo.get_metadata_cache())
 
 def _set_crypto_layer_choice_options(gizmo, cinfo):
     layer_locked = gizmo.knob('cryptoLayerLock').value()
@@ -650,38 +756,39 @@ def _set_crypto_layer_choice_options(gizmo, cinfo):
     gizmo.knob("cryptoLayerChoice").setValues(values)
     return values
 
-def _set_crypto_layer_choice(gizmo, cinfo):
-    values = _set_crypto_layer_choice_options(gizmo, cinfo)
+def _set_crypto_layer_choice(knobs, cinfo):
+    values = _set_crypto_layer_choice_options(knobs.node, cinfo)
     current_selection = cinfo.get_selection_name()
 
     if current_selection:
-        gizmo.knob("cryptoLayerChoice").setValue(values.index(current_selection))
+        knobs.set("cryptoLayerChoice", values.index(current_selection))
 
 def _update_cryptomatte_gizmo(gizmo, cinfo, force=False):
     if _cancel_update(gizmo, force):
         return
-    _set_metadata_cache(gizmo, cinfo)
-    if not cinfo.is_valid():
-        return
-    cryptomatte_channels = cinfo.get_channels()
-    if not cryptomatte_channels:
-        return
-    _set_channels(gizmo, cryptomatte_channels, cinfo.get_selection_name())
-    _explode_wildcards(gizmo, cinfo)
-    _set_expression(gizmo, cryptomatte_channels)
-    _set_preview_expression(gizmo, cryptomatte_channels)
-    _set_crypto_layer_choice(gizmo, cinfo)
+    with KnobChanges(gizmo) as knobs:
+        _set_metadata_cache(knobs, cinfo)
+        if not cinfo.is_valid():
+            return
+        cryptomatte_channels = cinfo.get_channels()
+        if not cryptomatte_channels:
+            return
+        _set_channels(knobs, cryptomatte_channels, cinfo.get_selection_name())
+        _explode_wildcards(knobs, cinfo)
+        _set_expression(knobs, cryptomatte_channels)
+        _set_preview_expression(knobs, cryptomatte_channels)
+        _set_crypto_layer_choice(knobs, cinfo)
 
 
-def _explode_wildcards(gizmo, cinfo):
+def _explode_wildcards(knobs, cinfo):
     """ Explodes the wildcards in the matte list."""
-    if not gizmo.knob("useWildcards").value():
+    if not knobs.node.knob("useWildcards").value():
         return 
 
-    ml = MatteList(gizmo)
+    ml = MatteList(knobs.value("matteList"))
     if ml.has_wildcards:
         ml.expand_wildcards(cinfo)
-        ml.set_gizmo_mattelist(gizmo)
+        knobs.set("matteList", ml.to_nukestr)
 
 def _set_ui(gizmo):
     layer_locked = gizmo.knob('cryptoLayerLock').value()
@@ -703,29 +810,35 @@ def _legal_nuke_layer_name(name):
 def _update_encryptomatte_gizmo(gizmo, cinfo, force=False):
     if _cancel_update(gizmo, force):
         return
+    with KnobChanges(gizmo) as knobs:
+        _set_encryptomatte_knobs(knobs, cinfo)
+
+
+def _set_encryptomatte_knobs(knobs, cinfo):
+    gizmo = knobs.node
 
-    def reset_gizmo(gizmo):
-        _set_channels(gizmo, [], "")
-        gizmo.knob("alphaExpression").setValue("")
+    def reset_gizmo(knobs):
+        _set_channels(knobs, [], "")
+        knobs.set("alphaExpression", "")
 
     matte_name = gizmo.knob('matteName').value()
     matte_input = gizmo.input(1)
-    _set_metadata_cache(gizmo, cinfo)
+    _set_metadata_cache(knobs, cinfo)
 
     if matte_name == "" and not matte_input is None:
         matte_name = matte_input.name()
-        gizmo.knob('matteName').setValue(matte_name)
+        knobs.set('matteName', matte_name)
 
     if matte_name == "":
-        gizmo.knob('id').setValue(0.0)
-        gizmo.knob('idHex').setValue('')
-        gizmo.knob('previewColor').setValue([0.0, 0.0, 0.0])
+        knobs.set('id', 0.0)
+        knobs.set('idHex', '')
+        knobs.set('previewColor', [0.0, 0.0, 0.0])
 
     else:
         id_value = mm3hash_float(matte_name)
-        gizmo.knob('id').setValue(id_value)
-        gizmo.knob('idHex').setValue(id_to_hex(id_value))
-        gizmo.knob('previewColor').setValue(id_to_rgb(id_value))
+        knobs.set('id', id_value)
+        knobs.set('idHex', id_to_hex(id_value))
+        knobs.set('previewColor', id_to_rgb(id_value))
 
     if gizmo.knob('setupLayers').value():
         gizmo.knob('cryptoLayers').setEnabled(True)
@@ -736,26 +849,26 @@ def _update_encryptomatte_gizmo(gizmo, cinfo, force=False):
         else:
             cryptomatte_channels = []
 
-        crypto_layer = gizmo.knob('cryptoLayer').value()
+        crypto_layer = knobs.value('cryptoLayer')
         crypto_layer = _legal_nuke_layer_name(crypto_layer)
         if not crypto_layer:
-            return reset_gizmo(gizmo)
+            return reset_gizmo(knobs)
         if crypto_layer in cryptomatte_channels:
-            gizmo.knob('inputCryptoLayers').setValue(len(cryptomatte_channels) - 1)
+            knobs.set('inputCryptoLayers', len(cryptomatte_channels) - 1)
             manifest_key = cinfo.get_selection_metadata_key("")
-            gizmo.knob('manifestKey').setValue(manifest_key)
-            gizmo.knob('newLayer').setValue(False)
+            knobs.set('manifestKey', manifest_key)
+            knobs.set('newLayer', False)
         else:
-            gizmo.knob('inputCryptoLayers').setValue(0)
-            gizmo.knob('manifestKey').setValue(
+            knobs.set('inputCryptoLayers', 0)
+            knobs.set('manifestKey',
                 CRYPTO_METADATA_DEFAULT_PREFIX + layer_hash(crypto_layer) + '/')
-            gizmo.knob('newLayer').setValue(True)
+            knobs.set('newLayer', True)
 
         cryptomatte_channels = [
             crypto_layer + "{0:02d}".format(i)
-            for i in range(int(gizmo.knob('cryptoLayers').value()))
+            for i in range(int(knobs.value('cryptoLayers')))
         ]
-        _set_channels(gizmo, cryptomatte_channels, crypto_layer)
+        _set_channels(knobs, cryptomatte_channels, crypto_layer)
 
     else:
         gizmo.knob('cryptoLayers').setEnabled(False)
@@ -766,26 +879,32 @@ def _update_encryptomatte_gizmo(gizmo, cinfo, force=False):
         if not cryptomatte_channels:
             return
 
-        gizmo.knob('newLayer').setValue(False)
-        _set_channels(gizmo, cryptomatte_channels, cinfo.get_selection_name())
-        gizmo.knob('inputCryptoLayers').setValue(len(cryptomatte_channels) - 1)
-        gizmo.knob('cryptoLayers').setValue(len(cryptomatte_channels) - 1)
+        knobs.set('newLayer', False)
+        _set_channels(knobs, cryptomatte_channels, cinfo.get_selection_name())
+        knobs.set('inputCryptoLayers', len(cryptomatte_channels) - 1)
+        knobs.set('cryptoLayers', len(cryptomatte_channels) - 1)
         manifest_key = cinfo.get_selection_metadata_key("")
-        gizmo.knob('manifestKey').setValue(manifest_key)
+        knobs.set('manifestKey', manifest_key)
 
-    gizmo.knob("alphaExpression").setValue(_build_extraction_expression(cryptomatte_channels, [0.0]))
+    knobs.set("alphaExpression", _build_extraction_expression(cryptomatte_channels, [0.0]))
 
 def _update_encyptomatte_setup_layers(gizmo):
+    with KnobChanges(gizmo) as knobs:
+        _set_encryptomatte_layer_knobs(knobs)
+
+
+def _set_encryptomatte_layer_knobs(knobs):
+    gizmo = knobs.node
     setup_layers = gizmo.knob('setupLayers').value()
     num_layers = gizmo.knob('cryptoLayers').value()
     input_layers = gizmo.knob('inputCryptoLayers').value()
     crypto_layer = _legal_nuke_layer_name(gizmo.knob('cryptoLayer').value())
 
     if not setup_layers:
-        gizmo.knob('manifestKey').setValue("")
+        knobs.set('manifestKey', "")
         for ch_add, ch_remove in zip(GIZMO_ADD_CHANNEL_KNOBS, GIZMO_REMOVE_CHANNEL_KNOBS):
-            gizmo.knob(ch_add).setValue("none")
-            gizmo.knob(ch_remove).setValue("none")
+            knobs.set(ch_add, "none")
+            knobs.set(ch_remove, "none")
         return
 
     all_layers = nuke.layers()
@@ -800,14 +919,14 @@ def _update_encyptomatte_setup_layers(gizmo):
                 channels = ["%s.%s" % (this_layer, c) for c in ['red', 'green', 'blue', 'alpha']]
                 nuke.Layer(this_layer, channels)
 
-            gizmo.knob(ch_add).setValue(this_layer)
-            gizmo.knob(ch_remove).setValue("none")
+            knobs.set(ch_add, this_layer)
+            knobs.set(ch_remove, "none")
         else:
-            gizmo.knob(ch_add).setValue("none")
+            knobs.set(ch_add, "none")
             if i <= input_layers:
-                gizmo.knob(ch_remove).setValue(this_layer)
+                knobs.set(ch_remove, this_layer)
             else:
-                gizmo.knob(ch_remove).setValue("none")
+                knobs.set(ch_remove, "none")
 
 def encryptomatte_add_manifest_id():
     node = nuke.thisNode()
@@ -945,51 +1064,122 @@ def unload_manifest(node):
 #############################################
 
 
-def _set_expression(gizmo, cryptomatte_channels):
-    ml = MatteList(gizmo)
-    expression = _build_extraction_expression(cryptomatte_channels, ml.IDs)
-    gizmo.knob("expression").setValue(expression)
+class ExpressionCache(object):
+    """ A small LRU cache of built expressions. Building the extraction
+    expression for big matte lists is expensive, and most knob changes
+    (e.g. toggling preview modes) don't change the channels or IDs.
 
+    Holds at most max_size expressions and max_chars characters of them,
+    since one expression of thousands of IDs can be megabytes. Expressions
+    longer than max_chars are built every time instead.
+    """
 
-def _build_condition(condition, IDs):
-    conditions = []
-    for ID in IDs:
-        conditions.append( condition.replace("ID", "{0:.12g}".format(ID)) )
-    return " || ".join(conditions)
+    def __init__(self, max_size=16, max_chars=8 * 1024 * 1024):
+        import collections
+        self.max_size = max_size
+        self.max_chars = max_chars
+        self.chars = 0
+        self._items = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    @classmethod
+    def _chars(cls, value):
+        """ Characters of an expression, or of a list of expressions. Other
+        values count as none. """
+        if isinstance(value, (list, tuple)):
+            return sum(cls._chars(item) for item in value)
+        return len(value) if hasattr(value, "__len__") else 0
+
+    def get(self, key, builder, *args):
+        """ Returns the cached value for key, calling builder(*args) on a miss. """
+        if key in self._items:
+            value, chars = self._items.pop(key)
+        else:
+            value = builder(*args)
+            chars = self._chars(value)
+            if chars > self.max_chars:
+                return value
+            self.chars += chars
+            while self._items and (len(self._items) >= self.max_size or
+                                   self.chars > self.max_chars):
+                _, (_, evicted_chars) = self._items.popitem(last=False)
+                self.chars -= evicted_chars
+        self._items[key] = (value, chars)
+        return value
 
+    def clear(self):
+        self._items.clear()
+        self.chars = 0
 
-def _build_extraction_expression(channel_list, IDs):
-    if not IDs:
-        return ""
-    sorted_ids = sorted(IDs)
-    iterated_expression = "({red_condition} ? sub_channel.green : 0.0) + ({blue_condition} ? sub_channel.alpha : 0.0) + more_work_needed"
 
-    subcondition_red =  "sub_channel.red == ID"
-    subcondition_blue = "sub_channel.blue == ID"
+def reset_expression_cache():
+    global g_cryptomatte_extraction_expressions
+    global g_cryptomatte_preview_expressions
 
-    expression = ""
-    for channel in channel_list:
-        condition_r = _build_condition(subcondition_red, sorted_ids)
-        condition_b = _build_condition(subcondition_blue, sorted_ids)
+    g_cryptomatte_extraction_expressions = ExpressionCache(max_size=16)
+    g_cryptomatte_preview_expressions = ExpressionCache(max_size=16)
 
-        channel_expression = iterated_expression.replace("red_condition", condition_r).replace("blue_condition", condition_b)
-        channel_expression = channel_expression.replace("sub_channel", channel)
+reset_expression_cache()
+
+
+def _set_expression(knobs, cryptomatte_channels):
+    ml = MatteList(knobs.value("matteList"))
+    expression = _get_extraction_expression(cryptomatte_channels, ml.IDs)
+    knobs.set("expression", expression)
+
+
+def _get_extraction_expression(cryptomatte_channels, IDs):
+    """ Cached _build_extraction_expression(), keyed by channels and ID set. """
+    id_set = frozenset(IDs)
+    key = (tuple(cryptomatte_channels), id_set)
+    return g_cryptomatte_extraction_expressions.get(
+        key, _build_extraction_expression, cryptomatte_channels, id_set)
 
-        if not expression:
-            expression = channel_expression
-        else:
-            expression = expression.replace("more_work_needed", channel_expression)
-    expression = expression.replace("more_work_needed", "0")
 
-    expression = expression.replace("{", "(")
-    expression = expression.replace("}", ")")
+def _build_id_literals(IDs):
+    """ Formats each ID once, in the sorted order used by the expressions. """
+    return ["{0:.12g}".format(ID) for ID in sorted(IDs)]
 
-    return expression
 
-def _set_preview_expression(gizmo, cryptomatte_channels):
-    enabled = gizmo.knob('previewEnabled').getValue()
-    preview_mode = gizmo.knob('previewMode').value() if enabled else 'None'
+def _build_condition(id_chan, id_literals):
+    return "%s == %s" % (id_chan, (" || %s == " % id_chan).join(id_literals))
 
+
+def _build_extraction_expression(channel_list, IDs):
+    """
+    Generates an expression like this, in one pass:
+        ((c00.red == ID1 || c00.red == ID2) ? c00.green : 0.0) +
+        ((c00.blue == ID1 || c00.blue == ID2) ? c00.alpha : 0.0) +
+        ((c01.red == ID1 || c01.red == ID2) ? c01.green : 0.0) +
+        ... + 0
+    """
+    if not IDs or not channel_list:
+        return ""
+    id_literals = _build_id_literals(IDs)
+
+    terms = []
+    for channel in channel_list:
+        for id_suffix, cov_suffix in [('.red', '.green'), ('.blue', '.alpha')]:
+            terms.append("((%s) ? %s : 0.0)" % (
+                _build_condition(channel + id_suffix, id_literals), channel + cov_suffix))
+    terms.append("0")
+    return " + ".join(terms)
+
+def _set_preview_expression(knobs, cryptomatte_channels):
+    enabled = knobs.node.knob('previewEnabled').getValue()
+    preview_mode = knobs.node.knob('previewMode').value() if enabled else 'None'
+
+    expressions = g_cryptomatte_preview_expressions.get(
+        (tuple(cryptomatte_channels), preview_mode),
+        _build_preview_expressions, cryptomatte_channels, preview_mode)
+    for i in range(4):
+        knobs.set('previewExpression' + str(i), expressions[i])
+
+
+def _build_preview_expressions(cryptomatte_channels, preview_mode):
+    """ Returns the four preview expressions (rgba) for the preview mode. """
     channel_pairs = []
     for c in cryptomatte_channels:
         channel_pairs.append(('%s.red' % c, '%s.green' % c))
@@ -1039,8 +1229,7 @@ def _set_preview_expression(gizmo, cryptomatte_channels):
         expressions.append("")
     else:  # mode is none
         expressions = ["", "", "", ""]
-    for i in range(4):
-        gizmo.knob('previewExpression' + str(i)).setValue(expressions[i])
+    return expressions
 
 
 
@@ -1234,10 +1423,9 @@ class MatteList(StringEncoder):
     """
 
     def __init__(self, initializer):
-        import nuke
         self.mattes = None
 
-        if type(initializer) is nuke.Gizmo:
+        if nuke and type(initializer) is nuke.Gizmo:
             gizmo = initializer
             nukestr = gizmo.knob("matteList").getValue()
         else: #str or in Python 2.7, str or unicode
@@ -1376,8 +1564,23 @@ def decryptomatte_button(node):
         decryptomatte_nodes([node], False)
 
 
-def decryptomatte_nodes(nodes, ask):
-    """ Replaces Cryptomatte gizmos with equivelant nodes. """
+def decryptomatte_nodes(nodes, ask, max_expression_length=None, merge_sources=False):
+    """ Replaces Cryptomatte gizmos with equivelant nodes.
+
+    If max_expression_length is set, extraction expressions longer than that
+    are split across chained Expression nodes, which keeps each expression
+    quick to parse for big matte lists. Each node stores its running sum in
+    the matte output channel for the next one to add to, so this matches the
+    single expression exactly only because Nuke evaluates expressions in
+    float32, the precision the channel is stored in, which
+    CryptomatteNukeTests.test_decrypto_split_expression_exact checks.
+
+    If merge_sources is set, gizmos with the same input share Expression nodes
+    computing up to four mattes each, which are shuffled into each gizmo's
+    matte output. This way the cryptomatte channels are read once for
+    every four mattes rather than for every matte, at the cost of a
+    Shuffle node per gizmo.
+    """
     gizmos = [n for n in nodes if n.Class() == "Cryptomatte"]
     if not gizmos:
         return
@@ -1385,8 +1588,15 @@ def decryptomatte_nodes(nodes, ask):
     if not ask or nuke.ask(('Replace %s Cryptomatte gizmos with expression nodes? '
         'Replaced Gizmos will be disabled and selected.') % len(gizmos)):
 
-        for gizmo in gizmos:
-            _decryptomatte(gizmo)
+        singles, batches = gizmos, []
+        if merge_sources:
+            singles, batches = _decryptomatte_batches(gizmos, max_expression_length)
+
+        for gizmo in singles:
+            _decryptomatte(gizmo, max_expression_length)
+
+        for batch in batches:
+            _decryptomatte_batch(batch)
 
         for node in nuke.selectedNodes():
             node.knob("selected").setValue(False)
@@ -1400,46 +1610,79 @@ def decryptomatte_nodes(nodes, ask):
 #############################################
 
 
-def _decryptomatte(gizmo):
+def _decryptomatte(gizmo, max_expression_length=None):
     """ Returns list of new nodes, in order of connections. """
     orig_name = gizmo.name()
     disabled = gizmo.knob("disable").getValue()
-    matte_list = gizmo.knob("matteList").value()
-    matte_only = gizmo.knob("matteOnly").value()
     expression = gizmo.knob("expression").value()
     matte_output = gizmo.knob("matteOutput").value()
     unpremultiply = gizmo.knob("unpremultiply").value()
-    remove_channels = gizmo.knob("RemoveChannels").value()
 
-    # compile list immediate outputs to connect to
+    connect_to = _decryptomatte_connections(gizmo)
+
+    # Split big expressions into partial sums, accumulated in the matte output.
+    expressions = [expression]
+    if max_expression_length and len(expression) > max_expression_length:
+        crypto_channels = [gizmo.knob(x).value() for x in GIZMO_CHANNEL_KNOBS]
+        accumulator = _decryptomatte_accumulator(matte_output, crypto_channels, unpremultiply)
+        partial_sums = _split_extraction_expression(expression, max_expression_length)
+        if accumulator and partial_sums:
+            expressions = _chain_partial_sums(accumulator, partial_sums)
+
+    # Modifiy expression to perform premult.
+    if unpremultiply and expressions[-1]:
+        expressions[-1] = "(%s) / (alpha ? alpha : 1)" % expressions[-1]
+
+    # Setup expression nodes.
+    new_nodes = []
+    for i, expr in enumerate(expressions):
+        expr_node = nuke.nodes.Expression(
+            inputs=new_nodes[-1:] or [gizmo], channel0=matte_output, expr0=expr,
+            name="%sExtract%s" % (orig_name, i + 1 if i else ""), disable=disabled)
+        new_nodes.append(expr_node)
+
+    _decryptomatte_add_gizmo_knobs(new_nodes[0], gizmo)
+    return _decryptomatte_finish(gizmo, new_nodes, connect_to)
+
+
+def _decryptomatte_add_gizmo_knobs(node, gizmo):
+    """ Records the matte list and the hidden cryptomatte channels of gizmo
+    on node, the first node replacing it.
+    """
+    node.addKnob(nuke.nuke.String_Knob(
+        'origMatteList', 'Original Matte List', gizmo.knob("matteList").value()))
+    for knob_name in GIZMO_CHANNEL_KNOBS:
+        node.addKnob(nuke.nuke.Channel_Knob(knob_name, "none") )
+        node.knob(knob_name).setValue(gizmo.knob(knob_name).value())
+        node.knob(knob_name).setVisible(False)
+
+
+def _decryptomatte_connections(gizmo):
+    """ Returns the list of (input number, node) immediate outputs to connect to. """
     connect_to = []
     for node in gizmo.dependent():
         for i in range(node.inputs()):
             input_node = node.input(i)
             if input_node and input_node.fullName() == gizmo.fullName():
-                connect_to.append((i, input_node))
+                connect_to.append((i, node))
+    return connect_to
 
-    # Modifiy expression to perform premult.
-    if unpremultiply and expression:
-        expression = "(%s) / (alpha ? alpha : 1)" % expression
-
-    # Setup expression node.
-    expr_node = nuke.nodes.Expression(
-        inputs=[gizmo], channel0=matte_output, expr0=expression,
-        name="%sExtract" % orig_name, disable=disabled)
-    expr_node.addKnob(nuke.nuke.String_Knob(
-        'origMatteList', 'Original Matte List', matte_list))
-    for knob_name in GIZMO_CHANNEL_KNOBS:
-        expr_node.addKnob(nuke.nuke.Channel_Knob(knob_name, "none") )
-        expr_node.knob(knob_name).setValue(gizmo.knob(knob_name).value())
-        expr_node.knob(knob_name).setVisible(False)
-    new_nodes = [expr_node]
+
+def _decryptomatte_finish(gizmo, new_nodes, connect_to):
+    """ Adds the remove channels and matte only nodes after new_nodes, disables
+    the gizmo and reconnects its outputs. Returns the list of new nodes.
+    """
+    orig_name = gizmo.name()
+    disabled = gizmo.knob("disable").getValue()
+    matte_only = gizmo.knob("matteOnly").value()
+    matte_output = gizmo.knob("matteOutput").value()
+    remove_channels = gizmo.knob("RemoveChannels").value()
 
     # Add remove channels node, if needed.
     if remove_channels:
         channels2 = matte_output if matte_output != "alpha" else ""
         remove = nuke.nodes.Remove(
-            inputs=[expr_node], operation="keep", channels="rgba",
+            inputs=[new_nodes[-1]], operation="keep", channels="rgba",
             channels2=channels2, name="%sRemove" % orig_name,
             disable=disabled)
         new_nodes.append(remove)
@@ -1459,3 +1702,155 @@ def _decryptomatte(gizmo):
     for inputID, node in connect_to:
         node.setInput(inputID, new_nodes[-1])
     return new_nodes
+
+
+def _decryptomatte_batches(gizmos, max_expression_length=None):
+    """ Splits gizmos into ones to decryptomatte on their own, and batches
+    of gizmos with the same input that can share Expression nodes.
+    """
+    import collections
+    singles = []
+    by_source = collections.OrderedDict()
+    for gizmo in gizmos:
+        source = gizmo.input(0)
+        expression = gizmo.knob("expression").value()
+        too_long = max_expression_length and len(expression) > max_expression_length
+        if not source or not expression or too_long or gizmo.knob("disable").getValue():
+            singles.append(gizmo)
+            continue
+        by_source.setdefault(source.fullName(), []).append(gizmo)
+
+    batches = []
+    for batch in by_source.values():
+        if len(batch) > 1:
+            batches.append(batch)
+        else:
+            singles.extend(batch)
+    return singles, batches
+
+
+def _decryptomatte_batch(gizmos):
+    """ Replaces gizmos with the same input, computing their mattes into the
+    channels of DECRYPTOMATTE_BATCH_LAYER, four at a time, and shuffling
+    them into each gizmo's matte output. The shuffles record their gizmo's
+    knobs, as the first Expression node of _decryptomatte does.
+
+    The disabled gizmos of each four are chained in front of their
+    Expression node, which keeps them in the node tree as _decryptomatte
+    does. The batch layer is left in the outputs, unless the gizmo's
+    RemoveChannels removes it along with its other channels.
+
+    Returns list of new nodes, in order of creation.
+    """
+    if not DECRYPTOMATTE_BATCH_LAYER in nuke.layers():
+        nuke.Layer(DECRYPTOMATTE_BATCH_LAYER, [
+            "%s.%s" % (DECRYPTOMATTE_BATCH_LAYER, c) for c in DECRYPTOMATTE_BATCH_CHANNELS])
+
+    num_slots = len(DECRYPTOMATTE_BATCH_CHANNELS)
+    new_nodes = []
+    for start in range(0, len(gizmos), num_slots):
+        batch = gizmos[start:start + num_slots]
+        connections = [_decryptomatte_connections(gizmo) for gizmo in batch]
+        for previous, gizmo in zip(batch, batch[1:]):
+            gizmo.setInput(0, previous)
+
+        expr_knobs = {}
+        for slot, channel in enumerate(DECRYPTOMATTE_BATCH_CHANNELS):
+            expr_knobs["channel%s" % slot] = "none"
+            if slot >= len(batch):
+                continue
+            expression = batch[slot].knob("expression").value()
+            if batch[slot].knob("unpremultiply").value():
+                expression = "(%s) / (alpha ? alpha : 1)" % expression
+            expr_knobs["channel%s" % slot] = "%s.%s" % (DECRYPTOMATTE_BATCH_LAYER, channel)
+            expr_knobs["expr%s" % slot] = expression
+        expr_node = nuke.nodes.Expression(
+            inputs=[batch[-1]], name="%sBatchExtract" % batch[0].name(), **expr_knobs)
+        new_nodes.append(expr_node)
+
+        for slot, (gizmo, connect_to) in enumerate(zip(batch, connections)):
+            shuffle = nuke.nodes.Shuffle(
+                name="%sExtract" % gizmo.name(), inputs=[expr_node])
+            shuffle.knob("in").setValue(DECRYPTOMATTE_BATCH_LAYER)
+            shuffle.knob("out").setValue(gizmo.knob("matteOutput").value())
+            for channel in DECRYPTOMATTE_BATCH_CHANNELS:
+                shuffle.knob(channel).setValue(DECRYPTOMATTE_BATCH_CHANNELS[slot])
+            _decryptomatte_add_gizmo_knobs(shuffle, gizmo)
+            new_nodes += _decryptomatte_finish(gizmo, [shuffle], connect_to)
+    return new_nodes
+
+
+def _decryptomatte_accumulator(matte_output, crypto_channels, unpremultiply):
+    """ Returns the channel chained expression nodes read the partial matte
+    back from, or None if the matte output can't be used to accumulate.
+    """
+    if "." in matte_output or matte_output in ["red", "green", "blue", "alpha"]:
+        output_channels = [matte_output]
+    else:
+        output_channels = [x for x in nuke.channels() if x.split(".")[0] == matte_output]
+    if not output_channels:
+        return None
+    if unpremultiply and any(x in ["alpha", "rgba.alpha"] for x in output_channels):
+        return None  # the original alpha is needed to unpremultiply
+    if any(x.split(".")[0] in crypto_channels for x in output_channels):
+        return None  # would overwrite the IDs and coverage being read
+    return output_channels[0]
+
+
+def _chain_partial_sums(accumulator, partial_sums):
+    """ Returns the expressions of chained Expression nodes, each adding its
+    partial sum to the running sum read back from the accumulator channel.
+
+    The terms are still added left to right, in the same order as the
+    unsplit expression. Rounding the running sum to the float32 accumulator
+    channel between nodes is then exact, as long as the unsplit expression
+    is evaluated in float32 too, as Nuke does.
+    """
+    return partial_sums[:1] + ["%s + %s" % (accumulator, partial) for partial in partial_sums[1:]]
+
+
+def _chunk_by_length(items, separator_length, max_length):
+    """ Splits items into consecutive chunks whose joined length stays within
+    max_length. Chunks always have at least one item.
+    """
+    chunks = []
+    chunk = []
+    length = 0
+    for item in items:
+        item_length = len(item) + separator_length
+        if chunk and length + item_length > max_length:
+            chunks.append(chunk)
+            chunk = []
+            length = 0
+        chunk.append(item)
+        length += item_length
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def _split_extraction_expression(expression, max_length):
+    """ Splits an expression built by _build_extraction_expression() into
+    partial sums, each roughly within max_length, which summed in order give
+    the same result. Terms are kept in rank order, and terms too long on
+    their own are split by ID subsets, of which at most one can match.
+
+    Returns None if the expression is not in the expected form.
+    """
+    terms = expression.split(" + ")
+    if len(terms) < 2 or terms[-1] != "0":
+        return None
+
+    pieces = []
+    for term in terms[:-1]:
+        match = EXTRACTION_TERM_RE.match(term)
+        if not match:
+            return None
+        if len(term) <= max_length:
+            pieces.append(term)
+            continue
+        conditions = match.group("condition").split(" || ")
+        for chunk in _chunk_by_length(conditions, len(" || "), max_length):
+            pieces.append("((%s) ? %s : 0.0)" % (" || ".join(chunk), match.group("coverage")))
+
+    return [" + ".join(chunk + ["0"]) for chunk in _chunk_by_length(pieces, len(" + "), max_length)]
@@ -0,0 +1,860 @@
+#
+#
+#  Copyright (c) 2014, 2015, 2016, 2017 Psyop Media Company, LLC
+#  See license.txt
+#
+#
+
+import os
+import sys
+import time
+
+
+def get_all_benchmarks():
+    """ Returns the list of benchmarks (to run in any context)"""
+    return [bench_extraction_expression, bench_exr_header, bench_exr_decode_threads,
+            bench_exr_pick, bench_extract_matte, bench_extract_all_mattes,
+            bench_extract_mattes_batch, bench_extract_early_exit, bench_extract_bands,
+            bench_bake_sequence, bench_frame_buffers, bench_render_preview,
+            bench_frame_index, bench_object_table, bench_sparse_ranks, bench_incremental_matte,
+            bench_matte_cache, bench_insert_matte, bench_insert_mattes, bench_merge_layers]
+
+
+#############################################
+# Reference implementations
+#############################################
+
+
+def _legacy_build_extraction_expression(channel_list, IDs):
+    """ The 1.4.0 expression builder, nested with str.replace(). Kept as a
+    reference for output equality and timing comparisons. """
+    def _build_condition(condition, IDs):
+        conditions = []
+        for ID in IDs:
+            conditions.append( condition.replace("ID", "{0:.12g}".format(ID)) )
+        return " || ".join(conditions)
+
+    if not IDs:
+        return ""
+    sorted_ids = sorted(IDs)
+    iterated_expression = "({red_condition} ? sub_channel.green : 0.0) + ({blue_condition} ? sub_channel.alpha : 0.0) + more_work_needed"
+
+    subcondition_red =  "sub_channel.red == ID"
+    subcondition_blue = "sub_channel.blue == ID"
+
+    expression = ""
+    for channel in channel_list:
+        condition_r = _build_condition(subcondition_red, sorted_ids)
+        condition_b = _build_condition(subcondition_blue, sorted_ids)
+
+        channel_expression = iterated_expression.replace("red_condition", condition_r).replace("blue_condition", condition_b)
+        channel_expression = channel_expression.replace("sub_channel", channel)
+
+        if not expression:
+            expression = channel_expression
+        else:
+            expression = expression.replace("more_work_needed", channel_expression)
+    expression = expression.replace("more_work_needed", "0")
+
+    expression = expression.replace("{", "(")
+    expression = expression.replace("}", ")")
+
+    return expression
+
+
+#############################################
+# Helpers
+#############################################
+
+
+def _sample_ids(count):
+    import cryptomatte_utilities as cu
+    return [cu.mm3hash_float("object_%s" % i) for i in range(count)]
+
+
+def _sample_channels(count):
+    return ["CryptoObject%02d" % i for i in range(count)]
+
+
+def _sample_exr_paths():
+    import os
+    import glob
+    default_path = os.path.normpath(os.path.join(__file__, "../", "../", "sample_images"))
+    sample_images = os.environ.get("CRYPTOMATTE_TESTING_SAMPLES", "") or default_path
+    return sorted(glob.glob(os.path.join(sample_images, "*.exr")) +
+                  glob.glob(os.path.join(sample_images, "*", "*.exr")))
+
+
+def _write_sample_cryptomatte(path, width=3840, height=2160, layers=3, objects=200,
+                              compression="ZIP"):
+    """ Writes a synthetic cryptomatte EXR: a grid of objects, with the
+    coverage of each pixel split between its object and the next one.
+    Returns the object names.
+    """
+    import json
+    import numpy as np
+    import cryptomatte_exr as ce
+
+    names = ["object_%s" % i for i in range(objects)]
+    ids = np.array(_sample_ids(objects), dtype=np.float32)
+    y, x = np.mgrid[0:height, 0:width]
+    index = (x // 64 + (y // 64) * 61) % objects
+    edge = (x % 64).astype(np.float32) / 64.0
+
+    ranks = layers * 2
+    rank_ids = np.zeros((ranks, height, width), np.float32)
+    rank_coverage = np.zeros((ranks, height, width), np.float32)
+    rank_ids[0], rank_coverage[0] = ids[index], 1.0 - edge * 0.5
+    if ranks > 1:
+        rank_ids[1], rank_coverage[1] = ids[(index + 1) % objects], edge * 0.5
+
+    channels = {}
+    for layer in range(layers):
+        prefix = "CryptoObject%02d." % layer
+        channels[prefix + "R"] = rank_ids[layer * 2]
+        channels[prefix + "G"] = rank_coverage[layer * 2]
+        channels[prefix + "B"] = rank_ids[layer * 2 + 1]
+        channels[prefix + "A"] = rank_coverage[layer * 2 + 1]
+    manifest = dict((name, "%08x" % (ID.view(np.uint32))) for name, ID in zip(names, ids))
+    attributes = {
+        "cryptomatte/f834d0a/name": "CryptoObject",
+        "cryptomatte/f834d0a/hash": "MurmurHash3_32",
+        "cryptomatte/f834d0a/conversion": "uint32_to_float32",
+        "cryptomatte/f834d0a/manifest": json.dumps(manifest),
+    }
+    ce.write_exr(path, channels, compression, attributes)
+    return names
+
+
+def _time_call(func, *args, **kwargs):
+    """ Returns the best wall time of a few runs, in seconds. """
+    repeats = kwargs.pop("repeats", 3)
+    best = None
+    for _ in range(repeats):
+        start = time.time()
+        func(*args)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+#############################################
+# Benchmarks
+#############################################
+
+
+def bench_extraction_expression(id_counts=(10, 1000, 10000), channel_counts=(3, 6, 12)):
+    """ Compares _build_extraction_expression against the 1.4.0 builder. """
+    import cryptomatte_utilities as cu
+
+    rows = []
+    for num_ids in id_counts:
+        ids = _sample_ids(num_ids)
+        for num_channels in channel_counts:
+            channels = _sample_channels(num_channels)
+            expression = cu._build_extraction_expression(channels, ids)
+            if expression != _legacy_build_extraction_expression(channels, ids):
+                raise RuntimeError("Expression mismatch: %s IDs, %s channels" % (
+                    num_ids, num_channels))
+            repeats = 1 if num_ids * num_channels > 10000 else 3
+            legacy = _time_call(_legacy_build_extraction_expression, channels, ids, repeats=repeats)
+            current = _time_call(cu._build_extraction_expression, channels, ids, repeats=repeats)
+            rows.append((num_ids, num_channels, len(expression), legacy, current))
+
+    print("Extraction expression: IDs, channels, length, legacy (s), current (s), speedup")
+    for num_ids, num_channels, length, legacy, current in rows:
+        print("    %6d %3d %10d %10.4f %10.4f %8.1fx" % (
+            num_ids, num_channels, length, legacy, current, legacy / max(current, 1e-9)))
+    return rows
+
+
+def bench_exr_header(repeats=50):
+    """ Times reading cryptomatte info from the sample images' headers. """
+    import cryptomatte_exr as ce
+
+    paths = _sample_exr_paths()
+
+    def read_all():
+        for _ in range(repeats):
+            for path in paths:
+                ce.ExrCryptomatteInfo(path)
+
+    elapsed = _time_call(read_all)
+    reads = max(repeats * len(paths), 1)
+    print("EXR header: %d files x %d, %.4f s, %.1f us per file" % (
+        len(paths), repeats, elapsed, elapsed / reads * 1e6))
+    return elapsed
+
+
+def bench_exr_decode_threads(width=3840, height=2160, layers=3,
+                             thread_counts=(1, 2, 4, 8, 16)):
+    """ Times decoding the ranks of a 4K ZIP cryptomatte with more and more
+    decode threads.
+    """
+    import os
+    import shutil
+    import tempfile
+    import multiprocessing
+    import cryptomatte_exr as ce
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(temp_dir, "bench_decode.exr")
+        _write_sample_cryptomatte(path, width, height, layers)
+        cinfo = ce.ExrCryptomatteInfo(path)
+        rows = []
+        for threads in thread_counts:
+            elapsed = _time_call(cinfo.read_ranks, None, threads)
+            rows.append((threads, elapsed))
+    finally:
+        shutil.rmtree(temp_dir)
+
+    print("EXR decode, %sx%s, %s ranks, %s cores: threads, time (s), speedup" % (
+        width, height, layers * 2, multiprocessing.cpu_count()))
+    for threads, elapsed in rows:
+        print("    %3d %10.4f %8.2fx" % (threads, elapsed, rows[0][1] / max(elapsed, 1e-9)))
+    return rows
+
+
+def bench_exr_pick(width=3840, height=2160, layers=3, compression="ZIP"):
+    """ Compares a full decode with a one pixel pick, in time and bytes read. """
+    import os
+    import shutil
+    import tempfile
+    import cryptomatte_exr as ce
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(temp_dir, "bench_pick.exr")
+        _write_sample_cryptomatte(path, width, height, layers, compression=compression)
+        cinfo = ce.ExrCryptomatteInfo(path)
+        channels = [channel for pair in cinfo.get_rank_channels() for channel in pair]
+        rows = []
+        for label, window in [("full", None), ("pick", (width // 2, height // 2) * 2)]:
+            with ce.ExrScanlineReader(path, threads=1) as reader:
+                elapsed = _time_call(reader.read, channels, None, window, repeats=1)
+                rows.append((label, elapsed, reader.chunks_read, reader.bytes_read))
+        file_size = os.path.getsize(path)
+    finally:
+        shutil.rmtree(temp_dir)
+
+    print("EXR window read, %sx%s, %s ranks, %s, file %d bytes: time (s), chunks, bytes" % (
+        width, height, layers * 2, compression, file_size))
+    for label, elapsed, chunks, bytes_read in rows:
+        print("    %-5s %10.4f %6d %12d" % (label, elapsed, chunks, bytes_read))
+    return rows
+
+
+def _sample_ranks(width=3840, height=2160, layers=3, objects=200):
+    """ Returns the names and decoded (rank_ids, rank_coverage) of a synthetic
+    cryptomatte, see _write_sample_cryptomatte.
+    """
+    import os
+    import shutil
+    import tempfile
+    import cryptomatte_exr as ce
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(temp_dir, "bench_ranks.exr")
+        names = _write_sample_cryptomatte(path, width, height, layers, objects, "ZIPS")
+        rank_ids, rank_coverage = ce.ExrCryptomatteInfo(path).read_ranks()
+    finally:
+        shutil.rmtree(temp_dir)
+    return names, rank_ids, rank_coverage
+
+
+def bench_extract_matte(width=3840, height=2160, layers=3, id_counts=(1, 8, 100, 1000)):
+    """ Times extract_matte on decoded ranks, for growing ID sets. """
+    import cryptomatte_extraction as cx
+
+    names, rank_ids, rank_coverage = _sample_ranks(width, height, layers)
+    all_ids = _sample_ids(max(id_counts))
+    rows = []
+    for num_ids in id_counts:
+        ids = all_ids[:num_ids]
+        elapsed = _time_call(cx.extract_matte, rank_ids, rank_coverage, ids)
+        rows.append((num_ids, elapsed))
+
+    print("Extract matte, %sx%s, %s ranks: IDs, time (s), frames per second" % (
+        width, height, layers * 2))
+    for num_ids, elapsed in rows:
+        print("    %6d %10.4f %8.1f" % (num_ids, elapsed, 1.0 / max(elapsed, 1e-9)))
+    return rows
+
+
+def bench_extract_all_mattes(width=3840, height=2160, layers=3, objects=3000, samples=10):
+    """ Compares extract_all_mattes with one extract_matte per object,
+    extrapolated from a few objects.
+    """
+    import cryptomatte_extraction as cx
+
+    names, rank_ids, rank_coverage = _sample_ranks(width, height, layers, objects)
+    manifest = dict(zip(names, _sample_ids(objects)))
+    all_mattes = _time_call(cx.extract_all_mattes, rank_ids, rank_coverage, manifest, repeats=1)
+    single = _time_call(lambda: [cx.extract_matte(rank_ids, rank_coverage, [manifest[name]])
+                                 for name in names[:samples]], repeats=1) / samples
+
+    print("All mattes, %sx%s, %s ranks, %s objects:" % (width, height, layers * 2, objects))
+    print("    one pass %10.4f s" % all_mattes)
+    print("    per matte %9.4f s (estimated from %s)" % (single * objects, samples))
+    return all_mattes, single * objects
+
+
+def bench_extract_mattes_batch(width=3840, height=2160, layers=3, objects=300,
+                               matte_counts=(1, 10, 50)):
+    """ Compares extract_mattes with one extract_matte per matte list, for
+    matte lists of up to 10 random objects.
+    """
+    import random
+    import cryptomatte_extraction as cx
+
+    names, rank_ids, rank_coverage = _sample_ranks(width, height, layers, objects)
+    ids = _sample_ids(objects)
+    rand = random.Random(0)
+    rows = []
+    for num_mattes in matte_counts:
+        id_sets = [rand.sample(ids, rand.randint(1, 10)) for _ in range(num_mattes)]
+        batch = _time_call(cx.extract_mattes, rank_ids, rank_coverage, id_sets, repeats=1)
+        single = _time_call(
+            lambda: [cx.extract_matte(rank_ids, rank_coverage, x) for x in id_sets], repeats=1)
+        rows.append((num_mattes, batch, single))
+
+    print("Matte batch, %sx%s, %s ranks: mattes, batch (s), one by one (s), speedup" % (
+        width, height, layers * 2))
+    for num_mattes, batch, single in rows:
+        print("    %4d %10.4f %10.4f %8.1fx" % (num_mattes, batch, single, single / max(batch, 1e-9)))
+    return rows
+
+
+def bench_extract_early_exit(repeats=20):
+    """ Compares extract_matte with and without early exit on the scanline
+    sample images, for one object and for every object of the manifest.
+    """
+    import numpy as np
+    import cryptomatte_exr as ce
+    import cryptomatte_extraction as cx
+
+    rows = []
+    for path in _sample_exr_paths():
+        cinfo = ce.ExrCryptomatteInfo(path)
+        if cinfo.header.parts[0].tiled or not cinfo.is_valid():
+            continue
+        rank_ids, rank_coverage = cinfo.read_ranks()
+        active = [np.count_nonzero(coverage) for coverage in rank_coverage]
+        evaluated = float(rank_ids[0].size + sum(active[1:])) / rank_ids.size
+        manifest_ids = list(cinfo.parse_manifest().values())
+        for ids in [manifest_ids[:1], manifest_ids]:
+            times = []
+            for early_exit in [False, True]:
+                times.append(_time_call(lambda: [
+                    cx.extract_matte(rank_ids, rank_coverage, ids, early_exit=early_exit)
+                    for _ in range(repeats)]) / repeats)
+            rows.append((os.path.basename(path), len(rank_ids), len(ids), evaluated) + tuple(times))
+
+    print("Early exit: image, ranks, IDs, rank pixels evaluated, all ranks (s), early exit (s), speedup")
+    for name, ranks, num_ids, evaluated, full, early in rows:
+        print("    %-36s %3d %4d %6.1f%% %10.5f %10.5f %6.2fx" % (
+            name, ranks, num_ids, evaluated * 100, full, early, full / max(early, 1e-9)))
+    return rows
+
+
+def bench_extract_bands(width=3840, height=2160, layers=3, band_heights=(16, 64, 256)):
+    """ Compares the time and peak memory of writing a matte from a whole
+    frame with the banded pipeline.
+    """
+    import shutil
+    import tempfile
+    import tracemalloc
+    import cryptomatte_exr as ce
+    import cryptomatte_extraction as cx
+
+    def whole_frame(cinfo, ids, path):
+        rank_ids, rank_coverage = cinfo.read_ranks()
+        matte = cx.extract_matte(rank_ids, rank_coverage, ids)
+        ce.write_exr(path, {"A": matte}, data_window=cinfo.header.parts[0].data_window[:2])
+
+    def measure(func, *args):
+        tracemalloc.start()
+        start = time.time()
+        func(*args)
+        elapsed = time.time() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return elapsed, peak
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        source = os.path.join(temp_dir, "bench_source.exr")
+        _write_sample_cryptomatte(source, width, height, layers)
+        cinfo = ce.ExrCryptomatteInfo(source)
+        ids = _sample_ids(3)
+        output = os.path.join(temp_dir, "bench_matte.exr")
+        rows = [("frame",) + measure(whole_frame, cinfo, ids, output)]
+        for band_height in band_heights:
+            rows.append(("band %s" % band_height,) + measure(
+                cx.write_matte, cinfo, ids, output, band_height))
+    finally:
+        shutil.rmtree(temp_dir)
+
+    print("Banded extraction, %sx%s, %s ranks: time (s), peak memory (MB)" % (
+        width, height, layers * 2))
+    for label, elapsed, peak in rows:
+        print("    %-10s %10.4f %10.1f" % (label, elapsed, peak / 1e6))
+    return rows
+
+
+def bench_bake_sequence(width=1920, height=1080, layers=3, frames=8,
+                        process_counts=(1, 2, 4, 8)):
+    """ Times baking a synthetic sequence with the command line's process pool. """
+    import shutil
+    import tempfile
+    import multiprocessing
+    import cryptomatte
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        input_pattern = os.path.join(temp_dir, "bench_source.%04d.exr")
+        for frame in range(1, frames + 1):
+            _write_sample_cryptomatte(cryptomatte._frame_path(input_pattern, frame),
+                                      width, height, layers)
+        rows = []
+        for processes in process_counts:
+            output_pattern = os.path.join(temp_dir, "out%s" % processes, "matte.%04d.exr")
+            args = cryptomatte._parse_args([input_pattern, "-o", output_pattern,
+                                            "-m", "object_1*, object_2*"])
+            jobs = cryptomatte.make_jobs(args)
+            start = time.time()
+            cryptomatte.bake_sequence(jobs, processes)
+            rows.append((processes, time.time() - start))
+    finally:
+        shutil.rmtree(temp_dir)
+
+    print("Bake sequence, %s frames of %sx%s, %s ranks, %s cores: processes, time (s), "
+          "frames per second, speedup" % (frames, width, height, layers * 2,
+                                          multiprocessing.cpu_count()))
+    for processes, elapsed in rows:
+        print("    %3d %10.4f %8.2f %8.2fx" % (processes, elapsed, frames / elapsed,
+                                              rows[0][1] / max(elapsed, 1e-9)))
+    return rows
+
+
+def bench_frame_buffers(width=3840, height=2160, layers=3, frames=6):
+    """ Times a frame loop writing mattes band by band, allocating buffers per
+    frame or reusing one BufferPool, with the pool's allocation counters.
+    """
+    import shutil
+    import tempfile
+    import cryptomatte_exr as ce
+    import cryptomatte_extraction as cx
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(temp_dir, "bench_source.exr")
+        names = _write_sample_cryptomatte(path, width, height, layers)
+        rows = []
+        for label, buffers in [("per frame", None), ("pool", ce.BufferPool())]:
+            times, allocations = [], []
+            for frame in range(frames):
+                before = buffers.allocations if buffers else 0
+                start = time.time()
+                cinfo = ce.ExrCryptomatteInfo(path)
+                ids = [cinfo.name_to_ID(name) for name in names[:10]]
+                cx.write_matte(cinfo, ids, os.path.join(temp_dir, "matte.exr"), threads=1,
+                               buffers=buffers)
+                times.append(time.time() - start)
+                allocations.append(buffers.allocations - before if buffers else None)
+            rows.append((label, times, allocations))
+    finally:
+        shutil.rmtree(temp_dir)
+
+    print("Frame buffers, %s frames of %sx%s, %s ranks: first frame (s), later frames (s), "
+          "pool allocations per frame" % (frames, width, height, layers * 2))
+    for label, times, allocations in rows:
+        print("    %-10s %8.4f %8.4f   %s" % (label, times[0], min(times[1:]),
+                                            allocations if allocations[0] is not None else "-"))
+    return rows
+
+
+def bench_render_preview(width=3840, height=2160, layers=3, frames=8):
+    """ Times rendering the preview modes of decoded ranks, and a contact
+    sheet of a sequence.
+    """
+    import shutil
+    import tempfile
+    import cryptomatte_preview as cp
+
+    names, rank_ids, rank_coverage = _sample_ranks(width, height, layers)
+    rows = []
+    for mode, ranks in [("Colors", 4), ("Colors", None), ("Edges", 4)]:
+        rows.append(("%s, %s ranks" % (mode, ranks or len(rank_ids)),
+                     _time_call(cp.render_preview, rank_ids, rank_coverage, mode, ranks)))
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        paths = [os.path.join(temp_dir, "bench_source.%04d.exr" % frame) for frame in range(frames)]
+        for path in paths:
+            _write_sample_cryptomatte(path, width // 2, height // 2, layers)
+        rows.append(("contact sheet, %s frames" % frames,
+                     _time_call(cp.contact_sheet, paths, "Colors", 4, None, 4, 8, repeats=1)))
+    finally:
+        shutil.rmtree(temp_dir)
+
+    print("Preview rendering, %sx%s, %s ranks: time (s)" % (width, height, layers * 2))
+    for label, elapsed in rows:
+        print("    %-28s %8.4f" % (label, elapsed))
+    return rows
+
+
+def bench_frame_index(width=1920, height=1080, layers=3, frames=20, frames_with_object=2):
+    """ Times baking an object that is in only a few frames of a sequence,
+    decoding every frame or skipping the others with the frame index.
+    """
+    import shutil
+    import tempfile
+    import cryptomatte
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        input_pattern = os.path.join(temp_dir, "bench_source.%04d.exr")
+        for frame in range(1, frames + 1):
+            # object_150 only exists in frames with 200 objects.
+            objects = 200 if frame <= frames_with_object else 100
+            _write_sample_cryptomatte(cryptomatte._frame_path(input_pattern, frame),
+                                      width, height, layers, objects)
+        rows = []
+        for label, extra_args in [("decode all", []), ("build index", ["--index"]),
+                                  ("with index", ["--index"])]:
+            output_pattern = os.path.join(temp_dir, "out", "matte.%04d.exr")
+            args = cryptomatte._parse_args([input_pattern, "-o", output_pattern, "-m",
+                                            "object_150", "-j", "1", "--overwrite"] + extra_args)
+            jobs = cryptomatte.make_jobs(args)
+            start = time.time()
+            if args.index:
+                path = cryptomatte.update_frame_index(jobs, args.input, args.layer, 1)
+                for job in jobs:
+                    job.options["index"] = path
+            cryptomatte.bake_sequence(jobs, 1)
+            rows.append((label, time.time() - start))
+    finally:
+        shutil.rmtree(temp_dir)
+
+    print("Frame index, object in %s of %s frames of %sx%s: time (s)" % (
+        frames_with_object, frames, width, height))
+    for label, elapsed in rows:
+        print("    %-12s %8.4f" % (label, elapsed))
+    return rows
+
+
+def bench_object_table(width=3840, height=2160, layers=3, objects=3000):
+    """ Times computing the table of object bounding boxes and areas of a
+    frame, and extracting a matte over an object's window rather than the
+    whole frame.
+    """
+    import shutil
+    import tempfile
+    import cryptomatte_exr as ce
+    import cryptomatte_index as ci
+    import cryptomatte_extraction as cx
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(temp_dir, "bench_source.exr")
+        _write_sample_cryptomatte(path, width, height, layers, objects)
+        cinfo = ce.ExrCryptomatteInfo(path)
+        start = time.time()
+        table = ci.object_table(cinfo, threads=1)
+        table_time = time.time() - start
+
+        ids = [cinfo.name_to_ID("object_1500")]
+        window = table.window(ids)
+
+        def whole_frame():
+            rank_ids, rank_coverage = cinfo.read_ranks(threads=1)
+            return cx.extract_matte(rank_ids, rank_coverage, ids)
+
+        frame_time = _time_call(whole_frame)
+        window_time = _time_call(cx.extract_matte_window, cinfo, ids, window, 1)
+    finally:
+        shutil.rmtree(temp_dir)
+
+    print("Object table, %sx%s, %s ranks, %s objects: time (s)" % (
+        width, height, layers * 2, len(table)))
+    print("    table                %8.4f" % table_time)
+    print("    extract, frame       %8.4f" % frame_time)
+    print("    extract, window      %8.4f  %s" % (window_time, window))
+    return table_time, frame_time, window_time
+
+
+def bench_sparse_ranks(width=3840, height=2160, layers=3, queries=50):
+    """ Compares queries of one to ten objects on dense ranks and on sparse
+    ranks, loaded memory mapped.
+    """
+    import random
+    import shutil
+    import tempfile
+    import numpy as np
+    import cryptomatte_extraction as cx
+
+    names, rank_ids, rank_coverage = _sample_ranks(width, height, layers)
+    ids = _sample_ids(len(names))
+    rand = random.Random(3)
+    id_sets = [rand.sample(ids, rand.randint(1, 10)) for _ in range(queries)]
+
+    start = time.time()
+    sparse = cx.sparse_ranks(rank_ids, rank_coverage)
+    convert_time = time.time() - start
+    temp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(temp_dir, "sparse")
+        sparse.save(path)
+        size = sum(os.path.getsize(os.path.join(path, x)) for x in os.listdir(path))
+        loaded = cx.load_sparse_ranks(path)
+        out = np.empty(rank_ids[0].shape, np.float32)
+        rows = []
+        dense = lambda ranks, ids: cx.extract_matte(ranks[0], ranks[1], ids, out)
+        sparse_query = lambda ranks, ids: ranks.extract(ids, out)
+        for label, query, ranks in [
+                ("dense", dense, (rank_ids, rank_coverage)),
+                ("sparse", sparse_query, sparse),
+                ("sparse, mmap", sparse_query, loaded)]:
+            start = time.time()
+            for ids in id_sets:
+                query(ranks, ids)
+            rows.append((label, queries / (time.time() - start)))
+        # Release the memory maps, so the files can be removed on Windows.
+        del loaded, ranks
+    finally:
+        shutil.rmtree(temp_dir)
+
+    print("Sparse ranks, %sx%s, %s ranks: %s entries (%.1f%% of dense), converted in %.2f s, "
+          "%.0f MB on disk" % (width, height, layers * 2, len(sparse),
+                              100.0 * len(sparse) / rank_ids.size, convert_time, size / 1e6))
+    print("    queries per second:")
+    for label, rate in rows:
+        print("    %-14s %8.1f" % (label, rate))
+    return rows
+
+
+def bench_incremental_matte(width=3840, height=2160, layers=3, list_size=100, clicks=10):
+    """ Times adding objects one click at a time to a matte list of
+    list_size objects, extracting the whole matte each time, or updating it.
+    """
+    import cryptomatte_extraction as cx
+
+    names, rank_ids, rank_coverage = _sample_ranks(width, height, layers)
+    ids = _sample_ids(len(names))
+    lists = [ids[:list_size + click] for click in range(clicks + 1)]
+    sparse = cx.sparse_ranks(rank_ids, rank_coverage)
+
+    def full(id_lists):
+        for id_list in id_lists:
+            cx.extract_matte(rank_ids, rank_coverage, id_list)
+
+    def incremental(ranks, id_lists):
+        matte = cx.IncrementalMatte()
+        matte.matte(0, ranks, id_lists[0])
+        start = time.time()
+        for id_list in id_lists[1:]:
+            matte.matte(0, ranks, id_list)
+        return time.time() - start
+
+    rows = [("full", _time_call(full, lists[1:], repeats=1) / clicks),
+            ("incremental", incremental((rank_ids, rank_coverage), lists) / clicks),
+            ("incremental, sparse", incremental(sparse, lists) / clicks)]
+    print("Incremental matte, %sx%s, %s ranks, list of %s objects: time per click (s)" % (
+        width, height, layers * 2, list_size))
+    for label, elapsed in rows:
+        print("    %-20s %8.4f" % (label, elapsed))
+    return rows
+
+
+def bench_matte_cache(width=3840, height=2160, layers=3):
+    """ Times extracting a matte from a file against cache hits, with each
+    storage option, and reports the size of each cached matte.
+    """
+    import shutil
+    import tempfile
+    import numpy as np
+    import cryptomatte_cache as cc
+    import cryptomatte_exr as ce
+    import cryptomatte_extraction as cx
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(temp_dir, "bench_source.exr")
+        names = _write_sample_cryptomatte(path, width, height, layers)
+        cinfo = ce.ExrCryptomatteInfo(path)
+        ids = [cinfo.name_to_ID(name) for name in names[:5]]
+
+        def extract():
+            rank_ids, rank_coverage = cinfo.read_ranks(threads=1)
+            return cx.extract_matte(rank_ids, rank_coverage, ids)
+
+        rows = [("extract", _time_call(extract), None)]
+        for label, dtype, crop, compress in [("float32", np.float32, False, False),
+                                             ("float16", np.float16, False, False),
+                                             ("float16, cropped, zlib", np.float16, True, True)]:
+            cache = cc.MatteCache(os.path.join(temp_dir, label), dtype=dtype, crop=crop,
+                                  compress=compress)
+            cache.matte(cinfo, ids)
+            rows.append(("hit, " + label, _time_call(lambda: np.asarray(cache.get(cinfo, ids)[1])),
+                         cache.size()))
+    finally:
+        shutil.rmtree(temp_dir)
+
+    print("Matte cache, %sx%s, %s ranks: time (s), size (MB)" % (width, height, layers * 2))
+    for label, elapsed, size in rows:
+        print("    %-28s %8.4f %8s" % (label, elapsed, "%.3f" % (size / 1e6) if size else "-"))
+    return rows
+
+
+def bench_insert_matte(width=3840, height=2160, layers=3):
+    """ Times inserting a matte into decoded ranks, over and under, and
+    writing the result as a cryptomatte.
+    """
+    import shutil
+    import tempfile
+    import numpy as np
+    import cryptomatte_encoding as ck
+    import cryptomatte_exr as ce
+
+    names, rank_ids, rank_coverage = _sample_ranks(width, height, layers)
+    alpha = np.random.RandomState(0).rand(height, width).astype(np.float32)
+    rows = []
+    for operation in ck.MERGE_OPERATIONS:
+        rows.append((operation, _time_call(ck.insert_matte, rank_ids, rank_coverage, alpha,
+                                           "inserted", operation=operation)))
+    new_ids, new_coverage, manifest = ck.insert_matte(rank_ids, rank_coverage, alpha, "inserted")
+    temp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(temp_dir, "bench_encrypted.exr")
+        rows.append(("write", _time_call(ce.write_cryptomatte, path, new_ids, new_coverage,
+                                         "CryptoObject", manifest, repeats=1)))
+    finally:
+        shutil.rmtree(temp_dir)
+
+    print("Matte insertion, %sx%s, %s ranks: time (s)" % (width, height, layers * 2))
+    for label, elapsed in rows:
+        print("    %-10s %8.4f" % (label, elapsed))
+    return rows
+
+
+def bench_insert_mattes(width=1920, height=1080, layers=3, num_mattes=40):
+    """ Times inserting many roto-like mattes at once against a chain of
+    single inserts.
+    """
+    import numpy as np
+    import cryptomatte_encoding as ck
+
+    names, rank_ids, rank_coverage = _sample_ranks(width, height, layers)
+    rng = np.random.RandomState(0)
+    mattes = []
+    for index in range(num_mattes):
+        alpha = np.zeros((height, width), np.float32)
+        x, y = rng.randint(0, width // 2), rng.randint(0, height // 2)
+        alpha[y:y + height // 3, x:x + width // 3] = rng.rand()
+        mattes.append(("roto%d" % index, alpha))
+
+    def chain():
+        ids, coverage, manifest = rank_ids, rank_coverage, {}
+        for name, alpha in mattes:
+            ids, coverage, manifest = ck.insert_matte(ids, coverage, alpha, name, manifest)
+
+    rows = [("chain", _time_call(chain, repeats=1)),
+            ("batch", _time_call(ck.insert_mattes, rank_ids, rank_coverage, mattes, repeats=1))]
+    print("Inserting %s mattes, %sx%s, %s ranks: time (s)" % (
+        num_mattes, width, height, layers * 2))
+    for label, elapsed in rows:
+        print("    %-10s %8.4f" % (label, elapsed))
+    return rows
+
+
+def bench_merge_layers(width=3840, height=2160, layers=3):
+    """ Times merging two cryptomatte layers, as decoded ranks and as files
+    streamed in bands, with the peak memory allocated by each.
+    """
+    import shutil
+    import tempfile
+    import cryptomatte_utilities as cu
+    import cryptomatte_encoding as ck
+    import cryptomatte_exr as ce
+    try:
+        import tracemalloc
+    except ImportError:
+        tracemalloc = None
+
+    def peak_call(func, *args, **kwargs):
+        if tracemalloc is None:
+            return None
+        tracemalloc.start()
+        try:
+            func(*args, **kwargs)
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        path_a = os.path.join(temp_dir, "bench_characters.exr")
+        path_b = os.path.join(temp_dir, "bench_environment.exr")
+        output_path = os.path.join(temp_dir, "bench_merged.exr")
+        _write_sample_cryptomatte(path_a, width, height, layers)
+        cinfo = ce.ExrCryptomatteInfo(path_a)
+        rank_ids, rank_coverage = cinfo.read_ranks()
+        manifest = dict((name, cu.id_to_hex(ID)) for name, ID in cinfo.parse_manifest().items())
+        # The same objects, upside down, so some pixels share IDs.
+        ids_b, coverage_b = rank_ids[:, ::-1].copy(), rank_coverage[:, ::-1].copy()
+        ce.write_cryptomatte(path_b, ids_b, coverage_b, "CryptoObject", manifest)
+
+        rows = [("ranks", _time_call(ck.merge_ranks, rank_ids, rank_coverage, ids_b, coverage_b),
+                 peak_call(ck.merge_ranks, rank_ids, rank_coverage, ids_b, coverage_b))]
+        del rank_ids, rank_coverage, ids_b, coverage_b
+        for band_height in [16, 64, 256]:
+            rows.append(("files, %s lines" % band_height,
+                         _time_call(ck.merge_cryptomatte_files, path_a, path_b, output_path,
+                                    band_height=band_height, repeats=1),
+                         peak_call(ck.merge_cryptomatte_files, path_a, path_b, output_path,
+                                   band_height=band_height)))
+    finally:
+        shutil.rmtree(temp_dir)
+
+    print("Layer merge, %sx%s, %s + %s ranks: time (s), peak memory (MB)" % (
+        width, height, layers * 2, layers * 2))
+    for label, elapsed, peak in rows:
+        print("    %-18s %8.4f %8s" % (label, elapsed, "%.1f" % (peak / 1e6) if peak else "-"))
+    return rows
+
+
+#############################################
+# Ad hoc benchmark running
+#############################################
+
+
+def run_benchmarks(benchmark_filter=""):
+    """ Utility function for manually running benchmarks.
+
+    Args:
+        benchmark_filter will be matched fnmatch style (* wildcards) to the name
+        of the benchmark function.
+    """
+    import fnmatch
+    import platform
+    import cryptomatte_utilities as cu
+
+    results = {}
+    for benchmark in get_all_benchmarks():
+        if benchmark_filter and not fnmatch.fnmatchcase(benchmark.__name__, benchmark_filter):
+            continue
+        results[benchmark.__name__] = benchmark()
+
+    print("---------")
+    print('Cryptomatte %s, Python %s, %s' % (cu.__version__,
+                                             sys.version.split()[0],
+                                             platform.platform()))
+    print("---------")
+    return results
+
+
+if __name__ == "__main__":
+    run_benchmarks(sys.argv[1] if len(sys.argv) > 1 else "")
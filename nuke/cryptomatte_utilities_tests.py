@@ -11,7 +11,10 @@ import unittest
 
 def get_all_unit_tests():
     """ Returns the list of unit tests (to run in any context)"""
-    return [CSVParsing, CryptoHashing]
+    return [CSVParsing, CryptoHashing, ExpressionBuilding, ExpressionSplitting,
+            ExpressionCaching, KnobWriting, ExrHeaderReading, ExrPixelDecoding,
+            Decryptomatting, MatteExtraction, SequenceBaking, PreviewRendering, MatteCaching,
+            MatteEncoding]
 
 
 def get_all_nuke_tests():
@@ -38,6 +41,32 @@ def set_skip_cleanup_on_failure(enabled):
     CRYPTOMATTETEST_SKIP_CLEANUP_ON_FAILURE = enabled
 
 
+def _sample_images_dir():
+    import os
+    default_path = os.path.normpath(os.path.join(__file__, "../", "../", "sample_images"))
+    return os.environ.get(SAMPLES_IMAGES_DIR_ENVIRON, "") or default_path
+
+
+def _StringIO():
+    try:
+        from StringIO import StringIO  # Python 2.7
+    except ImportError:
+        from io import StringIO
+    return StringIO()
+
+
+def _numpy_available():
+    try:
+        import numpy
+    except ImportError:
+        return False
+    return True
+
+
+# The headless decoding and extraction tests need numpy, which Nuke may not have.
+skip_without_numpy = unittest.skipIf(not _numpy_available(), "numpy is not available")
+
+
 def reset_skip_cleanup_on_failure():
     global CRYPTOMATTETEST_SKIP_CLEANUP_ON_FAILURE
     CRYPTOMATTETEST_SKIP_CLEANUP_ON_FAILURE = False
@@ -48,6 +77,123 @@ def reset_skip_cleanup_on_failure():
 #############################################
 
 
+class FakeKnob(object):
+    """ Stands in for a Nuke knob in unit tests, counting writes. """
+
+    def __init__(self, value):
+        self.writes = 0
+        self.visible = True
+        self._value = value
+
+    def value(self):
+        return self._value
+
+    def getValue(self):
+        return self._value
+
+    def setValue(self, value):
+        self.writes += 1
+        self._value = value
+
+    def setEnabled(self, enabled):
+        pass
+
+    def setValues(self, values):
+        pass
+
+    def setVisible(self, visible):
+        self.visible = visible
+
+
+class FakeNode(object):
+    """ Stands in for a Nuke node with the given knob values in unit tests. """
+
+    def __init__(self, **knob_values):
+        self._knobs = dict((name, FakeKnob(value)) for name, value in knob_values.items())
+
+    def knob(self, name):
+        return self._knobs[name]
+
+    def writes(self):
+        return sum(knob.writes for knob in self._knobs.values())
+
+
+class FakeGraphNode(FakeNode):
+    """ Stands in for a Nuke node in a FakeNuke graph, with knobs added on first use. """
+
+    def __init__(self, graph, node_class, name, inputs, **knob_values):
+        super(FakeGraphNode, self).__init__(**knob_values)
+        self._graph = graph
+        self._class = node_class
+        self._name = name
+        self._inputs = list(inputs)
+
+    def Class(self):
+        return self._class
+
+    def name(self):
+        return self._name
+
+    def fullName(self):
+        return self._name
+
+    def knob(self, name):
+        return self._knobs.setdefault(name, FakeKnob(None))
+
+    def addKnob(self, knob):
+        name, knob = knob
+        self._knobs[name] = knob
+
+    def inputs(self):
+        return len(self._inputs)
+
+    def input(self, i):
+        return self._inputs[i] if i < len(self._inputs) else None
+
+    def setInput(self, i, node):
+        self._inputs[i] = node
+
+    def dependent(self):
+        return [node for node in self._graph.created if self in node._inputs]
+
+
+class FakeNuke(object):
+    """ Stands in for the nuke module in unit tests of node graph building,
+    recording the nodes created. """
+
+    class Nodes(object):
+        def __init__(self, graph):
+            self._graph = graph
+
+        def __getattr__(self, node_class):
+            return lambda name="", inputs=(), **knobs: self._graph.create(
+                node_class, name, inputs, **knobs)
+
+    def __init__(self):
+        self.nuke = self
+        self.nodes = FakeNuke.Nodes(self)
+        self.created = []
+        self._layers = ["rgba", "uCryptoAsset"]
+
+    def create(self, node_class, name="", inputs=(), **knobs):
+        node = FakeGraphNode(self, node_class, name, inputs, **knobs)
+        self.created.append(node)
+        return node
+
+    def layers(self):
+        return list(self._layers)
+
+    def Layer(self, name, channels):
+        self._layers.append(name)
+
+    def String_Knob(self, name, label, value):
+        return name, FakeKnob(value)
+
+    def Channel_Knob(self, name, value):
+        return name, FakeKnob(value)
+
+
+
 class CSVParsing(unittest.TestCase):
     long_csv = (b"""str, "str with space", "single 'quotes'", """
                b'"with_a,_comma", "with comma, and \\"quotes\\"", <123.45>, '
@@ -114,6 +260,1543 @@ class CryptoHashing(unittest.TestCase):
             self.assertEqual(cu.mm3hash_float(name), cu.single_precision(hashvalue), msg)
 
 
+class ExpressionBuilding(unittest.TestCase):
+    def test_extraction_expression(self):
+        import cryptomatte_utilities as cu
+        expression = cu._build_extraction_expression(["c00", "c01"], [1.5, -2e20])
+        self.assertEqual(expression, (
+            "((c00.red == -2e+20 || c00.red == 1.5) ? c00.green : 0.0) + "
+            "((c00.blue == -2e+20 || c00.blue == 1.5) ? c00.alpha : 0.0) + "
+            "((c01.red == -2e+20 || c01.red == 1.5) ? c01.green : 0.0) + "
+            "((c01.blue == -2e+20 || c01.blue == 1.5) ? c01.alpha : 0.0) + 0"))
+
+    def test_extraction_expression_empty(self):
+        import cryptomatte_utilities as cu
+        self.assertEqual(cu._build_extraction_expression(["c00"], []), "")
+        self.assertEqual(cu._build_extraction_expression([], [1.5]), "")
+
+    def test_extraction_expression_matches_legacy(self):
+        import cryptomatte_utilities as cu
+        import cryptomatte_utilities_benchmarks as cu_benchmarks
+        ids = [cu.mm3hash_float("object_%s" % i) for i in range(50)] + [0.0]
+        for num_channels in [1, 3, 12]:
+            channels = ["crypto%02d" % i for i in range(num_channels)]
+            self.assertEqual(
+                cu._build_extraction_expression(channels, ids),
+                cu_benchmarks._legacy_build_extraction_expression(channels, ids))
+
+
+class ExpressionSplitting(unittest.TestCase):
+    channels = ["crypto00", "crypto01", "crypto02"]
+
+    def evaluate(self, expression, pixel):
+        """ Evaluates an extraction expression on a dict of channel values,
+        summing left to right as Nuke would. """
+        import cryptomatte_utilities as cu
+        total = 0.0
+        for term in expression.split(" + ")[:-1]:
+            match = cu.EXTRACTION_TERM_RE.match(term)
+            conditions = [x.split(" == ") for x in match.group("condition").split(" || ")]
+            if any(pixel[chan] == float(literal) for chan, literal in conditions):
+                total += pixel[match.group("coverage")]
+        return total
+
+    def sample_pixels(self, ids):
+        import random
+        rand = random.Random(7)
+        pixels = []
+        for _ in range(200):
+            pixel = {}
+            for channel in self.channels:
+                for id_suffix, cov_suffix in [('.red', '.green'), ('.blue', '.alpha')]:
+                    pixel[channel + id_suffix] = rand.choice(ids + [0.0, 1.0])
+                    pixel[channel + cov_suffix] = rand.random()
+            pixels.append(pixel)
+        return pixels
+
+    def test_split_ranks(self):
+        import cryptomatte_utilities as cu
+        ids = [cu.mm3hash_float("object_%s" % i) for i in range(3)]
+        expression = cu._build_extraction_expression(self.channels, ids)
+        partial_sums = cu._split_extraction_expression(expression, len(expression) // 3)
+        self.assertEqual(len(partial_sums), 3)
+        joined = " + ".join(x[:-len(" + 0")] for x in partial_sums) + " + 0"
+        self.assertEqual(joined, expression)
+
+    def test_split_ids(self):
+        import cryptomatte_utilities as cu
+        ids = [cu.mm3hash_float("object_%s" % i) for i in range(40)]
+        expression = cu._build_extraction_expression(self.channels, ids)
+        max_length = 200
+        partial_sums = cu._split_extraction_expression(expression, max_length)
+        self.assertTrue(len(partial_sums) > 6)
+        for partial in partial_sums:
+            self.assertTrue(len(partial) < max_length * 1.5, "Partial sum too long: %s" % partial)
+        for pixel in self.sample_pixels(ids):
+            self.assertEqual(self.evaluate(expression, pixel),
+                             sum(self.evaluate(x, pixel) for x in partial_sums))
+
+    def test_split_chained_float32(self):
+        """ Chained partial sums, stored in a float32 channel between nodes,
+        match the unsplit expression evaluated in float32.
+        """
+        import struct
+        import cryptomatte_utilities as cu
+
+        def float32(value):
+            return struct.unpack("f", struct.pack("f", value))[0]
+
+        def evaluate_float32(expression, pixel):
+            total = 0.0
+            for term in expression.split(" + ")[:-1]:
+                match = cu.EXTRACTION_TERM_RE.match(term)
+                if not match:
+                    total = float32(total + pixel[term])  # the accumulator
+                    continue
+                conditions = [x.split(" == ") for x in match.group("condition").split(" || ")]
+                if any(pixel[chan] == float(literal) for chan, literal in conditions):
+                    total = float32(total + pixel[match.group("coverage")])
+            return total
+
+        ids = [cu.mm3hash_float("object_%s" % i) for i in range(40)]
+        expression = cu._build_extraction_expression(self.channels, ids)
+        chain = cu._chain_partial_sums("alpha", cu._split_extraction_expression(expression, 200))
+        self.assertTrue(len(chain) > 6)
+        for pixel in self.sample_pixels(ids):
+            pixel = dict((chan, float32(value)) for chan, value in pixel.items())
+            for partial in chain:
+                pixel["alpha"] = evaluate_float32(partial, pixel)
+            self.assertEqual(evaluate_float32(expression, pixel), pixel["alpha"])
+
+    def test_split_unexpected(self):
+        import cryptomatte_utilities as cu
+        self.assertIsNone(cu._split_extraction_expression("", 10))
+        self.assertIsNone(cu._split_extraction_expression("alpha + 0", 10))
+
+
+class ExpressionCaching(unittest.TestCase):
+    def setUp(self):
+        import cryptomatte_utilities as cu
+        cu.reset_expression_cache()
+
+    def tearDown(self):
+        import cryptomatte_utilities as cu
+        cu.reset_expression_cache()
+
+    def test_cache_hit(self):
+        import cryptomatte_utilities as cu
+        calls = []
+
+        def builder(value):
+            calls.append(value)
+            return value * 2
+
+        cache = cu.ExpressionCache(max_size=2)
+        self.assertEqual(cache.get("a", builder, 1), 2)
+        self.assertEqual(cache.get("a", builder, 1), 2)
+        self.assertEqual(calls, [1])
+
+    def test_cache_eviction(self):
+        import cryptomatte_utilities as cu
+        calls = []
+
+        def builder(value):
+            calls.append(value)
+            return value
+
+        cache = cu.ExpressionCache(max_size=2)
+        cache.get("a", builder, 1)
+        cache.get("b", builder, 2)
+        cache.get("a", builder, 1)  # a is now most recently used
+        cache.get("c", builder, 3)  # evicts b
+        self.assertEqual(len(cache), 2)
+        cache.get("a", builder, 1)
+        cache.get("b", builder, 2)
+        self.assertEqual(calls, [1, 2, 3, 2])
+
+    def test_cache_eviction_by_size(self):
+        import cryptomatte_utilities as cu
+        calls = []
+
+        def builder(value):
+            calls.append(value)
+            return value
+
+        cache = cu.ExpressionCache(max_size=16, max_chars=10)
+        cache.get("a", builder, "aaaa")
+        cache.get("b", builder, ["bb", "bb"])
+        cache.get("a", builder, "aaaa")  # a is now most recently used
+        self.assertEqual(cache.chars, 8)
+        cache.get("c", builder, "ccc")  # 11 characters, evicts b
+        self.assertEqual((len(cache), cache.chars), (2, 7))
+        cache.get("d", builder, "d" * 11)  # too big to cache
+        cache.get("d", builder, "d" * 11)
+        self.assertEqual((len(cache), cache.chars), (2, 7))
+        cache.get("a", builder, "aaaa")
+        cache.get("b", builder, ["bb", "bb"])
+        self.assertEqual(calls, ["aaaa", ["bb", "bb"], "ccc", "d" * 11, "d" * 11, ["bb", "bb"]])
+        cache.clear()
+        self.assertEqual((len(cache), cache.chars), (0, 0))
+
+    def test_extraction_expression_cache_key(self):
+        import cryptomatte_utilities as cu
+        channels = ["c00", "c01"]
+        first = cu._get_extraction_expression(channels, [1.5, 2.5])
+        second = cu._get_extraction_expression(channels, [2.5, 1.5, 2.5])
+        self.assertIs(first, second)
+        self.assertEqual(first, cu._build_extraction_expression(channels, [1.5, 2.5]))
+        self.assertNotEqual(first, cu._get_extraction_expression(channels[:1], [1.5, 2.5]))
+
+    def test_knob_writes_skipped(self):
+        import cryptomatte_utilities as cu
+        knob = FakeKnob("")
+        self.assertTrue(cu._set_knob_value(knob, "a"))
+        self.assertFalse(cu._set_knob_value(knob, "a"))
+        self.assertEqual(knob.writes, 1)
+
+
+class KnobWriting(unittest.TestCase):
+    def setUp(self):
+        import cryptomatte_utilities as cu
+        cu.reset_knob_write_stats()
+        self.node = FakeNode(
+            cryptoLayer="CryptoObject", in00="CryptoObject00", in01="none",
+            inputCryptoLayers=1.0, previewColor=[0.0, 0.5, 0.5])
+
+    def tearDown(self):
+        import cryptomatte_utilities as cu
+        cu.reset_knob_write_stats()
+
+    def test_only_changed_knobs_written(self):
+        import cryptomatte_utilities as cu
+        with cu.KnobChanges(self.node) as knobs:
+            knobs.set("cryptoLayer", "CryptoObject")
+            knobs.set("in00", "CryptoObject00")
+            knobs.set("in01", "CryptoObject01")
+            knobs.set("inputCryptoLayers", 1)
+            knobs.set("previewColor", [0.0, 0.5, 0.5])
+            self.assertEqual(self.node.writes(), 0, "Knobs written before commit.")
+        self.assertEqual(self.node.writes(), 1)
+        self.assertEqual(self.node.knob("in01").value(), "CryptoObject01")
+        self.assertEqual(cu.get_knob_write_stats(), {"written": 1, "avoided": 4})
+
+    def test_pending_values(self):
+        import cryptomatte_utilities as cu
+        knobs = cu.KnobChanges(self.node)
+        knobs.set("in01", "CryptoObject01")
+        self.assertEqual(knobs.value("in01"), "CryptoObject01")
+        self.assertEqual(knobs.value("in00"), "CryptoObject00")
+        self.assertEqual(knobs.commit(), 1)
+        self.assertEqual(knobs.commit(), 0)
+
+    def test_write_order(self):
+        import cryptomatte_utilities as cu
+        order = []
+        for knob_name in ["in01", "cryptoLayer"]:
+            knob = self.node.knob(knob_name)
+            knob.setValue = lambda value, knob_name=knob_name: order.append(knob_name)
+        with cu.KnobChanges(self.node) as knobs:
+            knobs.set("in01", "a")
+            knobs.set("cryptoLayer", "b")
+            knobs.set("in01", "c")
+        self.assertEqual(order, ["cryptoLayer", "in01"])
+
+    def test_gizmo_update_order(self):
+        """ The update writes in the order the knobs were set before batching,
+        with the wildcard expansion of the matte list inside the transaction.
+        """
+        import cryptomatte_utilities as cu
+
+        class FakeInfo(object):
+            cryptomattes = {"abc": {"name": "CryptoObject"}}
+
+            def is_valid(self):
+                return True
+
+            def get_channels(self):
+                return ["CryptoObject00", "CryptoObject01"]
+
+            def get_selection_name(self):
+                return "CryptoObject"
+
+            def get_metadata_cache(self):
+                return "metadata"
+
+            def parse_manifest(self):
+                return {"bunny": "13851a76", "bunnyEar": "0d7aa2e7", "cube": "7e5e0ba8"}
+
+        knob_values = dict((knob_name, "none") for knob_name in cu.GIZMO_CHANNEL_KNOBS)
+        knob_values.update(dict(("previewExpression%s" % i, "stale") for i in range(4)))
+        node = FakeNode(
+            stopAutoUpdate=0.0, metadataCache="", cryptoLayer="", useWildcards=True,
+            matteList="bunny*", expression="", previewEnabled=True, previewMode="Colors",
+            cryptoLayerLock=False, cryptoLayerChoice=-1, **knob_values)
+        order = []
+        for knob_name, knob in node._knobs.items():
+            def record(value, knob_name=knob_name, set_value=knob.setValue):
+                order.append(knob_name)
+                set_value(value)
+            knob.setValue = record
+
+        cu._update_cryptomatte_gizmo(node, FakeInfo())
+        self.assertEqual(
+            order,
+            ["metadataCache", "cryptoLayer", "in00", "in01", "matteList", "expression"] +
+            ["previewExpression%s" % i for i in range(4)] + ["cryptoLayerChoice"])
+        self.assertEqual(node.knob("matteList").value(), cu.MatteList("bunny, bunnyEar").to_nukestr)
+        self.assertEqual(
+            node.knob("expression").value(),
+            cu._build_extraction_expression(
+                ["CryptoObject00", "CryptoObject01"],
+                [cu.mm3hash_float("bunny"), cu.mm3hash_float("bunnyEar")]))
+
+    def test_no_commit_on_error(self):
+        import cryptomatte_utilities as cu
+
+        def update():
+            with cu.KnobChanges(self.node) as knobs:
+                knobs.set("in01", "CryptoObject01")
+                raise RuntimeError("Failed update")
+
+        self.assertRaises(RuntimeError, update)
+        self.assertEqual(self.node.writes(), 0)
+
+
+class Decryptomatting(unittest.TestCase):
+    def setUp(self):
+        import cryptomatte_utilities as cu
+        self.orig_nuke = cu.nuke
+        cu.nuke = self.nuke = FakeNuke()
+        self.source = self.nuke.create("Read", "Read1")
+
+    def tearDown(self):
+        import cryptomatte_utilities as cu
+        cu.nuke = self.orig_nuke
+
+    def gizmo(self, name, matte_output="alpha"):
+        import cryptomatte_utilities as cu
+        channel_knobs = dict((knob_name, "none") for knob_name in cu.GIZMO_CHANNEL_KNOBS)
+        channel_knobs.update(in00="CryptoAsset00", in01="CryptoAsset01", in02="CryptoAsset02")
+        return self.nuke.create(
+            "Cryptomatte", name, [self.source], matteList="%s, triangle" % name,
+            expression="(%s_expression)" % name, matteOutput=matte_output,
+            unpremultiply=False, disable=False, matteOnly=False, RemoveChannels=False,
+            **channel_knobs)
+
+    def recorded_knobs(self, node):
+        import cryptomatte_utilities as cu
+        knob_names = ["origMatteList"] + cu.GIZMO_CHANNEL_KNOBS
+        return (dict((knob_name, node.knob(knob_name).value()) for knob_name in knob_names),
+                [node.knob(knob_name).visible for knob_name in cu.GIZMO_CHANNEL_KNOBS])
+
+    def expected_knobs(self, gizmo):
+        import cryptomatte_utilities as cu
+        knobs = dict((knob_name, gizmo.knob(knob_name).value())
+                     for knob_name in cu.GIZMO_CHANNEL_KNOBS)
+        knobs["origMatteList"] = gizmo.knob("matteList").value()
+        return knobs, [False] * len(cu.GIZMO_CHANNEL_KNOBS)
+
+    def test_recorded_knobs(self):
+        """ Single and merged decryptomattes record the same gizmo knobs on
+        the first node replacing each gizmo. """
+        import cryptomatte_utilities as cu
+        gizmos = [self.gizmo("Cryptomatte%s" % i) for i in range(6)]
+        new_nodes = cu._decryptomatte(gizmos[0])
+        self.assertEqual(new_nodes[0].Class(), "Expression")
+        self.assertEqual(self.recorded_knobs(new_nodes[0]), self.expected_knobs(gizmos[0]))
+
+        new_nodes = cu._decryptomatte_batch(gizmos[1:])
+        shuffles = [node for node in new_nodes if node.Class() == "Shuffle"]
+        self.assertEqual(len(shuffles), len(gizmos[1:]))
+        for gizmo, shuffle in zip(gizmos[1:], shuffles):
+            self.assertEqual(self.recorded_knobs(shuffle), self.expected_knobs(gizmo))
+
+    def test_merged_graph(self):
+        """ Merged decryptomattes add an Expression node per four gizmos and a
+        Shuffle per gizmo, with the gizmos chained in front of the Expression. """
+        import cryptomatte_utilities as cu
+        gizmos = [self.gizmo("Cryptomatte%s" % i) for i in range(10)]
+        outputs = [self.nuke.create("Dot", "Dot%s" % i, [gizmo]) for i, gizmo in enumerate(gizmos)]
+        new_nodes = cu._decryptomatte_batch(gizmos)
+        self.assertEqual(sorted(node.Class() for node in new_nodes),
+                         ["Expression"] * 3 + ["Shuffle"] * 10)
+
+        expr_nodes = [node for node in new_nodes if node.Class() == "Expression"]
+        for expr_node, batch in zip(expr_nodes, [gizmos[0:4], gizmos[4:8], gizmos[8:]]):
+            self.assertIs(expr_node.input(0), batch[-1])
+            self.assertEqual([gizmo.input(0) for gizmo in batch], [self.source] + batch[:-1])
+        for gizmo, output in zip(gizmos, outputs):
+            self.assertTrue(gizmo.knob("disable").value())
+            shuffle = output.input(0)
+            self.assertEqual(shuffle.Class(), "Shuffle")
+            self.assertEqual(shuffle.knob("origMatteList").value(), gizmo.knob("matteList").value())
+
+    def test_merged_output_channels(self):
+        """ A merged matte is written to every channel of a multi-channel
+        matte output, as the Expression node of a single decryptomatte does. """
+        import cryptomatte_utilities as cu
+        gizmos = [self.gizmo("Cryptomatte%s" % i, "uCryptoAsset") for i in range(3)]
+        single = cu._decryptomatte(self.gizmo("Single", "uCryptoAsset"))[0]
+        self.assertEqual((single.knob("channel0").value(), single.knob("expr0").value()),
+                         ("uCryptoAsset", "(Single_expression)"))
+
+        new_nodes = cu._decryptomatte_batch(gizmos)
+        expr_node = new_nodes[0]
+        shuffles = [node for node in new_nodes if node.Class() == "Shuffle"]
+        out_channels = ["red", "green", "blue", "alpha"]
+        for slot, (gizmo, shuffle) in enumerate(zip(gizmos, shuffles)):
+            slot_channel = "%s.%s" % (cu.DECRYPTOMATTE_BATCH_LAYER, out_channels[slot])
+            self.assertEqual(expr_node.knob("channel%s" % slot).value(), slot_channel)
+            self.assertEqual(expr_node.knob("expr%s" % slot).value(),
+                             gizmo.knob("expression").value())
+            self.assertEqual((shuffle.knob("in").value(), shuffle.knob("out").value()),
+                             (cu.DECRYPTOMATTE_BATCH_LAYER, "uCryptoAsset"))
+            written = dict(("uCryptoAsset.%s" % channel, "%s.%s" % (
+                cu.DECRYPTOMATTE_BATCH_LAYER, shuffle.knob(channel).value()))
+                for channel in out_channels)
+            self.assertEqual(written, dict(("uCryptoAsset.%s" % channel, slot_channel)
+                                           for channel in out_channels))
+        self.assertEqual(expr_node.knob("channel3").value(), "none")
+
+
+class ExrHeaderReading(unittest.TestCase):
+    def setUp(self):
+        import os
+        sample_images = _sample_images_dir()
+        self.wildcard_path = os.path.join(sample_images, "cornellBox_CryptoWildcard.0001.exr")
+        self.sidecar_path = os.path.join(sample_images, "debug_images", "sidecar_manifest.exr")
+        self.special_path = os.path.join(sample_images, "debug_images", "special_chars.exr")
+        for file_path in [self.wildcard_path, self.sidecar_path, self.special_path]:
+            if not os.path.isfile(file_path):
+                raise IOError(
+                    ("Could not find: %s. Sample image dir can be defined env variable, %s") %
+                    (file_path, SAMPLES_IMAGES_DIR_ENVIRON))
+
+    def test_header(self):
+        import cryptomatte_exr as ce
+        header = ce.read_exr_header(self.wildcard_path)
+        self.assertFalse(header.multipart)
+        self.assertEqual(len(header.parts), 1)
+        part = header.parts[0]
+        self.assertEqual(part.compression, "ZIPS")
+        self.assertEqual(part.data_window, (167, 0, 792, 539))
+        self.assertEqual(part.chunk_count, 540)
+        self.assertFalse(part.tiled)
+        metadata = header.metadata()
+        self.assertEqual(metadata["exr/cryptomatte/2ae4678/name"], "uCryptoWildcard")
+        self.assertEqual(metadata["exr/cryptomatte/2ae4678/hash"], "MurmurHash3_32")
+        self.assertEqual(metadata["input/filename"], self.wildcard_path)
+
+    def test_nuke_channel_names(self):
+        import cryptomatte_exr as ce
+        channels = ce.read_exr_header(self.wildcard_path).channels()
+        part_index, channel = channels["uCryptoWildcard00.red"]
+        self.assertEqual((part_index, channel.name), (0, "uCryptoWildcard00.R"))
+        self.assertEqual(ce.ExrChannel("special chars00.red", 2).nuke_name,
+                         "special_chars00.red")
+
+    def test_cryptomatte_info(self):
+        import cryptomatte_exr as ce
+        cinfo = ce.ExrCryptomatteInfo(self.wildcard_path)
+        self.assertTrue(cinfo.is_valid())
+        self.assertEqual(cinfo.get_selection_name(), "uCryptoWildcard")
+        self.assertEqual(cinfo.get_channels(),
+                         ["uCryptoWildcard00", "uCryptoWildcard01", "uCryptoWildcard02"])
+        self.assertIn("sphere_?_2", cinfo.parse_manifest())
+
+        cinfo = ce.ExrCryptomatteInfo(self.special_path)
+        self.assertEqual(cinfo.get_channels(),
+                         ["special_chars00", "special_chars01", "special_chars02"])
+
+    def test_sidecar_manifest(self):
+        import cryptomatte_exr as ce
+        cinfo = ce.ExrCryptomatteInfo(self.sidecar_path)
+        self.assertTrue(cinfo.parse_manifest(), "Sidecar manifest not loaded.")
+
+    def test_not_exr(self):
+        import cryptomatte_exr as ce
+        self.assertRaises(IOError, ce.read_exr_header, __file__)
+
+
+@skip_without_numpy
+class ExrPixelDecoding(unittest.TestCase):
+    def setUp(self):
+        import os
+        import shutil
+        import tempfile
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        sample_images = _sample_images_dir()
+        self.wildcard_path = os.path.join(sample_images, "cornellBox_CryptoWildcard.0001.exr")
+        self.tiled_path = os.path.join(sample_images, "debug_images", "multichannel.exr")
+
+    def _channels(self):
+        import numpy as np
+        rng = np.random.RandomState(0)
+        shape = (37, 23)
+        return {
+            "Crypto00.R": rng.rand(*shape).astype(np.float32),
+            "Crypto00.G": np.zeros(shape, np.float32),
+            "Crypto00.B": np.full(shape, 3.5, np.float32),
+            "Crypto00.A": rng.rand(*shape).astype(np.float16),
+            "beauty.R": rng.rand(*shape),
+        }
+
+    def test_round_trip(self):
+        import os
+        import numpy as np
+        import cryptomatte_exr as ce
+        channels = self._channels()
+        exr_names = ["Crypto00.R", "Crypto00.G", "Crypto00.B", "Crypto00.A"]
+        for compression in ["NONE", "RLE", "ZIPS", "ZIP"]:
+            path = os.path.join(self.temp_dir, "%s.exr" % compression)
+            ce.write_exr(path, channels, compression, data_window=(5, 9))
+            with ce.ExrScanlineReader(path) as reader:
+                self.assertEqual(reader.data_window, (5, 9, 27, 45))
+                planes = reader.read(["Crypto00.red", "Crypto00.green",
+                                      "Crypto00.blue", "Crypto00.alpha"])
+            for plane, exr_name in zip(planes, exr_names):
+                self.assertTrue(
+                    np.array_equal(plane, channels[exr_name].astype(np.float32)),
+                    "%s mismatch with %s compression." % (exr_name, compression))
+
+    def test_read_ranks(self):
+        import numpy as np
+        import cryptomatte_exr as ce
+        cinfo = ce.ExrCryptomatteInfo(self.wildcard_path)
+        rank_ids, rank_coverage = cinfo.read_ranks()
+        self.assertEqual(rank_ids.shape, (6, 540, 626))
+        self.assertEqual(rank_coverage.dtype, np.float32)
+        manifest_ids = set(np.float32(ID) for ID in cinfo.parse_manifest().values())
+        found_ids = set(np.unique(rank_ids[rank_coverage > 0]))
+        self.assertTrue(found_ids and found_ids <= manifest_ids, "IDs not in manifest.")
+        self.assertTrue(np.allclose(rank_coverage.sum(axis=0).max(), 1.0, atol=1e-5))
+
+        out = np.zeros((2, 6, 540, 626), np.float32)
+        reused_ids, _ = cinfo.read_ranks(out)
+        self.assertTrue(np.array_equal(reused_ids, rank_ids))
+        self.assertTrue(np.shares_memory(reused_ids, out))
+
+    def test_threaded_decode(self):
+        import os
+        import numpy as np
+        import cryptomatte_exr as ce
+        path = os.path.join(self.temp_dir, "threads.exr")
+        channels = dict(("Crypto00.%s" % c, np.random.RandomState(i).rand(70, 40))
+                        for i, c in enumerate("RGBA"))
+        for compression in ["ZIPS", "ZIP"]:
+            ce.write_exr(path, channels, compression)
+            results = []
+            for threads in [1, 3]:
+                with ce.ExrScanlineReader(path, threads=threads) as reader:
+                    results.append(reader.read(["Crypto00.red", "Crypto00.alpha"]))
+            self.assertTrue(np.array_equal(results[0], results[1]))
+
+    def test_window(self):
+        import numpy as np
+        import cryptomatte_exr as ce
+        cinfo = ce.ExrCryptomatteInfo(self.wildcard_path)
+        full_ids, full_coverage = cinfo.read_ranks()
+        # data window is (167, 0, 792, 539)
+        window_ids, window_coverage = cinfo.read_ranks(window=(300, 200, 340, 215))
+        self.assertEqual(window_ids.shape, (6, 16, 41))
+        self.assertTrue(np.array_equal(window_ids, full_ids[:, 200:216, 133:174]))
+        self.assertTrue(np.array_equal(window_coverage, full_coverage[:, 200:216, 133:174]))
+
+        # Outside the data window is zeros.
+        window_ids, _ = cinfo.read_ranks(window=(160, 530, 170, 545))
+        self.assertEqual(window_ids.shape, (6, 16, 11))
+        self.assertFalse(window_ids[:, :, :7].any() or window_ids[:, 10:].any())
+        self.assertTrue(np.array_equal(window_ids[:, :10, 7:], full_ids[:, 530:, :4]))
+
+    def test_pick(self):
+        import cryptomatte_exr as ce
+        cinfo = ce.ExrCryptomatteInfo(self.wildcard_path)
+        rank_ids, rank_coverage = cinfo.read_ranks()
+        expected = [(float(ID), float(coverage)) for ID, coverage in
+                    zip(rank_ids[:, 270, 313], rank_coverage[:, 270, 313]) if coverage > 0.0]
+        self.assertTrue(expected)
+        self.assertEqual(cinfo.pick(480, 270), expected)
+
+        with ce.ExrScanlineReader(self.wildcard_path) as reader:
+            reader.read(["uCryptoWildcard00.red"], window=(480, 270, 480, 270))
+            self.assertEqual(reader.chunks_read, 1)
+            self.assertTrue(reader.bytes_read < 10000)
+
+    def test_unsupported(self):
+        import cryptomatte_exr as ce
+        with ce.ExrScanlineReader(self.tiled_path) as reader:
+            self.assertRaises(ValueError, reader.read, ["crypto_asset00.red"])
+        with ce.ExrScanlineReader(self.wildcard_path) as reader:
+            self.assertRaises(ValueError, reader.read, ["notAChannel.red"])
+
+
+@skip_without_numpy
+class MatteExtraction(unittest.TestCase):
+    def setUp(self):
+        import os
+        import cryptomatte_exr as ce
+        sample_images = _sample_images_dir()
+        self.cinfo = ce.ExrCryptomatteInfo(
+            os.path.join(sample_images, "cornellBox_CryptoWildcard.0001.exr"))
+        self.rank_ids, self.rank_coverage = self.cinfo.read_ranks()
+        self.names = sorted(self.cinfo.parse_manifest().keys())
+
+    def matte_ids(self, names):
+        import cryptomatte_utilities as cu
+        matte_list = cu.MatteList("")
+        for name in names:
+            matte_list.add(name)
+        return matte_list.IDs
+
+    def evaluate(self, expression):
+        """ Evaluates an extraction expression on the frame, in float32 and
+        summing left to right as Nuke would. """
+        import numpy as np
+        import cryptomatte_utilities as cu
+        channels = {}
+        for rank, (id_channel, coverage_channel) in enumerate(self.cinfo.get_rank_channels()):
+            channels[id_channel] = self.rank_ids[rank]
+            channels[coverage_channel] = self.rank_coverage[rank]
+        total = np.zeros(self.rank_ids[0].shape, np.float32)
+        for term in expression.split(" + ")[:-1]:
+            match = cu.EXTRACTION_TERM_RE.match(term)
+            mask = np.zeros(total.shape, bool)
+            for chan, literal in [x.split(" == ") for x in match.group("condition").split(" || ")]:
+                mask |= channels[chan] == np.float32(literal)
+            total = total + np.where(mask, channels[match.group("coverage")], np.float32(0.0))
+        return total
+
+    def assertBitsEqual(self, a, b, msg=None):
+        import numpy as np
+        self.assertTrue(np.array_equal(a.view(np.uint32), b.view(np.uint32)), msg)
+
+    def test_matches_expression(self):
+        import cryptomatte_utilities as cu
+        import cryptomatte_extraction as cx
+        for names in [self.names[:1], self.names[:3], self.names]:
+            ids = self.matte_ids(names)
+            matte = cx.extract_matte(self.rank_ids, self.rank_coverage, ids)
+            expected = self.evaluate(cu._build_extraction_expression(self.cinfo.get_channels(), ids))
+            self.assertTrue(matte.any())
+            self.assertBitsEqual(matte, expected, "Mismatch for %s" % names)
+
+    def test_large_id_set(self):
+        import cryptomatte_utilities as cu
+        import cryptomatte_extraction as cx
+        ids = self.matte_ids(self.names[:2]) + [cu.mm3hash_float("no_%s" % i) for i in range(50)]
+        self.assertTrue(len(ids) > cx.SMALL_ID_SET)
+        self.assertBitsEqual(
+            cx.extract_matte(self.rank_ids, self.rank_coverage, ids),
+            cx.extract_matte(self.rank_ids, self.rank_coverage, self.matte_ids(self.names[:2])))
+
+    def test_all_mattes(self):
+        import numpy as np
+        import cryptomatte_extraction as cx
+        manifest = self.cinfo.parse_manifest()
+        mattes = cx.extract_all_mattes(self.rank_ids, self.rank_coverage, manifest)
+        self.assertEqual(len(mattes), len(manifest))
+        for name, ID in manifest.items():
+            index = mattes.index(name)
+            self.assertEqual(mattes.index(ID), index)
+            expected = cx.extract_matte(self.rank_ids, self.rank_coverage, [ID])
+            self.assertBitsEqual(mattes.matte(index), expected, "Mismatch for %s" % name)
+            self.assertEqual(mattes.pixel_count(index), np.count_nonzero(expected))
+
+            bbox, cropped = mattes.cropped(index)
+            rows, columns = np.nonzero(expected)
+            self.assertEqual(bbox, (columns.min(), rows.min(), columns.max(), rows.max()))
+            self.assertTrue(np.array_equal(
+                cropped, expected[bbox[1]:bbox[3] + 1, bbox[0]:bbox[2] + 1]))
+
+    def test_all_mattes_repeated_ids(self):
+        import numpy as np
+        import cryptomatte_extraction as cx
+        ID = np.float32(self.cinfo.parse_manifest()["sphere_?_2"])
+        rank_ids = np.full((3, 2, 2), ID, np.float32)
+        rank_coverage = np.array([0.5, 0.3, 0.2], np.float32)[:, None, None] * np.ones((3, 2, 2))
+        rank_coverage = rank_coverage.astype(np.float32)
+        mattes = cx.extract_all_mattes(rank_ids, rank_coverage, [float(ID)])
+        self.assertBitsEqual(mattes.matte(0), cx.extract_matte(rank_ids, rank_coverage, [ID]))
+        self.assertEqual(mattes.pixel_count(0), 4)
+
+    def test_batch(self):
+        import random
+        import cryptomatte_utilities as cu
+        import cryptomatte_extraction as cx
+        rand = random.Random(3)
+        id_sets = [self.matte_ids(rand.sample(self.names, rand.randint(0, 4))) for _ in range(70)]
+        id_sets.append([cu.mm3hash_float("not_in_frame")])
+        mattes = cx.extract_mattes(self.rank_ids, self.rank_coverage, id_sets)
+        self.assertEqual(mattes.shape, (71,) + self.rank_ids[0].shape)
+        for matte, ids in zip(mattes, id_sets):
+            self.assertBitsEqual(matte, cx.extract_matte(self.rank_ids, self.rank_coverage, ids),
+                                 "Mismatch for %s" % ids)
+
+    def test_early_exit(self):
+        import numpy as np
+        import cryptomatte_extraction as cx
+        ids = self.matte_ids(self.names[:4])
+        expected = cx.extract_matte(self.rank_ids, self.rank_coverage, ids, early_exit=False)
+        self.assertBitsEqual(
+            cx.extract_matte(self.rank_ids, self.rank_coverage, ids, early_exit=True), expected)
+        self.assertBitsEqual(
+            cx.extract_mattes(self.rank_ids, self.rank_coverage, [ids])[0], expected)
+
+        # By default, ranks are summed like the gizmo's expression even when
+        # they are not sorted by coverage, or have negative coverage.
+        ID = np.float32(ids[0])
+        rank_ids = np.array([[[ID, ID]], [[0.0, ID]], [[ID, 0.0]], [[0.0, ID]]], np.float32)
+        rank_coverage = np.array([[[0.25, 1.5]], [[0.0, 0.0]], [[0.5, 0.0]], [[0.0, -0.5]]],
+                                 np.float32)
+        expected = np.array([[0.75, 1.0]], np.float32)
+        self.assertBitsEqual(cx.extract_matte(rank_ids, rank_coverage, [ID, ids[1]]), expected)
+        self.assertBitsEqual(cx.extract_mattes(rank_ids, rank_coverage, [[ID, ids[1]]])[0],
+                             expected)
+        early = cx.extract_matte(rank_ids, rank_coverage, [ID, ids[1]], early_exit=True)
+        self.assertFalse(np.array_equal(early, expected))
+
+        # With a tolerance, later ranks of fully covered pixels are skipped.
+        rank_ids = np.array(ids[:3], np.float32)[:, None, None] * np.ones((3, 1, 2), np.float32)
+        rank_coverage = np.array([[[1.0, 0.5]], [[1e-7, 0.5]], [[0.0, 0.0]]], np.float32)
+        exact = cx.extract_matte(rank_ids, rank_coverage, ids)
+        approximate = cx.extract_matte(rank_ids, rank_coverage, ids, tolerance=1e-6)
+        self.assertTrue(exact[0, 0] > 1.0)
+        self.assertEqual(approximate[0, 0], 1.0)
+        self.assertEqual(approximate[0, 1], exact[0, 1])
+
+    def test_bands(self):
+        import os
+        import shutil
+        import tempfile
+        import numpy as np
+        import cryptomatte_exr as ce
+        import cryptomatte_extraction as cx
+        ids = self.matte_ids(self.names[:3])
+        expected = cx.extract_matte(self.rank_ids, self.rank_coverage, ids)
+
+        bands = list(cx.iter_matte_bands(self.cinfo, ids, band_height=50))
+        self.assertEqual([first_line for first_line, _ in bands], list(range(0, 540, 50)))
+        self.assertTrue(bands[0][1].base is bands[-1][1].base, "Band buffer not reused.")
+        matte = np.concatenate([band.copy() for _, band in cx.iter_matte_bands(self.cinfo, ids, 50)])
+        self.assertBitsEqual(matte, expected)
+
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        path = os.path.join(temp_dir, "matte.exr")
+        for compression in ["NONE", "ZIP"]:
+            cx.write_matte(self.cinfo, ids, path, band_height=40, compression=compression)
+            with ce.ExrScanlineReader(path) as reader:
+                self.assertEqual(reader.data_window, self.cinfo.header.parts[0].data_window)
+                self.assertBitsEqual(reader.read(["alpha"])[0], expected)
+
+    def test_baked_header(self):
+        import os
+        import shutil
+        import tempfile
+        import numpy as np
+        import cryptomatte_exr as ce
+        import cryptomatte_extraction as cx
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        source = self.cinfo.header.parts[0]
+        self.assertNotEqual(source.attributes["displayWindow"], source.data_window)
+        path = os.path.join(temp_dir, "matte.exr")
+        for ids in [self.matte_ids(self.names[:3]), []]:
+            cx.write_matte(self.cinfo, ids, path)
+            baked = ce.read_exr_header(path).parts[0]
+            self.assertEqual(baked.data_window, source.data_window)
+            self.assertEqual(baked.display_attributes(), source.display_attributes())
+
+        display = {"display_window": (-10, -20, 99, 199), "pixel_aspect_ratio": 2.0,
+                   "screen_window_center": (0.5, 0.25), "screen_window_width": 1.5}
+        with ce.ExrScanlineWriter(path, {"A": np.float32}, 4, 2, "NONE", data_window=(3, 5),
+                                  **display) as writer:
+            writer.write({"A": np.zeros((2, 4), np.float32)})
+        part = ce.read_exr_header(path).parts[0]
+        self.assertEqual(part.data_window, (3, 5, 6, 6))
+        self.assertEqual(part.display_attributes(), display)
+
+    def test_empty(self):
+        import numpy as np
+        import cryptomatte_extraction as cx
+        out = np.ones(self.rank_ids[0].shape, np.float32)
+        matte = cx.extract_matte(self.rank_ids, self.rank_coverage, [], out)
+        self.assertTrue(matte is out)
+        self.assertFalse(matte.any())
+
+    def test_incremental(self):
+        import numpy as np
+        import cryptomatte_extraction as cx
+        sparse = cx.sparse_ranks(self.rank_ids, self.rank_coverage)
+        dense = (self.rank_ids, self.rank_coverage)
+        steps = [self.names[:2], self.names[:3], self.names[1:3], self.names[1:3] + ["nothing"],
+                 self.names[2:3], [], self.names, self.names]
+        for ranks in [dense, sparse]:
+            incremental = cx.IncrementalMatte(max_fraction=0.5)
+            results = []
+            for names in steps:
+                ids = self.matte_ids(names)
+                expected = cx.extract_matte(self.rank_ids, self.rank_coverage, ids,
+                                            early_exit=False)
+                results.append((names, incremental.matte(1, ranks, ids), expected))
+                self.assertBitsEqual(results[-1][1], expected, names)
+            self.assertEqual(incremental.full_updates, 2)
+            self.assertEqual(incremental.incremental_updates, 5)
+            # Later updates leave earlier results alone.
+            for names, matte, expected in results:
+                self.assertBitsEqual(matte, expected, names)
+            results[-1][1][...] = 2.0
+            self.assertBitsEqual(incremental.matte(1, ranks, self.matte_ids(self.names)),
+                                 results[-2][2])
+
+        incremental = cx.IncrementalMatte(max_frames=1)
+        incremental.matte(1, dense, self.matte_ids(self.names[:1]))
+        incremental.matte(2, dense, self.matte_ids(self.names[:1]))
+        incremental.matte(1, dense, self.matte_ids(self.names[:2]))
+        self.assertEqual(incremental.full_updates, 3)
+
+    def test_sparse_ranks(self):
+        import os
+        import shutil
+        import tempfile
+        import numpy as np
+        import cryptomatte_extraction as cx
+        sparse = cx.sparse_ranks(self.rank_ids, self.rank_coverage, band_height=50)
+        self.assertEqual(len(sparse), np.count_nonzero(self.rank_coverage))
+        for pixel in [0, 1000, 20000]:
+            y, x = divmod(pixel, self.rank_ids.shape[2])
+            expected = self.rank_ids[:, y, x].view(np.uint32)[self.rank_coverage[:, y, x] != 0]
+            self.assertTrue(np.array_equal(
+                sparse.keys[sparse.offsets[pixel]:sparse.offsets[pixel + 1]], expected))
+        id_sets = [self.names[:1], self.names[:3], self.names]
+        id_sets = [self.matte_ids(names) for names in id_sets] + [[], [0.5]]
+        for ids in id_sets:
+            self.assertBitsEqual(sparse.extract(ids),
+                                 cx.extract_matte(self.rank_ids, self.rank_coverage, ids))
+
+        read = cx.read_sparse_ranks(self.cinfo, band_height=16)
+        for name in cx.SparseRanks.ARRAYS:
+            self.assertTrue(np.array_equal(getattr(read, name), getattr(sparse, name)), name)
+
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        sparse.save(os.path.join(temp_dir, "frame"))
+        loaded = cx.load_sparse_ranks(os.path.join(temp_dir, "frame"))
+        self.assertTrue(isinstance(loaded.keys, np.memmap))
+        self.assertBitsEqual(loaded.extract(id_sets[1]), sparse.extract(id_sets[1]))
+
+        # float16 coverage matches extraction from float16 ranks.
+        half = cx.sparse_ranks(self.rank_ids, self.rank_coverage, np.float16)
+        self.assertEqual(half.coverage.dtype, np.float16)
+        self.assertBitsEqual(half.extract(id_sets[1]), cx.extract_matte(
+            self.rank_ids, self.rank_coverage.astype(np.float16).astype(np.float32), id_sets[1]))
+
+
+@skip_without_numpy
+class SequenceBaking(unittest.TestCase):
+    def setUp(self):
+        import os
+        import shutil
+        import tempfile
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.input = os.path.join(_sample_images_dir(), "cornellBox_CryptoWildcard.%04d.exr")
+        self.output = os.path.join(self.temp_dir, "matte", "matte.####.exr")
+
+    def run_main(self, *args):
+        import sys
+        import cryptomatte
+        stdout = sys.stdout
+        try:
+            sys.stdout = self.log = _StringIO()
+            return cryptomatte.main(list(args))
+        finally:
+            sys.stdout = stdout
+
+    def test_frames(self):
+        import cryptomatte
+        self.assertEqual(cryptomatte.parse_frame_range("1001-1004x2, 7,9-10"),
+                         [1001, 1003, 7, 9, 10])
+        self.assertEqual(cryptomatte._frame_path("a.####.exr", 7), "a.0007.exr")
+        self.assertEqual(cryptomatte._frame_path("a.%04d.exr", 12), "a.0012.exr")
+        self.assertEqual(cryptomatte._frame_path("a.%d.exr", 12), "a.12.exr")
+        self.assertEqual(cryptomatte.find_frames(self.input), [1, 2])
+
+    def test_bake(self):
+        import os
+        import cryptomatte
+        import cryptomatte_exr as ce
+        import cryptomatte_utilities as cu
+        import cryptomatte_extraction as cx
+        self.assertEqual(self.run_main(self.input, "-o", self.output, "-m", "Rect*, sphere_?_2",
+                                       "-l", "uCryptoWildcard", "-j", "1"), 0)
+        for frame in [1, 2]:
+            cinfo = ce.ExrCryptomatteInfo(cryptomatte._frame_path(self.input, frame))
+            matte_list = cu.MatteList("Rect*, sphere_?_2")
+            matte_list.expand_wildcards(cinfo)
+            self.assertTrue(matte_list.IDs)
+            rank_ids, rank_coverage = cinfo.read_ranks()
+            expected = cx.extract_matte(rank_ids, rank_coverage, matte_list.IDs)
+            with ce.ExrScanlineReader(cryptomatte._frame_path(self.output, frame)) as reader:
+                self.assertTrue((reader.read(["alpha"])[0] == expected).all())
+
+    def test_resume(self):
+        import os
+        self.assertEqual(self.run_main(self.input, "-o", self.output, "-m", "Rect*", "-j", "1",
+                                       "-f", "1"), 0)
+        self.assertEqual(self.run_main(self.input, "-o", self.output, "-m", "Rect*", "-j", "1"), 0)
+        self.assertEqual(self.log.getvalue().count("skipped"), 1)
+        self.assertEqual(self.log.getvalue().count("written"), 1)
+
+        # Failed frames leave existing and temporary outputs alone.
+        self.assertEqual(self.run_main(self.input, "-o", self.output, "-m", "Rect*", "-j", "1",
+                                       "-l", "nope", "--overwrite", "-f", "1"), 1)
+        self.assertEqual(sorted(os.listdir(os.path.dirname(self.output))),
+                         ["matte.0001.exr", "matte.0002.exr"])
+
+    def copy_frames(self):
+        import os
+        import shutil
+        import cryptomatte
+        pattern = os.path.join(self.temp_dir, "render.%04d.exr")
+        for frame in [1, 2]:
+            shutil.copy(cryptomatte._frame_path(self.input, frame),
+                        cryptomatte._frame_path(pattern, frame))
+        return pattern
+
+    def test_frame_index(self):
+        import os
+        import numpy as np
+        import cryptomatte
+        import cryptomatte_exr as ce
+        import cryptomatte_index as ci
+        pattern = self.copy_frames()
+        paths = dict((frame, cryptomatte._frame_path(pattern, frame)) for frame in [1, 2])
+        index = ci.build_frame_index(paths, "uCryptoWildcard", processes=1)
+        self.assertEqual(index.layer, "uCryptoWildcard")
+        for frame in [1, 2]:
+            rank_ids, rank_coverage = ce.ExrCryptomatteInfo(paths[frame]).read_ranks()
+            expected = np.unique(rank_ids.view(np.uint32)[rank_coverage != 0])
+            self.assertTrue(np.array_equal(index.frame_keys(frame), expected))
+            self.assertTrue(all(index._bloom_rows(key)[frame - 1] for key in expected))
+        self.assertEqual(index.frames_containing("sphere_?_2"), [1])
+        self.assertEqual(index.frames_containing("sphere_*_1"), [2])
+        self.assertEqual(index.frames_containing("has_n_asterisk"), [1, 2])
+        self.assertEqual(index.frames_containing("nothing"), [])
+
+        rng = np.random.RandomState(0)
+        false_positives = np.mean([index._bloom_rows(key).mean()
+                                   for key in rng.randint(1, 2 ** 31, 2000).astype(np.uint32)])
+        self.assertLess(false_positives, 0.05)
+
+        path = cryptomatte.index_path(pattern, "uCryptoWildcard")
+        self.assertEqual(os.path.basename(path), "render.uCryptoWildcard.cryptoindex.npz")
+        index.save(path)
+        loaded = ci.load_frame_index(path)
+        self.assertEqual(loaded.frames_containing("sphere_?_2"), [1])
+        self.assertTrue(np.array_equal(loaded.blooms, index.blooms))
+        self.assertTrue(loaded.is_current(1, paths[1]))
+
+        # Changed frames are indexed again.
+        os.utime(paths[2], (0, 0))
+        self.assertFalse(loaded.is_current(2, paths[2]))
+        updated = ci.build_frame_index({2: paths[2]}, "uCryptoWildcard", loaded, processes=1)
+        self.assertEqual(updated.frames, [1, 2])
+        self.assertTrue(updated.is_current(2, paths[2]))
+
+    def test_index_skips_frames(self):
+        import cryptomatte
+        import cryptomatte_exr as ce
+        import cryptomatte_extraction as cx
+        pattern = self.copy_frames()
+        self.assertEqual(self.run_main(pattern, "-o", self.output, "-m", "sphere_?_2", "-j", "1",
+                                       "--index"), 0)
+        self.assertEqual(self.log.getvalue().count(", empty"), 1)
+        self.assertTrue("frame 2 written" in self.log.getvalue())
+        for frame in [1, 2]:
+            cinfo = ce.ExrCryptomatteInfo(cryptomatte._frame_path(pattern, frame))
+            rank_ids, rank_coverage = cinfo.read_ranks()
+            expected = cx.extract_matte(rank_ids, rank_coverage,
+                                        [cinfo.name_to_ID("sphere_?_2")])
+            self.assertEqual(bool(expected.any()), frame == 1)
+            with ce.ExrScanlineReader(cryptomatte._frame_path(self.output, frame)) as reader:
+                self.assertTrue((reader.read(["alpha"])[0] == expected).all())
+
+    def test_index_location(self):
+        import os
+        import cryptomatte
+        pattern = self.copy_frames()
+        index_dir = os.path.join(self.temp_dir, "indexes") + os.sep
+        self.assertEqual(self.run_main(pattern, "-o", self.output, "-m", "sphere_?_2", "-j", "1",
+                                       "--index", "--index-path", index_dir), 0)
+        path = cryptomatte.index_path(pattern, "", index_dir)
+        self.assertEqual(os.path.dirname(path), os.path.join(self.temp_dir, "indexes"))
+        self.assertTrue(os.path.exists(path))
+        self.assertFalse(os.path.exists(cryptomatte.index_path(pattern)))
+        self.assertEqual(self.log.getvalue().count(", empty"), 1)
+        file_path = os.path.join(self.temp_dir, "index.npz")
+        self.assertEqual(cryptomatte.index_path(pattern, "", file_path), file_path)
+
+        # An index that can not be written is skipped, not fatal. A directory
+        # in its place stands in for a read only input directory.
+        os.mkdir(cryptomatte.index_path(pattern))
+        self.assertEqual(self.run_main(pattern, "-o", self.output, "-m", "sphere_?_2", "-j", "1",
+                                       "--index", "--overwrite"), 0)
+        self.assertTrue("Could not write the index" in self.log.getvalue())
+        self.assertEqual(self.log.getvalue().count(" written"), 2)
+
+    def test_object_table(self):
+        import os
+        import numpy as np
+        import cryptomatte_exr as ce
+        import cryptomatte_index as ci
+        import cryptomatte_extraction as cx
+        cinfo = ce.ExrCryptomatteInfo(self.input % 1)
+        table = ci.object_table(cinfo, band_height=16)
+        manifest = cinfo.parse_manifest()
+        self.assertEqual(sorted(table.names), sorted(manifest))
+
+        xmin, ymin = cinfo.header.parts[0].data_window[:2]
+        rank_ids, rank_coverage = cinfo.read_ranks()
+        for name, ID in manifest.items():
+            row = table.index(name)
+            self.assertEqual(table.index(ID), row)
+            matte = cx.extract_matte(rank_ids, rank_coverage, [ID])
+            rows, columns = np.nonzero(matte)
+            self.assertEqual(tuple(table.bboxes[row]), (columns.min() + xmin, rows.min() + ymin,
+                                                        columns.max() + xmin, rows.max() + ymin))
+            self.assertEqual(table.pixel_counts[row], len(rows))
+            self.assertAlmostEqual(table.areas[row] / matte.sum(dtype=np.float64), 1.0, places=6)
+
+            window = table.window([ID])
+            self.assertEqual(window, tuple(table.bboxes[row]))
+            cropped = cx.extract_matte_window(cinfo, [ID], window)
+            self.assertTrue(np.array_equal(
+                cropped, matte[window[1] - ymin:window[3] - ymin + 1,
+                               window[0] - xmin:window[2] - xmin + 1]))
+        self.assertEqual(table.window([cinfo.name_to_ID("nothing")]), None)
+        self.assertEqual(table.rows()[0][0], "has_n_asterisk")
+
+        path = os.path.join(self.temp_dir, "table.npz")
+        table.save(path)
+        loaded = ci.load_object_table(path)
+        self.assertEqual(loaded.rows(), table.rows())
+
+    def test_buffer_reuse(self):
+        import os
+        import cryptomatte
+        import cryptomatte_exr as ce
+        import cryptomatte_extraction as cx
+        try:
+            import tracemalloc
+        except ImportError:
+            tracemalloc = None
+        buffers = ce.BufferPool()
+        allocations = []
+        peaks = []
+        for frame in [1, 2, 1, 2]:
+            cinfo = ce.ExrCryptomatteInfo(cryptomatte._frame_path(self.input, frame))
+            ids = [cinfo.name_to_ID("Rect")]
+            output = os.path.join(self.temp_dir, "%s.exr" % frame)
+            if tracemalloc:
+                tracemalloc.start()
+            cx.write_matte(cinfo, ids, output, band_height=16, buffers=buffers)
+            if tracemalloc:
+                peaks.append(tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+            rank_ids, rank_coverage = cinfo.read_ranks(buffers=buffers)
+            expected = cx.extract_matte(rank_ids, rank_coverage, ids)
+            with ce.ExrScanlineReader(output) as reader:
+                self.assertTrue((reader.read(["alpha"])[0] == expected).all())
+            allocations.append(buffers.allocations)
+        self.assertGreater(allocations[0], 0)
+        self.assertEqual(allocations[1:], allocations[:1] * 3, "Later frames allocated buffers.")
+        self.assertGreater(buffers.reuses, 0)
+        if peaks:
+            # Real allocations, not just the pool's: after the first frame,
+            # only per-chunk and per-band temporaries, the same for every
+            # frame. That is about one band of decoded ranks, plus zlib's
+            # output for the chunks decoded in parallel.
+            band_bytes = rank_ids.shape[0] * 2 * 16 * rank_ids.shape[2] * 4
+            self.assertLess(max(peaks[1:]), band_bytes + 2 * 1024 ** 2, peaks)
+            self.assertLess(max(peaks[1:]), peaks[0] / 2, peaks)
+            self.assertLess(max(peaks[1:]) - min(peaks[1:]), 64 * 1024, peaks)
+
+        # A different data window reallocates.
+        cinfo = ce.ExrCryptomatteInfo(
+            os.path.join(_sample_images_dir(), "debug_images", "special_chars.exr"))
+        rank_ids, _ = cinfo.read_ranks(buffers=buffers)
+        self.assertEqual(rank_ids.shape, (6, 64, 64))
+        self.assertGreater(buffers.allocations, allocations[1])
+
+
+@skip_without_numpy
+class PreviewRendering(unittest.TestCase):
+    channels = ["crypto00", "crypto01", "crypto02"]
+
+    def setUp(self):
+        import numpy as np
+        import cryptomatte_utilities as cu
+        rng = np.random.RandomState(3)
+        ids = np.array([cu.mm3hash_float("object_%s" % i) for i in range(20)] + [0.0, -3.5e-7],
+                       np.float32)
+        self.rank_ids = ids[rng.randint(len(ids), size=(6, 9, 11))]
+        self.rank_coverage = rng.rand(6, 9, 11).astype(np.float32)
+        self.rank_coverage[5, 0] = -self.rank_coverage[5, 0]
+
+    def evaluate(self, expression, y, x):
+        """ Evaluates a preview expression at one pixel, one float32 operation
+        at a time, summing left to right as Nuke would. """
+        import math
+        import re
+        import numpy as np
+        if not expression:
+            return np.float32(0.0)
+        channels = {}
+        for rank in range(len(self.rank_ids)):
+            suffixes = [".red", ".green"] if rank % 2 == 0 else [".blue", ".alpha"]
+            channels[self.channels[rank // 2] + suffixes[0]] = self.rank_ids[rank, y, x]
+            channels[self.channels[rank // 2] + suffixes[1]] = self.rank_coverage[rank, y, x]
+        match = re.match(r"^2\.0 \* (\S+)$", expression)
+        if match:
+            return np.float32(2.0) * channels[match.group(1)]
+        total = None
+        for id_chan, factor, cov_chan in re.findall(
+                r"\(mantissa\(abs\((\S+)\)\) \* (\d+) % 0\.25\) \* ([^ )]+)", expression):
+            mantissa = np.float32(math.frexp(abs(float(channels[id_chan])))[0])
+            term = np.float32(math.fmod(mantissa * np.float32(int(factor)), 0.25))
+            term = term * channels[cov_chan]
+            total = term if total is None else total + term
+        return total
+
+    def assertMatchesExpressions(self, mode, rendered, ranks=4):
+        import numpy as np
+        import cryptomatte_utilities as cu
+        channels = self.channels[:(ranks + 1) // 2]
+        expressions = cu._build_preview_expressions(channels, mode)
+        for channel, expression in enumerate(expressions):
+            expected = np.array([[self.evaluate(expression, y, x) for x in range(11)]
+                                 for y in range(9)], np.float32)
+            self.assertTrue(np.array_equal(rendered[channel].view(np.uint32), expected.view(np.uint32)),
+                            "%s mismatch in channel %s" % (mode, channel))
+
+    def test_colors(self):
+        import numpy as np
+        import cryptomatte_preview as cp
+        rendered = cp.render_preview(self.rank_ids, self.rank_coverage, "Colors")
+        self.assertMatchesExpressions("Colors", rendered)
+        self.assertTrue(rendered[:3].any())
+
+        # With all ranks, as the gizmo would with more puzzle layers.
+        self.assertFalse(np.array_equal(
+            cp.render_preview(self.rank_ids, self.rank_coverage, "Colors", ranks=None), rendered))
+        self.assertTrue(np.array_equal(
+            cp.render_preview(self.rank_ids[:4], self.rank_coverage[:4], "Colors", ranks=None),
+            rendered))
+
+    def test_edges(self):
+        import numpy as np
+        import cryptomatte_preview as cp
+        rendered = cp.render_preview(self.rank_ids, self.rank_coverage, "Edges")
+        self.assertMatchesExpressions("Edges", rendered)
+        rgb = np.ones((3, 9, 11), np.float32)
+        rendered = cp.render_preview(self.rank_ids, self.rank_coverage, "Edges", rgb=rgb)
+        self.assertTrue((rendered[:3] == 1.0).all())
+        self.assertFalse(cp.render_preview(self.rank_ids, self.rank_coverage, "None").any())
+        self.assertRaises(ValueError, cp.render_preview, self.rank_ids, self.rank_coverage, "Bad")
+
+    def test_contact_sheet(self):
+        import os
+        import shutil
+        import tempfile
+        import numpy as np
+        import cryptomatte_exr as ce
+        import cryptomatte_preview as cp
+        paths = [os.path.join(_sample_images_dir(), "cornellBox_CryptoWildcard.%04d.exr" % frame)
+                 for frame in [1, 2]]
+        paths.append(os.path.join(_sample_images_dir(), "debug_images", "special_chars.exr"))
+        sheet = cp.contact_sheet(paths, columns=2, step=4, layer="uCryptoWildcard")
+        self.assertEqual(sheet.shape, (4, 2 * 135, 2 * 157))
+
+        cinfo = ce.ExrCryptomatteInfo(paths[1])
+        rank_ids, rank_coverage = cinfo.read_ranks()
+        expected = cp.render_preview(rank_ids[:, ::4, ::4], rank_coverage[:, ::4, ::4])
+        self.assertTrue(np.array_equal(sheet[:, :135, 157:], expected))
+        self.assertFalse(sheet[:, 135:].any(), "Frame without the layer is not black.")
+
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        output = os.path.join(temp_dir, "sheet.exr")
+        cp.write_contact_sheet(paths[:2], output, mode="Edges")
+        with ce.ExrScanlineReader(output) as reader:
+            self.assertEqual(reader.shape, (135, 2 * 157))
+            self.assertTrue(reader.read(["alpha"])[0].any())
+
+
+@skip_without_numpy
+class MatteCaching(unittest.TestCase):
+    def setUp(self):
+        import os
+        import shutil
+        import tempfile
+        import cryptomatte_exr as ce
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.source = os.path.join(self.temp_dir, "render.exr")
+        shutil.copy(os.path.join(_sample_images_dir(), "cornellBox_CryptoWildcard.0001.exr"),
+                    self.source)
+        self.cinfo = ce.ExrCryptomatteInfo(self.source)
+        self.rank_ids, self.rank_coverage = self.cinfo.read_ranks()
+        manifest = self.cinfo.parse_manifest()
+        self.ids = [manifest["sphere_?_2"], manifest["has_*_asterisk"]]
+
+    def test_keys(self):
+        import os
+        import cryptomatte_cache as cc
+        self.assertEqual(cc.ids_digest(self.ids), cc.ids_digest(self.ids[::-1] + self.ids))
+        self.assertNotEqual(cc.ids_digest(self.ids), cc.ids_digest(self.ids[:1]))
+        key = cc.cache_key(self.cinfo, self.ids)
+        self.assertNotEqual(key, cc.cache_key(self.cinfo, self.ids, "float16"))
+        self.assertNotEqual(key, cc.cache_key(self.cinfo, self.ids, crop=True))
+        os.utime(self.source, (0, 0))
+        self.assertNotEqual(key, cc.cache_key(self.cinfo, self.ids), "Changed file, same key.")
+
+    def test_hits(self):
+        import os
+        import numpy as np
+        import cryptomatte_cache as cc
+        import cryptomatte_extraction as cx
+        expected = cx.extract_matte(self.rank_ids, self.rank_coverage, self.ids)
+        xmin, ymin, xmax, ymax = self.cinfo.header.parts[0].data_window
+        rows, columns = np.nonzero(expected)
+        bbox = (columns.min() + xmin, rows.min() + ymin, columns.max() + xmin, rows.max() + ymin)
+        for dtype, crop, compress in [(np.float32, False, False), (np.float16, True, False),
+                                      (np.float32, True, True)]:
+            directory = os.path.join(self.temp_dir, "cache_%s_%s_%s" % (dtype.__name__, crop,
+                                                                        compress))
+            cache = cc.MatteCache(directory, dtype=dtype, crop=crop, compress=compress)
+            self.assertEqual(cache.get(self.cinfo, self.ids), None)
+            stored = cache.matte(self.cinfo, self.ids, (self.rank_ids, self.rank_coverage))
+            window, matte = cache.matte(self.cinfo, self.ids[::-1])
+            self.assertEqual((cache.hits, cache.misses), (1, 2))
+            self.assertEqual(window, stored[0])
+            self.assertEqual(matte.dtype, np.dtype(dtype))
+            self.assertEqual(isinstance(matte, np.memmap), not compress)
+            if crop:
+                self.assertEqual(window, bbox)
+                expected_matte = expected[bbox[1] - ymin:bbox[3] - ymin + 1,
+                                          bbox[0] - xmin:bbox[2] - xmin + 1]
+            else:
+                self.assertEqual(window, (xmin, ymin, xmax, ymax))
+                expected_matte = expected
+            self.assertTrue(np.array_equal(matte, expected_matte.astype(dtype)))
+
+        # Cropped and full frame caches sharing a directory keep their own mattes.
+        shared = os.path.join(self.temp_dir, "shared")
+        full_cache, crop_cache = cc.MatteCache(shared), cc.MatteCache(shared, crop=True)
+        full_cache.matte(self.cinfo, self.ids, (self.rank_ids, self.rank_coverage))
+        self.assertEqual(crop_cache.matte(self.cinfo, self.ids)[0], bbox)
+        self.assertEqual(full_cache.matte(self.cinfo, self.ids)[0], (xmin, ymin, xmax, ymax))
+
+        cache = cc.MatteCache(os.path.join(self.temp_dir, "empty"), crop=True)
+        self.assertEqual(cache.matte(self.cinfo, [0.5])[0], None)
+        self.assertEqual(cache.matte(self.cinfo, [0.5])[1].shape, (0, 0))
+
+    def test_eviction(self):
+        import os
+        import cryptomatte_cache as cc
+        cache = cc.MatteCache(os.path.join(self.temp_dir, "cache"))
+        ranks = (self.rank_ids, self.rank_coverage)
+        for i, ID in enumerate(self.ids):
+            cache.matte(self.cinfo, [ID], ranks)
+            key = cc.cache_key(self.cinfo, [ID])
+            os.utime(os.path.join(cache.directory, key + ".json"), (i, i))
+        entry_size = cache.size() // 2
+        cache.get(self.cinfo, [self.ids[0]])  # now the most recently used
+        cache.max_bytes = entry_size * 2
+        cache.matte(self.cinfo, self.ids, ranks)
+        self.assertEqual(len(cache.entries()), 2)
+        self.assertTrue(cache.get(self.cinfo, [self.ids[0]]))
+        self.assertFalse(cache.get(self.cinfo, [self.ids[1]]))
+
+
+@skip_without_numpy
+class MatteEncoding(unittest.TestCase):
+    def setUp(self):
+        import os
+        import shutil
+        import tempfile
+        import numpy as np
+        import cryptomatte_exr as ce
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.cinfo = ce.ExrCryptomatteInfo(
+            os.path.join(_sample_images_dir(), "cornellBox_CryptoWildcard.0001.exr"))
+        rank_ids, rank_coverage = self.cinfo.read_ranks()
+        # A crop across object edges, so pixels have several ranks.
+        self.rank_ids = rank_ids[:, 60:90, 110:150].copy()
+        self.rank_coverage = rank_coverage[:, 60:90, 110:150].copy()
+        rng = np.random.RandomState(5)
+        self.alpha = rng.rand(30, 40).astype(np.float32)
+        self.alpha[:5] = 0.0
+        self.alpha[5:10] = 1.0
+
+    def reference(self, name, operation, ranks):
+        """ Inserts a matte one pixel at a time. """
+        import numpy as np
+        import cryptomatte_utilities as cu
+        ID = np.float32(cu.mm3hash_float(name))
+        count, height, width = self.rank_ids.shape
+        out_ids = np.zeros((ranks, height, width), np.float32)
+        out_coverage = np.zeros((ranks, height, width), np.float32)
+        one = np.float32(1.0)
+        for y in range(height):
+            for x in range(width):
+                alpha = self.alpha[y, x]
+                entries = [(self.rank_ids[r, y, x], self.rank_coverage[r, y, x])
+                           for r in range(count)]
+                if operation == "over":
+                    entries = [(i, c * (one - alpha)) for i, c in entries]
+                    total = alpha
+                else:
+                    covered = np.float32(0.0)
+                    for _, c in entries:
+                        covered = covered + c
+                    total = alpha * max(one - covered, np.float32(0.0))
+                for i, c in entries:
+                    if i.view(np.uint32) == ID.view(np.uint32):
+                        total = total + c
+                entries = [(i, c) for i, c in entries if i.view(np.uint32) != ID.view(np.uint32)]
+                new = [(ID, total)]
+                entries = new + entries if operation == "over" else entries + new
+                entries = sorted(entries, key=lambda entry: -entry[1])[:ranks]
+                for r, (i, c) in enumerate(entries):
+                    out_ids[r, y, x] = i if c != 0.0 else 0.0
+                    out_coverage[r, y, x] = c
+        return out_ids, out_coverage
+
+    def assertBitsEqual(self, a, b, msg=None):
+        import numpy as np
+        self.assertTrue(np.array_equal(a.view(np.uint32), b.view(np.uint32)), msg)
+
+    def test_insert(self):
+        import cryptomatte_encoding as ck
+        for name in ["painted", "has_n_asterisk"]:
+            for operation in ["over", "under"]:
+                for ranks in [4, 6, 7]:
+                    rank_ids, rank_coverage, _ = ck.insert_matte(
+                        self.rank_ids, self.rank_coverage, self.alpha, name, ranks=ranks,
+                        operation=operation, band_height=7)
+                    expected_ids, expected_coverage = self.reference(name, operation, ranks)
+                    msg = "%s %s %s" % (name, operation, ranks)
+                    self.assertBitsEqual(rank_ids, expected_ids, msg)
+                    self.assertBitsEqual(rank_coverage, expected_coverage, msg)
+        self.assertRaises(ValueError, ck.insert_matte, self.rank_ids, self.rank_coverage,
+                          self.alpha, "painted", operation="plus")
+
+    def test_insert_many(self):
+        import numpy as np
+        import cryptomatte_encoding as ck
+        rng = np.random.RandomState(7)
+        mattes = []
+        for name in ["roto1", "roto2", "has_n_asterisk", "roto3", "roto1"]:
+            alpha = np.zeros((30, 40), np.float32)
+            x, y = rng.randint(0, 30), rng.randint(0, 20)
+            alpha[y:y + 12, x:x + 15] = rng.rand(12, 15)
+            alpha[y + 3:y + 9, x + 3:x + 12] = 1.0
+            mattes.append((name, alpha))
+        for operation, ranks in [("over", 4), ("over", 6), ("over", 11), ("under", 11)]:
+            rank_ids, rank_coverage, manifest = self.rank_ids, self.rank_coverage, {}
+            for name, alpha in mattes:
+                rank_ids, rank_coverage, manifest = ck.insert_matte(
+                    rank_ids, rank_coverage, alpha, name, manifest, ranks, operation)
+            batch_ids, batch_coverage, batch_manifest = ck.insert_mattes(
+                self.rank_ids, self.rank_coverage, mattes, {}, ranks, operation, band_height=7)
+            msg = "%s %s" % (operation, ranks)
+            self.assertEqual(batch_manifest, manifest, msg)
+            self.assertBitsEqual(batch_ids, rank_ids, msg)
+            self.assertTrue(np.allclose(batch_coverage, rank_coverage, rtol=0, atol=1e-6), msg)
+
+    def merge_reference(self, ids_a, coverage_a, ids_b, coverage_b, ranks):
+        """ Merges rank sets one pixel at a time. """
+        import numpy as np
+        count, height, width = ids_a.shape
+        out_ids = np.zeros((ranks, height, width), np.float32)
+        out_coverage = np.zeros((ranks, height, width), np.float32)
+        for y in range(height):
+            for x in range(width):
+                entries = [[ids_a[r, y, x], coverage_a[r, y, x]] for r in range(count)]
+                keys = [i.view(np.uint32) for i, _ in entries]
+                for r in range(len(ids_b)):
+                    i, c = ids_b[r, y, x], coverage_b[r, y, x]
+                    if i.view(np.uint32) in keys:
+                        entries[keys.index(i.view(np.uint32))][1] += c
+                    else:
+                        entries.append([i, c])
+                entries = sorted(entries, key=lambda entry: -entry[1])[:ranks]
+                for r, (i, c) in enumerate(entries):
+                    out_ids[r, y, x] = i if c != 0.0 else 0.0
+                    out_coverage[r, y, x] = c
+        return out_ids, out_coverage
+
+    def other_ranks(self):
+        """ Ranks of another part of the frame, with some of the same objects. """
+        rank_ids, rank_coverage = self.cinfo.read_ranks()
+        return rank_ids[:4, 100:130, 110:150].copy(), rank_coverage[:4, 100:130, 110:150].copy()
+
+    def test_merge_ranks(self):
+        import cryptomatte_encoding as ck
+        ids_b, coverage_b = self.other_ranks()
+        for ranks in [3, 6, 10]:
+            rank_ids, rank_coverage = ck.merge_ranks(self.rank_ids, self.rank_coverage, ids_b,
+                                                     coverage_b, ranks, band_height=7)
+            expected_ids, expected_coverage = self.merge_reference(
+                self.rank_ids, self.rank_coverage, ids_b, coverage_b, ranks)
+            self.assertBitsEqual(rank_ids, expected_ids, ranks)
+            self.assertBitsEqual(rank_coverage, expected_coverage, ranks)
+        self.assertRaises(ValueError, ck.merge_ranks, self.rank_ids, self.rank_coverage,
+                          ids_b[:, 1:], coverage_b[:, 1:])
+
+    def test_merge_files(self):
+        import os
+        import cryptomatte_utilities as cu
+        import cryptomatte_exr as ce
+        import cryptomatte_encoding as ck
+        manifest = dict((name, cu.id_to_hex(ID))
+                        for name, ID in self.cinfo.parse_manifest().items())
+        names = sorted(manifest)
+        manifest_a = dict((name, manifest[name]) for name in names[:5])
+        manifest_b = dict((name, manifest[name]) for name in names[3:])
+        ids_b, coverage_b = self.other_ranks()
+        path_a = os.path.join(self.temp_dir, "characters.exr")
+        path_b = os.path.join(self.temp_dir, "environment.exr")
+        ce.write_cryptomatte(path_a, self.rank_ids, self.rank_coverage, "CryptoCharacters",
+                             manifest_a, "ZIPS")
+        ce.write_cryptomatte(path_b, ids_b, coverage_b, "CryptoEnvironment", manifest_b)
+
+        path = os.path.join(self.temp_dir, "merged.exr")
+        merged_manifest = ck.merge_cryptomatte_files(path_a, path_b, path, "CryptoObject",
+                                                     band_height=7)
+        self.assertEqual(merged_manifest, manifest)
+        cinfo = ce.ExrCryptomatteInfo(path)
+        self.assertEqual(cinfo.get_selection_name(), "CryptoObject")
+        self.assertEqual(sorted(cinfo.parse_manifest()), names)
+        read_ids, read_coverage = cinfo.read_ranks()
+        expected_ids, expected_coverage = ck.merge_ranks(self.rank_ids, self.rank_coverage,
+                                                         ids_b, coverage_b)
+        self.assertBitsEqual(read_ids, expected_ids)
+        self.assertBitsEqual(read_coverage, expected_coverage)
+
+        ce.write_cryptomatte(path_b, ids_b[:, 1:], coverage_b[:, 1:], "CryptoEnvironment",
+                             manifest_b)
+        self.assertRaises(ValueError, ck.merge_cryptomatte_files, path_a, path_b, path)
+        self.assertRaises(ValueError, ck.merge_cryptomatte_files, path_a, path_a, path,
+                          layer_b="CryptoMaterial")
+
+    def test_merge_files_keeps_source(self):
+        import os
+        import numpy as np
+        import cryptomatte_utilities as cu
+        import cryptomatte_exr as ce
+        import cryptomatte_encoding as ck
+        source = self.cinfo.header.parts[0]
+        rank_ids, rank_coverage = self.cinfo.read_ranks()
+        ids_b, coverage_b = rank_ids[:, ::-1].copy(), rank_coverage[:, ::-1].copy()
+        path_b = os.path.join(self.temp_dir, "environment.exr")
+        ce.write_cryptomatte(path_b, ids_b, coverage_b, "CryptoEnvironment", {},
+                             data_window=source.data_window[:2])
+
+        path = os.path.join(self.temp_dir, "merged.exr")
+        ck.merge_cryptomatte_files(self.cinfo.header.path, path_b, path, "CryptoObject")
+        merged = ce.read_exr_header(path).parts[0]
+        self.assertEqual(merged.data_window, source.data_window)
+        self.assertEqual(merged.display_attributes(), source.display_attributes())
+        metadata = merged.metadata_attributes()
+        for key, value in source.metadata_attributes().items():
+            if key.startswith("cryptomatte/"):
+                self.assertNotIn(key, metadata)
+            else:
+                self.assertEqual(metadata[key], value, key)
+        self.assertIn("cryptomatte/%s/name" % cu.layer_hash("CryptoObject"), metadata)
+
+        copied = [channel for channel in source.channels
+                  if not channel.name.startswith("uCryptoWildcard0")]
+        self.assertEqual(sorted((c.name, c.pixel_type) for c in merged.channels
+                                if not c.name.startswith("CryptoObject")),
+                         sorted((c.name, c.pixel_type) for c in copied))
+        names = [channel.nuke_name for channel in copied]
+        dtypes = [ce.EXR_PIXEL_TYPE_DTYPES[channel.pixel_type] for channel in copied]
+        with ce.ExrScanlineReader(self.cinfo.header.path) as reader:
+            expected = reader.read(names, [reader.allocate(1, dtype)[0] for dtype in dtypes])
+        with ce.ExrScanlineReader(path) as reader:
+            planes = reader.read(names, [reader.allocate(1, dtype)[0] for dtype in dtypes])
+        for name, plane, expected_plane in zip(names, planes, expected):
+            self.assertEqual(plane.tobytes(), expected_plane.tobytes(), name)
+        cinfo = ce.ExrCryptomatteInfo(path)
+        cinfo.set_selection("CryptoObject")
+        read_ids, read_coverage = cinfo.read_ranks()
+        expected_ids, expected_coverage = ck.merge_ranks(rank_ids, rank_coverage, ids_b,
+                                                         coverage_b)
+        self.assertBitsEqual(read_ids, expected_ids)
+        self.assertBitsEqual(read_coverage, expected_coverage)
+
+        ck.merge_cryptomatte_files(self.cinfo.header.path, path_b, path, "CryptoObject",
+                                   copy_channels=False)
+        merged = ce.read_exr_header(path).parts[0]
+        self.assertEqual(merged.display_attributes(), source.display_attributes())
+        self.assertTrue(all(c.name.startswith("CryptoObject0") for c in merged.channels))
+
+    def test_manifest(self):
+        import cryptomatte_utilities as cu
+        import cryptomatte_encoding as ck
+        manifest = {"other": "00000001"}
+        _, _, updated = ck.insert_matte(self.rank_ids, self.rank_coverage, self.alpha, "painted",
+                                        manifest)
+        self.assertEqual(updated, {"other": "00000001",
+                                   "painted": cu.id_to_hex(cu.mm3hash_float("painted"))})
+        self.assertEqual(manifest, {"other": "00000001"})
+        clash = {"other": cu.id_to_hex(cu.mm3hash_float("painted"))}
+        self.assertRaises(ValueError, ck.insert_matte, self.rank_ids, self.rank_coverage,
+                          self.alpha, "painted", clash)
+        self.assertEqual(ck.add_manifest_ids({}, [("a", 1.0), ("b", 2.0), ("a", 1.0)]),
+                         {"a": cu.id_to_hex(1.0), "b": cu.id_to_hex(2.0)})
+        self.assertRaises(ValueError, ck.add_manifest_ids, {}, [("a", 1.0), ("b", 1.0)])
+
+        merged = ck.merge_manifests({"a": "00000001", "b": "00000002"},
+                                    {"b": "00000002", "c": "00000003"})
+        self.assertEqual(merged, {"a": "00000001", "b": "00000002", "c": "00000003"})
+        self.assertRaises(ValueError, ck.merge_manifests, {"a": "00000001"}, {"b": "00000001"})
+        self.assertRaises(ValueError, ck.merge_manifests, {"a": "00000001"}, {"a": "00000002"})
+
+    def test_round_trip(self):
+        import os
+        import numpy as np
+        import cryptomatte_exr as ce
+        import cryptomatte_encoding as ck
+        import cryptomatte_extraction as cx
+        manifest = self.cinfo.parse_manifest()
+        manifest_hex = dict((name, "%08x" % np.float32(ID).view(np.uint32))
+                            for name, ID in manifest.items())
+        rank_ids, rank_coverage, manifest_hex = ck.insert_matte(
+            self.rank_ids, self.rank_coverage, self.alpha, "painted", manifest_hex, ranks=7)
+        path = os.path.join(self.temp_dir, "encrypted.exr")
+        ce.write_cryptomatte(path, rank_ids, rank_coverage, "uCryptoPainted", manifest_hex)
+
+        cinfo = ce.ExrCryptomatteInfo(path)
+        self.assertEqual(cinfo.get_selection_name(), "uCryptoPainted")
+        self.assertEqual(len(cinfo.get_rank_channels()), 8)
+        read_ids, read_coverage = cinfo.read_ranks()
+        self.assertBitsEqual(read_ids[:7], rank_ids)
+        painted = cx.extract_matte(read_ids, read_coverage, [cinfo.name_to_ID("painted")])
+        self.assertBitsEqual(painted, self.alpha)
+        for name, ID in manifest.items():
+            expected = cx.extract_matte(self.rank_ids, self.rank_coverage, [ID])
+            expected *= np.float32(1.0) - self.alpha
+            matte = cx.extract_matte(read_ids, read_coverage, [cinfo.name_to_ID(name)])
+            self.assertTrue(np.allclose(matte, expected, atol=1e-6), name)
+
+
 #############################################
 # Nuke tests
 #############################################
@@ -575,6 +2258,7 @@ class CryptomatteNukeTests(unittest.TestCase):
             # They'll just scatter some nodes about.
             self.setUpClass()
         cu.reset_manifest_cache()
+        cu.reset_expression_cache()
         self._remove_later = []
         self.gizmo = self.tempNode("Cryptomatte", inputs=[self.read_asset])
         self.merge = self.tempNode(
@@ -595,6 +2279,7 @@ class CryptomatteNukeTests(unittest.TestCase):
                 nuke.delete(node)
 
         cu.reset_manifest_cache()
+        cu.reset_expression_cache()
 
 
     def tempNode(self, nodeType, **kwargs):
@@ -864,6 +2549,17 @@ class CryptomatteNukeTests(unittest.TestCase):
             "Update function should have updated from upstream changes. %s" %
             (gizmo.knob("cryptoLayer").value()))
 
+    def test_repeated_update_avoids_knob_writes(self):
+        import cryptomatte_utilities as cu
+        self.gizmo.knob("matteList").setValue("triangle")
+        cu.update_cryptomatte_gizmo(self.gizmo, True)
+        cu.reset_knob_write_stats()
+        cu.update_cryptomatte_gizmo(self.gizmo, True)
+        stats = cu.get_knob_write_stats()
+        cu.reset_knob_write_stats()
+        self.assertEqual(stats["written"], 0, "No-op update wrote knobs: %s" % stats)
+        self.assertTrue(stats["avoided"] > 0, "No-op update skipped no knobs: %s" % stats)
+
     #############################################
     # Keying
     #############################################
@@ -1264,6 +2960,88 @@ class CryptomatteNukeTests(unittest.TestCase):
             msg = "Matte-only difference between %s and %s" % (channels[i], channels[i + 1])
             self.assertEqual(decrypto_hashes[i], decrypto_hashes[i + 1], msg)
 
+    def test_decrypto_split_expression(self):
+        import cryptomatte_utilities as cu
+        self.key_on_image(self.set_pkr, self.bunny_pkr)
+        correct_hash = self.hash_channel(self.gizmo, self.set_pkr, "alpha")
+        expression = self.gizmo.knob("expression").value()
+
+        new_nodes = cu._decryptomatte(self.gizmo, max_expression_length=len(expression) // 4)
+        self.delete_nodes_after_test(new_nodes)
+        self.assertTrue(len(new_nodes) > 1, "Expression was not split.")
+        for node in new_nodes:
+            self.assertTrue(len(node.knob("expr0").value()) < len(expression))
+        decryptomatte_hash = self.hash_channel(new_nodes[-1], self.set_pkr, "alpha")
+        self.assertEqual(correct_hash, decryptomatte_hash,
+                         "Split decryptomatte caused a different alpha from Cryptomatte.")
+
+    def test_decrypto_split_expression_exact(self):
+        """ Splitting the expression of all the objects, so many terms match
+        on the edges across node boundaries, gives the same bits as the
+        unsplit expression. This relies on Nuke evaluating it in float32.
+        """
+        import cryptomatte_utilities as cu
+        matte_list = cu.MatteList("")
+        for name in cu.CryptomatteInfo(self.read_asset).parse_manifest():
+            matte_list.add(name)
+        gizmos = [self.tempNode("Cryptomatte", inputs=[self.read_asset],
+                                matteList=matte_list.to_nukestr)
+                  for _ in range(2)]
+        for gizmo in gizmos:
+            cu.update_cryptomatte_gizmo(gizmo, True)
+        expression = gizmos[0].knob("expression").value()
+
+        unsplit_nodes = cu._decryptomatte(gizmos[0])
+        split_nodes = cu._decryptomatte(gizmos[1], max_expression_length=len(expression) // 8)
+        self.delete_nodes_after_test(unsplit_nodes + split_nodes)
+        self.assertEqual(len(unsplit_nodes), 1)
+        self.assertTrue(len(split_nodes) > 4, "Expression was not split.")
+        for pkr in [self.bunny_pkr, self.floweredge_pkr, self.bunnyflower_pkr]:
+            self.assertEqual(self.hash_channel(unsplit_nodes[-1], pkr, "alpha", num_scanlines=32),
+                             self.hash_channel(split_nodes[-1], pkr, "alpha", num_scanlines=32),
+                             "Split decryptomatte differs from unsplit at %s." % (pkr[1],))
+
+    def test_decrypto_merge_sources(self):
+        import cryptomatte_utilities as cu
+        custom_layer = "uCryptoAsset"  # guaranteed to already exist
+        self.key_on_image(self.bunny_pkr)
+        gizmos = [self.gizmo]
+        for matte_list, kwargs in [("set", {}),
+                                   ("bunny, set", {"unpremultiply": True}),
+                                   ("triangle", {"matteOutput": custom_layer}),
+                                   ("set", {"matteOnly": True}),
+                                   ("bunny", {"RemoveChannels": True})]:
+            gizmo = self.tempNode("Cryptomatte", inputs=[self.read_asset], matteList=matte_list, **kwargs)
+            cu.update_cryptomatte_gizmo(gizmo, True)
+            gizmos.append(gizmo)
+        outputs = [self.tempNode("Dot", inputs=[gizmo]) for gizmo in gizmos]
+
+        channels = ["alpha", "%s.red" % custom_layer]
+        correct_hashes = [[self.hash_channel(gizmo, self.bunny_pkr, ch) for ch in channels]
+                          for gizmo in gizmos]
+        correct_channels = [set(gizmo.channels()) for gizmo in gizmos]
+        batch_channels = set("%s.%s" % (cu.DECRYPTOMATTE_BATCH_LAYER, channel)
+                             for channel in cu.DECRYPTOMATTE_BATCH_CHANNELS)
+
+        singles, batches = cu._decryptomatte_batches(gizmos)
+        self.assertEqual((singles, batches), ([], [gizmos]))
+        new_nodes = cu._decryptomatte_batch(gizmos)
+        self.delete_nodes_after_test(new_nodes)
+        self.assertEqual(len([x for x in new_nodes if x.Class() == "Expression"]), 2)
+        self.assertEqual(len([x for x in new_nodes if x.Class() == "Remove"]), 1)
+
+        for i, (gizmo, output) in enumerate(zip(gizmos, outputs)):
+            self.assertTrue(gizmo.knob("disable").value())
+            hashes = [self.hash_channel(output, self.bunny_pkr, ch) for ch in channels]
+            self.assertEqual(correct_hashes[i], hashes,
+                             "Merged decryptomatte differs from %s" % gizmo.name())
+            # The batch layer is only removed along with the other channels.
+            channels = set(output.channels())
+            if not gizmo.knob("RemoveChannels").value():
+                channels -= batch_channels
+            self.assertEqual(correct_channels[i], channels,
+                             "Merged decryptomatte changed channels of %s" % gizmo.name())
+
     def test_decrypto_rmchannels_customlayer(self):
         self._test_decrypto_rmchannels("uCryptoAsset")
 